@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+Compare nearest-neighbour queries ordered by ST_Distance with the KNN queries
+built by prkng.database.nearest, on growing tables of random points.
+
+Usage: python contrib/bench_nearest.py "dbname=prkng_test user=prkng" [rows ...]
+
+Everything is done in temporary tables; nothing is written to the database.
+"""
+import random
+import sys
+import time
+
+import psycopg2
+
+sys.path.insert(0, '.')
+from prkng.database import nearest
+
+
+LIMIT = 5
+QUERIES = 50
+# around Montreal
+BBOX = (-73.75, 45.40, -73.47, 45.70)
+
+
+def random_point():
+    return random.uniform(BBOX[0], BBOX[2]), random.uniform(BBOX[1], BBOX[3])
+
+
+def timed(cur, queries):
+    started = time.time()
+    for qry in queries:
+        cur.execute(qry)
+        cur.fetchall()
+    return (time.time() - started) * 1000 / len(queries)
+
+
+def main(dsn, sizes):
+    conn = psycopg2.connect(dsn)
+    cur = conn.cursor()
+    print("{:>10} {:>16} {:>16} {:>8}".format("rows", "ST_Distance (ms)", "KNN (ms)", "speedup"))
+    for size in sizes:
+        cur.execute("DROP TABLE IF EXISTS bench_points")
+        cur.execute("""
+            CREATE TEMP TABLE bench_points AS
+            SELECT id, ST_Transform(ST_SetSRID(ST_MakePoint(
+                    {0} + random() * ({2} - {0}), {1} + random() * ({3} - {1})), 4326), 3857) AS geom
+            FROM generate_series(1, {size}) id
+        """.format(*BBOX, size=size))
+        cur.execute("CREATE INDEX ON bench_points USING gist(geom)")
+        cur.execute("ANALYZE bench_points")
+
+        points = [random_point() for _ in range(QUERIES)]
+        old = timed(cur, ["""
+            SELECT id FROM bench_points
+            ORDER BY ST_Distance(geom, st_transform('SRID=4326;POINT({} {})'::geometry, 3857))
+            LIMIT {}
+        """.format(x, y, LIMIT) for x, y in points])
+        new = timed(cur, [nearest("bench_points", ["id"], x, y, LIMIT) for x, y in points])
+        print("{:>10} {:>16.2f} {:>16.2f} {:>7.1f}x".format(size, old, new, old / new))
+    conn.rollback()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        sys.exit(__doc__)
+    main(sys.argv[1], [int(x) for x in sys.argv[2:]] or [1000, 10000, 100000, 1000000])
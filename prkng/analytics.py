@@ -1,171 +1,95 @@
 from prkng.database import db
 
+from sqlalchemy import text
+
+
+# metrics shown on the admin dashboard: table, time column and aggregate
+METRICS = {
+    'users': ('users', 'created', 'count(id)'),
+    'actives': ('users', 'last_hello', 'count(DISTINCT id)'),
+    'checkins': ('checkins', 'checkin_time', 'count(id)'),
+    'checkin_users': ('checkins', 'checkin_time', 'count(DISTINCT user_id)')
+}
+
 
 class Analytics(object):
+    """
+    Figures for the admin dashboard.
+
+    Daily and monthly figures are read from the `analytics_rollups` table, kept up to date
+    by the `update_analytics_rollups` task. Only today's figure is computed live.
+    """
     @staticmethod
-    def get_user_data():
+    def get_rollup(metric):
+        """
+        Get today's figure as well as daily and monthly history for a metric.
+
+        :param metric: one of the keys of METRICS (str)
+        :returns: dict with 'day' (int), 'week' and 'year' (lists of dicts)
+        """
+        table, column, aggregate = METRICS[metric]
         today = db.engine.execute("""
-            SELECT count(id)
-            FROM users
-            WHERE (created AT TIME ZONE 'UTC') AT TIME ZONE 'US/Eastern' >= (NOW() AT TIME ZONE 'US/Eastern')::date
-              AND (created AT TIME ZONE 'UTC') AT TIME ZONE 'US/Eastern' <= (NOW() AT TIME ZONE 'US/Eastern' + INTERVAL '1 DAY')::date
-        """).first()[0]
+            SELECT {aggregate}
+            FROM {table}
+            WHERE {column} >= ((NOW() AT TIME ZONE 'US/Eastern')::date::timestamp AT TIME ZONE 'US/Eastern') AT TIME ZONE 'UTC'
+        """.format(table=table, column=column, aggregate=aggregate)).first()[0]
         week = db.engine.execute("""
             SELECT
-              a.date, count(u.id)
-            FROM (
-              SELECT
-                to_char(date_trunc('day', ((NOW() AT TIME ZONE 'US/Eastern')::date - (offs * INTERVAL '1 DAY'))), 'YYYY-MM-DD"T"HH24:MI:SS"-0400"') AS date
-              FROM generate_series(0, 365, 1) offs
-            ) a
-            LEFT OUTER JOIN users u
-              ON (a.date = to_char(date_trunc('day', (u.created AT TIME ZONE 'UTC') AT TIME ZONE 'US/Eastern'), 'YYYY-MM-DD"T"HH24:MI:SS"-0400"'))
-            GROUP BY a.date
+              to_char(a.date, 'YYYY-MM-DD"T"HH24:MI:SS"-0400"') AS date, coalesce(r.count, 0) AS count
+            FROM generate_series(
+                ((NOW() AT TIME ZONE 'US/Eastern')::date - 6)::timestamp,
+                ((NOW() AT TIME ZONE 'US/Eastern')::date - 1)::timestamp,
+                INTERVAL '1 DAY'
+            ) AS a(date)
+            LEFT OUTER JOIN analytics_rollups r
+              ON r.period = 'day' AND r.metric = '{metric}' AND r.date = a.date::date
             ORDER BY a.date DESC
-            OFFSET 1 LIMIT 6
-        """)
+        """.format(metric=metric))
         year = db.engine.execute("""
             SELECT
-              to_char(a.date, 'Mon'), count(u.id)
-            FROM (
-              SELECT
-                date_trunc('month', ((NOW() AT TIME ZONE 'US/Eastern')::date - (offs * INTERVAL '1 MONTH'))) AS date
-              FROM generate_series(0, 12, 1) offs
-            ) a
-            LEFT OUTER JOIN users u
-              ON (to_char(a.date, 'Mon') = to_char(date_trunc('month', (u.created AT TIME ZONE 'UTC') AT TIME ZONE 'US/Eastern'), 'Mon'))
-            GROUP BY a.date
+              to_char(a.date, 'Mon') AS to_char, coalesce(r.count, 0) AS count
+            FROM generate_series(
+                date_trunc('month', (NOW() AT TIME ZONE 'US/Eastern')) - INTERVAL '5 MONTHS',
+                date_trunc('month', (NOW() AT TIME ZONE 'US/Eastern')),
+                INTERVAL '1 MONTH'
+            ) AS a(date)
+            LEFT OUTER JOIN analytics_rollups r
+              ON r.period = 'month' AND r.metric = '{metric}' AND r.date = a.date::date
             ORDER BY a.date DESC
-            LIMIT 6
-        """)
+        """.format(metric=metric))
         return {"day": today, "week": [{key: value for key, value in row.items()} for row in week],
             "year": [{key: value for key, value in row.items()} for row in year]}
 
+    @staticmethod
+    def get_user_data():
+        return Analytics.get_rollup('users')
+
     @staticmethod
     def get_active_user_chk_data():
-        today = db.engine.execute("""
-            SELECT count(DISTINCT c.user_id)
-            FROM checkins c
-            WHERE (c.checkin_time AT TIME ZONE 'UTC') AT TIME ZONE 'US/Eastern' >= (NOW() AT TIME ZONE 'US/Eastern')::date
-              AND (c.checkin_time AT TIME ZONE 'UTC') AT TIME ZONE 'US/Eastern' <= (NOW() AT TIME ZONE 'US/Eastern' + INTERVAL '1 DAY')::date
-        """).first()[0]
-        week = db.engine.execute("""
-            SELECT
-              a.date, count(DISTINCT c.user_id)
-            FROM (
-              SELECT
-                to_char(date_trunc('day', ((NOW() AT TIME ZONE 'US/Eastern')::date - (offs * INTERVAL '1 DAY'))), 'YYYY-MM-DD"T"HH24:MI:SS"-0400"') AS date
-              FROM generate_series(0, 365, 1) offs
-            ) a
-            LEFT OUTER JOIN checkins c
-              ON (a.date = to_char(date_trunc('day', (c.checkin_time AT TIME ZONE 'UTC') AT TIME ZONE 'US/Eastern'), 'YYYY-MM-DD"T"HH24:MI:SS"-0400"'))
-            GROUP BY a.date
-            ORDER BY a.date DESC
-            OFFSET 1 LIMIT 6
-        """)
-        year = db.engine.execute("""
-            SELECT
-              to_char(a.date, 'Mon'), count(DISTINCT c.user_id)
-            FROM (
-              SELECT
-                date_trunc('month', ((NOW() AT TIME ZONE 'US/Eastern')::date - (offs * INTERVAL '1 MONTH'))) AS date
-              FROM generate_series(0, 12, 1) offs
-            ) a
-            LEFT OUTER JOIN checkins c
-              ON (to_char(a.date, 'Mon') = to_char(date_trunc('month', (c.checkin_time AT TIME ZONE 'UTC') AT TIME ZONE 'US/Eastern'), 'Mon'))
-            GROUP BY a.date
-            ORDER BY a.date DESC
-            LIMIT 6
-        """)
-        return {"day": today, "week": [{key: value for key, value in row.items()} for row in week],
-            "year": [{key: value for key, value in row.items()} for row in year]}
+        return Analytics.get_rollup('checkin_users')
 
     @staticmethod
     def get_active_user_data():
-        today = db.engine.execute("""
-            SELECT count(DISTINCT u.id)
-            FROM users u
-            WHERE (u.last_hello AT TIME ZONE 'UTC') AT TIME ZONE 'US/Eastern' >= (NOW() AT TIME ZONE 'US/Eastern')::date
-              AND (u.last_hello AT TIME ZONE 'UTC') AT TIME ZONE 'US/Eastern' <= (NOW() AT TIME ZONE 'US/Eastern' + INTERVAL '1 DAY')::date
-        """).first()[0]
-        week = db.engine.execute("""
-            SELECT
-              a.date, count(DISTINCT u.id)
-            FROM (
-              SELECT
-                to_char(date_trunc('day', ((NOW() AT TIME ZONE 'US/Eastern')::date - (offs * INTERVAL '1 DAY'))), 'YYYY-MM-DD"T"HH24:MI:SS"-0400"') AS date
-              FROM generate_series(0, 365, 1) offs
-            ) a
-            LEFT OUTER JOIN users u
-              ON (a.date = to_char(date_trunc('day', (u.last_hello AT TIME ZONE 'UTC') AT TIME ZONE 'US/Eastern'), 'YYYY-MM-DD"T"HH24:MI:SS"-0400"'))
-            GROUP BY a.date
-            ORDER BY a.date DESC
-            OFFSET 1 LIMIT 6
-        """)
-        year = db.engine.execute("""
-            SELECT
-              to_char(a.date, 'Mon'), count(DISTINCT u.id)
-            FROM (
-              SELECT
-                date_trunc('month', ((NOW() AT TIME ZONE 'US/Eastern')::date - (offs * INTERVAL '1 MONTH'))) AS date
-              FROM generate_series(0, 12, 1) offs
-            ) a
-            LEFT OUTER JOIN users u
-              ON (to_char(a.date, 'Mon') = to_char(date_trunc('month', (u.last_hello AT TIME ZONE 'UTC') AT TIME ZONE 'US/Eastern'), 'Mon'))
-            GROUP BY a.date
-            ORDER BY a.date DESC
-            LIMIT 6
-        """)
-        return {"day": today, "week": [{key: value for key, value in row.items()} for row in week],
-            "year": [{key: value for key, value in row.items()} for row in year]}
+        return Analytics.get_rollup('actives')
 
     @staticmethod
     def get_checkin_data():
-        today = db.engine.execute("""
-            SELECT count(id)
-            FROM checkins
-            WHERE (checkin_time AT TIME ZONE 'UTC') AT TIME ZONE 'US/Eastern' >= (NOW() AT TIME ZONE 'US/Eastern')::date
-              AND (checkin_time AT TIME ZONE 'UTC') AT TIME ZONE 'US/Eastern' <= (NOW() AT TIME ZONE 'US/Eastern' + INTERVAL '1 DAY')::date
-        """).first()[0]
-        week = db.engine.execute("""
-            SELECT
-              a.date, count(c.id)
-            FROM (
-              SELECT
-                to_char(date_trunc('day', ((NOW() AT TIME ZONE 'US/Eastern')::date - (offs * INTERVAL '1 DAY'))), 'YYYY-MM-DD"T"HH24:MI:SS"-0400"') AS date
-              FROM generate_series(0, 365, 1) offs
-            ) a
-            LEFT OUTER JOIN checkins c
-              ON (a.date = to_char(date_trunc('day', (c.checkin_time AT TIME ZONE 'UTC') AT TIME ZONE 'US/Eastern'), 'YYYY-MM-DD"T"HH24:MI:SS"-0400"'))
-            GROUP BY a.date
-            ORDER BY a.date DESC
-            OFFSET 1 LIMIT 6
-        """)
-        year = db.engine.execute("""
-            SELECT
-              to_char(a.date, 'Mon'), count(c.id)
-            FROM (
-              SELECT
-                date_trunc('month', ((NOW() AT TIME ZONE 'US/Eastern')::date - (offs * INTERVAL '1 MONTH'))) AS date
-              FROM generate_series(0, 12, 1) offs
-            ) a
-            LEFT OUTER JOIN checkins c
-              ON (to_char(a.date, 'Mon') = to_char(date_trunc('month', (c.checkin_time AT TIME ZONE 'UTC') AT TIME ZONE 'US/Eastern'), 'Mon'))
-            GROUP BY a.date
-            ORDER BY a.date DESC
-            LIMIT 6
-        """)
-        return {"day": today, "week": [{key: value for key, value in row.items()} for row in week],
-            "year": [{key: value for key, value in row.items()} for row in year]}
+        return Analytics.get_rollup('checkins')
 
     @staticmethod
-    def get_map_usage(hours=24):
-        res = db.engine.execute("""
-            SELECT
-                ST_X(ST_Transform(centerpoint, 4326)) AS long,
-                ST_Y(ST_Transform(centerpoint, 4326)) AS lat,
-                count
-            FROM analytics_pos
-            WHERE created >= (NOW() - ({} * INTERVAL '1 HOUR'))
-        """.format(hours))
+    def get_map_usage(hours=24, city=None):
+        """
+        Get map usage aggregated on a grid, as maintained by the `update_heatmap` task.
+
+        :param hours: time window, in hours before now (int)
+        :param city: only return cells of this city (opt str)
+        :returns: list of dicts with the `long`, `lat` of each cell center and its `count`
+        """
+        res = db.engine.execute(text("""
+            SELECT long, lat, sum(count) AS count
+            FROM analytics_heatmap
+            WHERE hour >= date_trunc('hour', NOW() - (:hours * INTERVAL '1 HOUR'))
+              AND (CAST(:city AS varchar) IS NULL OR city = :city)
+            GROUP BY bin_x, bin_y, long, lat
+        """), hours=hours, city=city or None)
         return [{key: value for key, value in row.items()} for row in res]
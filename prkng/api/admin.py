@@ -1,7 +1,10 @@
+from prkng import passwords
 from prkng.api import auth_required, create_token
 from prkng.analytics import Analytics
-from prkng.models import Carshares, Checkins, City, Corrections, FreeSpaces, ParkingLots, Reports, Slots, User
+from prkng.database import db
+from prkng.models import Analytics as AnalyticsRecords, Carshares, Checkins, City, Corrections, FreeSpaces, ParkingLots, Reports, Slots, User
 from prkng.notifications import schedule_notifications
+from prkng.tasks import scheduling, worker
 
 from flask import jsonify, Blueprint, abort, current_app, request, send_from_directory
 from geojson import Feature, FeatureCollection
@@ -301,10 +304,33 @@ def get_heatmap():
     """
     Get map usage heatmap
     """
-    usage = Analytics.get_map_usage(request.args.get('hours', 24))
+    try:
+        hours = int(request.args.get('hours', 24))
+    except ValueError:
+        return "Hours must be an integer", 400
+    usage = Analytics.get_map_usage(hours, request.args.get('city'))
     return jsonify(heatmap=usage), 200
 
 
+@admin.route('/api/metrics', methods=['GET'])
+@auth_required()
+def get_metrics():
+    """
+    Get runtime counters for the worker process serving this request
+    """
+    return jsonify(passwords=passwords.stats(), analytics=AnalyticsRecords.buffer().stats()), 200
+
+
+@admin.route('/api/tasks', methods=['GET'])
+@auth_required()
+def get_tasks():
+    """
+    Get the state and last runs of the periodic tasks, and the connections of the worker processes
+    """
+    return jsonify(tasks=scheduling.status(db.redis, int(request.args.get('count', 20))),
+        workers=worker.stats(db.redis)), 200
+
+
 @admin.route('/api/notification', methods=['POST'])
 @auth_required()
 def send_push():
@@ -1,5 +1,6 @@
 from __future__ import unicode_literals
 
+from prkng import passwords
 from prkng.api.public import api
 from prkng.models import Checkins, City, Images, Reports, Slots, User, UserAuth
 from prkng.login import facebook_signin, google_signin, email_register, email_signin, email_update
@@ -249,8 +250,11 @@ class LoginEmailChangePass(Resource):
         user = User.get_byemail(args["email"])
         if not user:
             return "Account not found", 404
-        if not UserAuth.update_password("email${}".format(user.id), args["passwd"], args["code"]):
-            return "Reset code incorrect", 400
+        try:
+            if not UserAuth.update_password("email${}".format(user.id), args["passwd"], args["code"]):
+                return "Reset code incorrect", 400
+        except passwords.PasswordPoolBusy:
+            return "Server busy, please try again", 503
 
 
 # define header parser for the API key
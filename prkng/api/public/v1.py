@@ -1,6 +1,8 @@
 from __future__ import unicode_literals
 
+from prkng import live, passwords
 from prkng.api.public import api
+from prkng.database import db
 from prkng.models import Analytics, Carshares, Checkins, City, Images, ParkingLots, Reports, Slots, User, UserAuth
 from prkng.login import facebook_signin, google_signin, email_register, email_signin, email_update
 from prkng.tasks.general import parking_panda_welcome_email
@@ -8,7 +10,7 @@ from prkng.utils import timestamp
 
 import copy
 from geojson import loads, FeatureCollection, Feature
-from flask import Response, g, request
+from flask import Response, current_app, g, request, stream_with_context
 from flask.ext.restplus import Resource, fields
 from rq import Queue
 import time
@@ -756,6 +758,46 @@ class CarshareLotsResource(Resource):
         ]), 200
 
 
+live_parser = copy.deepcopy(api_key_parser)
+for arg, desc in [('neLat', 'North-east latitude'), ('neLng', 'North-east longitude'),
+        ('swLat', 'South-west latitude'), ('swLng', 'South-west longitude')]:
+    live_parser.add_argument(
+        arg,
+        type=float,
+        location='args',
+        required=True,
+        help='{} of the bounding box in degrees (WGS84)'.format(desc)
+    )
+
+
+@ns.route('/live', endpoint='live_v1')
+class LiveResource(Resource):
+    @api.secure
+    @api.doc(security='apikey',
+        responses={404: "no feature found"}
+    )
+    @api.doc(parser=live_parser)
+    def get(self):
+        """
+        Stream carshare and parking lot changes inside a bounding box, as Server-Sent Events.
+
+        Each event is a JSON list of changes with `type` (carshare, carshare_lot or lot),
+        `event` (parked, moved, unparked or availability), `id`, `long`, `lat` and properties.
+        The stream is closed after a few minutes; clients are expected to reconnect.
+        """
+        args = live_parser.parse_args()
+
+        city = City.get((args['neLng'] + args['swLng']) / 2, (args['neLat'] + args['swLat']) / 2)
+        if not city:
+            api.abort(404, "no feature found")
+
+        return Response(stream_with_context(live.stream(db.redis, city,
+                args['neLat'], args['neLng'], args['swLat'], args['swLng'],
+                current_app.config['LIVE_STREAM_DURATION'], current_app.config['LIVE_HEARTBEAT'])),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
 login_parser = api.parser()
 login_parser.add_argument('type', type=str, location='form', help='login type (facebook, google, etc). required for OAuth2', required=False)
 login_parser.add_argument('email', type=str, location='form', help='user email (for email logins only)', required=False)
@@ -868,8 +910,11 @@ class LoginChangePass(Resource):
         user = User.get_byemail(args["email"])
         if not user:
             return "Account not found", 404
-        if not UserAuth.update_password("email${}".format(user.id), args["passwd"], args["code"]):
-            return "Reset code incorrect", 400
+        try:
+            if not UserAuth.update_password("email${}".format(user.id), args["passwd"], args["code"]):
+                return "Reset code incorrect", 400
+        except passwords.PasswordPoolBusy:
+            return "Server busy, please try again", 503
 
 
 # define the slot id parser
@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming database backups.
+
+The output of ``pg_dump`` is piped through a compressor (``pigz``, which uses
+every core, or ``gzip`` if it is not installed) and cut into fixed-size parts
+that are uploaded concurrently as a multipart upload while the dump goes on.
+Nothing is written to local disk, and only a few parts are held in memory at
+once, so backups are not capped by the size of one upload or of ``/tmp``.
+
+Targets implement ``open``, ``write_part``, ``complete`` and ``abort``:
+:class:`S3Target` for Amazon S3, and :class:`DirectoryTarget` which stores the
+parts in a local directory the same way, for tests and local backups.
+
+Local backups can also be made in the directory format of ``pg_dump``, which
+dumps and restores several tables at once (see :func:`dump_directory` and
+:func:`restore_directory`).
+"""
+from cStringIO import StringIO
+from distutils.spawn import find_executable
+import fnmatch
+from multiprocessing.pool import ThreadPool
+import os
+import re
+import subprocess
+import tempfile
+import threading
+import time
+
+from boto.s3.connection import S3Connection
+from boto.s3.multipart import MultiPartUpload
+
+from prkng.logger import Logger
+
+
+MEGABYTE = 1024 * 1024
+
+# line of pg_dump / pg_restore --verbose output telling the data of a table is processed
+TABLE_DATA = re.compile(
+    r'(?:dumping contents of table|processing data for table|finished item \d+ TABLE DATA) "?([^"\s]+)"?$')
+
+
+class S3Target(object):
+    """
+    Multipart upload to Amazon S3, with a connection per uploading thread.
+    Parts must be at least 5 MB, except the last one.
+    """
+    def __init__(self, connect, bucket, name, encrypt=True):
+        """
+        :param connect: function returning a new S3Connection
+        :param bucket: bucket name (str)
+        :param name: key name (str)
+        :param encrypt: encrypt the object server-side (bool)
+        """
+        self.connect = connect
+        self.bucket = bucket
+        self.name = name
+        self.encrypt = encrypt
+        self.local = threading.local()
+        self.upload = None
+
+    @property
+    def location(self):
+        return os.path.join(self.bucket, self.name)
+
+    def open(self):
+        self.upload = self.connect().get_bucket(self.bucket, validate=False) \
+            .initiate_multipart_upload(self.name, encrypt_key=self.encrypt)
+
+    def write_part(self, num, data):
+        # boto connections must not be shared between threads
+        if not hasattr(self.local, 'upload'):
+            self.local.upload = MultiPartUpload(self.connect().get_bucket(self.bucket, validate=False))
+            self.local.upload.key_name = self.name
+            self.local.upload.id = self.upload.id
+        self.local.upload.upload_part_from_file(StringIO(data), num, size=len(data))
+
+    def complete(self):
+        self.upload.complete_upload()
+
+    def abort(self):
+        if self.upload is not None:
+            self.upload.cancel_upload()
+
+
+class DirectoryTarget(object):
+    """
+    Multipart upload to a local directory: parts are written next to the final file
+    and put together when the upload completes, as S3 does.
+    """
+    def __init__(self, directory, name):
+        """
+        :param directory: path of the directory (str)
+        :param name: file name (str)
+        """
+        self.directory = directory
+        self.name = name
+        self.parts = set()
+
+    @property
+    def location(self):
+        return os.path.join(self.directory, self.name)
+
+    def _part(self, num):
+        return "{}.part{:05d}".format(self.location, num)
+
+    def open(self):
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+    def write_part(self, num, data):
+        with open(self._part(num), 'wb') as f:
+            f.write(data)
+        self.parts.add(num)
+
+    def complete(self):
+        with open(self.location, 'wb') as f:
+            for num in sorted(self.parts):
+                with open(self._part(num), 'rb') as part:
+                    while True:
+                        data = part.read(MEGABYTE)
+                        if not data:
+                            break
+                        f.write(data)
+        self.abort()
+
+    def abort(self):
+        for num in self.parts:
+            if os.path.exists(self._part(num)):
+                os.unlink(self._part(num))
+        self.parts = set()
+
+
+def compressor(threads=None):
+    """
+    Command compressing stdin to stdout.
+
+    :param threads: number of threads used by pigz, default one per core (int)
+    :returns: list of str
+    """
+    if find_executable('pigz'):
+        return ['pigz', '-c'] + (['-p', str(threads)] if threads else [])
+    return ['gzip', '-c']
+
+
+def read_part(f, size):
+    """
+    Read ``size`` bytes from a pipe, or less at the end of the stream.
+    """
+    chunks, left = [], size
+    while left:
+        data = f.read(min(left, MEGABYTE))
+        if not data:
+            break
+        chunks.append(data)
+        left -= len(data)
+    return "".join(chunks)
+
+
+def stream(command, target, part_size=32 * MEGABYTE, uploads=4, threads=None):
+    """
+    Compress the output of a command and upload it in parts to a target.
+
+    :param command: command writing the data to stdout (list of str)
+    :param target: S3Target or DirectoryTarget
+    :param part_size: size of the uploaded parts, in bytes (int)
+    :param uploads: number of parts uploaded at once (int)
+    :param threads: number of compression threads, see :func:`compressor` (int)
+    :returns: stats (dict): compressed bytes, parts, seconds and throughput in MB/s
+    """
+    started = time.time()
+    dump = subprocess.Popen(command, stdout=subprocess.PIPE)
+    compress = subprocess.Popen(compressor(threads), stdin=dump.stdout, stdout=subprocess.PIPE)
+    dump.stdout.close()
+
+    # at most twice `uploads` parts in memory, read parts waiting for a free upload thread
+    slots = threading.BoundedSemaphore(uploads * 2)
+    errors = []
+
+    def upload(num, data):
+        try:
+            if not errors:
+                target.write_part(num, data)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            slots.release()
+
+    pool = ThreadPool(uploads)
+    size, num = 0, 0
+    try:
+        target.open()
+        while not errors:
+            data = read_part(compress.stdout, part_size)
+            if not data and num:
+                break
+            # an empty dump is still uploaded, as one empty part
+            slots.acquire()
+            num += 1
+            size += len(data)
+            pool.apply_async(upload, (num, data))
+            if not data:
+                break
+        pool.close()
+        pool.join()
+        if errors:
+            raise errors[0]
+        compress.stdout.close()
+        if compress.wait() or dump.wait():
+            raise subprocess.CalledProcessError(dump.returncode or compress.returncode, command[0])
+        target.complete()
+    except BaseException:
+        pool.terminate()
+        for proc in (dump, compress):
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+        target.abort()
+        raise
+
+    seconds = time.time() - started
+    stats = {"bytes": size, "parts": num, "seconds": round(seconds, 1),
+        "throughput": round(float(size) / MEGABYTE / max(seconds, 0.001), 2)}
+    Logger.info("Backup stored as {}: {:.1f} MB in {} parts, {}s ({} MB/s)".format(
+        target.location, float(size) / MEGABYTE, num, stats["seconds"], stats["throughput"]))
+    return stats
+
+
+def pg_dump_command(CONFIG, include=(), exclude=()):
+    """
+    Command dumping the database as SQL.
+
+    :param CONFIG: app configuration (dict)
+    :param include: patterns of the tables to dump, default all (list of str)
+    :param exclude: patterns of the tables not to dump (list of str)
+    :returns: list of str
+    """
+    return ['pg_dump', '-c', '-U', CONFIG["PG_USERNAME"]] + table_options(include, exclude) + \
+        [CONFIG["PG_DATABASE"]]
+
+
+def table_options(include=(), exclude=()):
+    return [v for x in include for v in ('-t', x)] + [v for x in exclude for v in ('-T', x)]
+
+
+def run_verbose(command, action, total=None):
+    """
+    Run pg_dump or pg_restore, logging each table as its data is processed.
+
+    :param command: command, without --verbose (list of str)
+    :param action: word describing the command in the log, e.g. "Dumping" (str)
+    :param total: number of tables expected, if known (int)
+    :returns: number of tables processed (int)
+    """
+    started = time.time()
+    proc = subprocess.Popen(command + ['--verbose'], stderr=subprocess.PIPE)
+    seen = set()
+    for line in iter(proc.stderr.readline, ''):
+        line = line.strip()
+        match = TABLE_DATA.search(line)
+        if match:
+            name = match.group(1).split('.')[-1]
+            if name not in seen:
+                seen.add(name)
+                Logger.info("{} {}{}: {} ({:.0f}s)".format(action, len(seen),
+                    "/{}".format(total) if total else "", name, time.time() - started))
+        elif 'error' in line.lower() or 'warning' in line.lower():
+            Logger.warning(line)
+    if proc.wait():
+        raise subprocess.CalledProcessError(proc.returncode, command[0])
+    return len(seen)
+
+
+def dump_directory(CONFIG, path, jobs=4, include=(), exclude=()):
+    """
+    Dump the database in the directory format, ``jobs`` tables at once.
+
+    :param CONFIG: app configuration (dict)
+    :param path: directory to create (str)
+    :param jobs: number of tables dumped at once (int)
+    :param include: patterns of the tables to dump, default all (list of str)
+    :param exclude: patterns of the tables not to dump (list of str)
+    :returns: stats (dict): tables, bytes and seconds
+    """
+    started = time.time()
+    tables = run_verbose(['pg_dump', '-Fd', '-j', str(jobs), '-f', path, '-U', CONFIG["PG_USERNAME"]] +
+        table_options(include, exclude) + [CONFIG["PG_DATABASE"]], "Dumping")
+    size = sum(os.path.getsize(os.path.join(path, x)) for x in os.listdir(path))
+    stats = {"tables": tables, "bytes": size, "seconds": round(time.time() - started, 1)}
+    Logger.info("Backup stored as {}: {} tables, {:.1f} MB, {}s".format(
+        path, tables, float(size) / MEGABYTE, stats["seconds"]))
+    return stats
+
+
+def filter_toc(lines, include=(), exclude=()):
+    """
+    Filter the table of contents of a dump (``pg_restore -l``) to restore only the data
+    of some tables. The schema of every table is restored.
+
+    :param lines: lines of the table of contents (list of str)
+    :param include: patterns of the tables to restore the data of, default all (list of str)
+    :param exclude: patterns of the tables not to restore the data of (list of str)
+    :returns: list of the lines kept (str)
+    """
+    kept = []
+    for line in lines:
+        # e.g. "2345; 0 16386 TABLE DATA public slots prkng"
+        fields = line.partition(';')[2].split()
+        if not line.startswith(';') and fields[2:4] == ['TABLE', 'DATA']:
+            name = fields[5]
+            if include and not any(fnmatch.fnmatch(name, x) for x in include):
+                continue
+            if any(fnmatch.fnmatch(name, x) for x in exclude):
+                continue
+        kept.append(line)
+    return kept
+
+
+def restore_directory(CONFIG, path, jobs=4, include=(), exclude=()):
+    """
+    Restore a dump in the directory format, ``jobs`` tables at once.
+    Existing objects are dropped first.
+
+    :param CONFIG: app configuration (dict)
+    :param path: directory of the dump (str)
+    :param jobs: number of tables restored at once (int)
+    :param include: patterns of the tables to restore the data of, default all (list of str)
+    :param exclude: patterns of the tables not to restore the data of (list of str)
+    :returns: stats (dict): tables and seconds
+    """
+    started = time.time()
+    toc = filter_toc(subprocess.check_output(['pg_restore', '-l', path]).splitlines(), include, exclude)
+    with tempfile.NamedTemporaryFile(suffix='.list') as f:
+        f.write("\n".join(toc) + "\n")
+        f.flush()
+        tables = run_verbose(['pg_restore', '-c', '--if-exists', '-j', str(jobs), '-L', f.name,
+            '-U', CONFIG["PG_USERNAME"], '-d', CONFIG["PG_DATABASE"], path], "Restoring",
+            total=sum(1 for x in toc if ' TABLE DATA ' in x))
+    stats = {"tables": tables, "seconds": round(time.time() - started, 1)}
+    Logger.info("Backup {} restored: {} tables, {}s".format(path, tables, stats["seconds"]))
+    return stats
+
+
+def backup(CONFIG, target, include=(), exclude=()):
+    """
+    Dump the database to a target, see :func:`stream`.
+
+    :param CONFIG: app configuration (dict)
+    :param target: S3Target or DirectoryTarget
+    :param include: patterns of the tables to dump, default all (list of str)
+    :param exclude: patterns of the tables not to dump (list of str)
+    :returns: stats (dict)
+    """
+    return stream(pg_dump_command(CONFIG, include, exclude), target, part_size=CONFIG["BACKUP_PART_SIZE"],
+        uploads=CONFIG["BACKUP_UPLOADS"], threads=CONFIG["BACKUP_THREADS"])
+
+
+def s3_target(CONFIG, bucket, name):
+    """
+    :param CONFIG: app configuration (dict)
+    :param bucket: bucket name (str)
+    :param name: key name (str)
+    :returns: S3Target
+    """
+    return S3Target(lambda: S3Connection(CONFIG["AWS_ACCESS_KEY"], CONFIG["AWS_SECRET_KEY"]),
+        bucket, name)
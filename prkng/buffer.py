@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+In-process write-behind buffer.
+
+Records are appended to a bounded ring buffer from the request thread, which
+never blocks, and written out in batches by a background thread. When the
+buffer is full the oldest records are dropped and counted.
+"""
+import atexit
+import collections
+import os
+import threading
+import time
+
+from logger import Logger
+
+
+class WriteBehindBuffer(object):
+    """
+    Bounded ring buffer flushed in batches by a daemon thread.
+    """
+    def __init__(self, flush, maxlen=10000, batch_size=500, interval=1.0):
+        """
+        :param flush: function called with a list of records, from the background thread
+        :param maxlen: max number of records waiting to be flushed (int)
+        :param batch_size: max number of records given to ``flush`` at once (int)
+        :param interval: max number of seconds a record waits before being flushed (float)
+        """
+        self.flush = flush
+        self.maxlen = maxlen
+        self.batch_size = batch_size
+        self.interval = interval
+        self.records = collections.deque(maxlen=maxlen)
+        self.cond = threading.Condition()
+        self.counters = collections.Counter()
+        self.pid = None
+        atexit.register(self.drain)
+
+    def add(self, record):
+        """
+        Queue a record for writing. Never blocks on I/O.
+
+        :param record: any object understood by the flush function
+        """
+        with self.cond:
+            if len(self.records) == self.maxlen:
+                # the deque discards the oldest record on append
+                self.counters['dropped'] += 1
+            self.records.append(record)
+            self.counters['queued'] += 1
+            if len(self.records) >= self.batch_size:
+                self.cond.notify()
+            if self.pid != os.getpid():
+                # first use in this process (threads don't survive a fork)
+                self.pid = os.getpid()
+                thread = threading.Thread(target=self._run, name='write-behind')
+                thread.daemon = True
+                thread.start()
+
+    def _take(self):
+        with self.cond:
+            return [self.records.popleft() for _ in range(min(len(self.records), self.batch_size))]
+
+    def _write(self, batch):
+        started = time.time()
+        try:
+            self.flush(batch)
+        except Exception:
+            Logger.exception("Write-behind flush of {} records failed".format(len(batch)))
+            with self.cond:
+                self.counters['failed'] += len(batch)
+        else:
+            with self.cond:
+                self.counters['flushed'] += len(batch)
+                self.counters['batches'] += 1
+                self.counters['flush_time'] += time.time() - started
+
+    def _run(self):
+        while True:
+            with self.cond:
+                if len(self.records) < self.batch_size:
+                    self.cond.wait(self.interval)
+            batch = self._take()
+            if batch:
+                self._write(batch)
+
+    def drain(self):
+        """
+        Flush everything still in the buffer from the calling thread.
+        Called automatically when the process exits.
+        """
+        if self.pid != os.getpid():
+            return
+        batch = self._take()
+        while batch:
+            self._write(batch)
+            batch = self._take()
+
+    def stats(self):
+        """
+        Return the buffer counters.
+
+        :returns: dict
+        """
+        with self.cond:
+            res = dict(self.counters, pending=len(self.records), pid=os.getpid())
+        return res
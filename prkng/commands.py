@@ -1,7 +1,8 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function
 
-from prkng import create_app
+from prkng import backup as backups, create_app
+from prkng.database import PostgresWrapper
 from prkng.logger import Logger
 from subprocess import check_call
 from prkng.tasks import init_tasks
@@ -27,30 +28,54 @@ def serve():
 
 
 @click.command()
-def backup():
+@click.option('--format', 'fmt', type=click.Choice(['plain', 'directory']), default='plain',
+    help='Compressed SQL file, or directory dumped and restored in parallel')
+@click.option('--jobs', '-j', default=4, help='Tables dumped at once (directory format)')
+@click.option('--include', '-t', multiple=True, help='Only dump tables matching this pattern')
+@click.option('--exclude', '-T', multiple=True, help='Do not dump tables matching this pattern')
+@click.option('--s3', is_flag=True, help='Upload to the backup bucket on Amazon S3 (plain format)')
+def backup(fmt, jobs, include, exclude, s3):
     """
     Dump the database to file
     """
     CONFIG = create_app().config
+    if fmt == 'directory' and s3:
+        raise click.UsageError('Only plain backups can be uploaded to S3')
     Logger.info('Creating backup...')
     backup_dir = os.path.join(os.path.dirname(os.environ["PRKNG_SETTINGS"]), 'backup')
-    file_name = 'prkng-{}.sql.gz'.format(datetime.datetime.now().strftime('%Y%m%d-%H%M%S'))
-    if not os.path.exists(backup_dir):
-        os.mkdir(backup_dir)
-    subprocess.check_call('pg_dump -c -U {PG_USERNAME} {PG_DATABASE} | gzip > {}'.format(
-        os.path.join(backup_dir, file_name), PG_USERNAME=CONFIG["PG_USERNAME"], PG_DATABASE=CONFIG["PG_DATABASE"]),
-        shell=True)
-    Logger.info('Backup created and stored as {}'.format(os.path.join(backup_dir, file_name)))
+    file_name = 'prkng-{}'.format(datetime.datetime.now().strftime('%Y%m%d-%H%M%S'))
+    if fmt == 'directory':
+        if not os.path.exists(backup_dir):
+            os.mkdir(backup_dir)
+        backups.dump_directory(CONFIG, os.path.join(backup_dir, file_name), jobs, include, exclude)
+        return
+    if s3:
+        target = backups.s3_target(CONFIG, CONFIG["BACKUP_BUCKET"], file_name + '.sql.gz')
+    else:
+        target = backups.DirectoryTarget(backup_dir, file_name + '.sql.gz')
+    backups.backup(CONFIG, target, include, exclude)
+    Logger.info('Backup created and stored as {}'.format(target.location))
 
 
 @click.command(name="import")
-@click.argument('path', type=click.Path(exists=True, dir_okay=False, readable=True, resolve_path=True))
-def file_import(path):
+@click.argument('path', type=click.Path(exists=True, readable=True, resolve_path=True))
+@click.option('--jobs', '-j', default=4, help='Tables restored at once (directory backups)')
+@click.option('--include', '-t', multiple=True,
+    help='Only restore the data of tables matching this pattern (directory backups)')
+@click.option('--exclude', '-T', multiple=True,
+    help='Do not restore the data of tables matching this pattern (directory backups)')
+def file_import(path, jobs, include, exclude):
     """
-    Import database from specified file location
+    Import database from specified file or directory location
     """
     CONFIG = create_app().config
     Logger.info('Importing backup...')
+    if os.path.isdir(path):
+        backups.restore_directory(CONFIG, path, jobs, include, exclude)
+        Logger.info('Data imported successfully')
+        return
+    if include or exclude:
+        raise click.UsageError('Tables can only be filtered when importing directory backups')
     if path.endswith(".gz"):
         cmdstring = 'gunzip -c {} | psql {PG_USERNAME} {PG_DATABASE}'
     else:
@@ -78,6 +103,97 @@ def maintenance():
     check_call('service nginx reload')
 
 
+# indexes declared in the models that are built on existing databases by ``prkng migrate``
+# (tables created from the models already have them), and on the existing monthly partitions
+# of the table (later ones copy them): table, name, definition
+INDEXES = [
+    ("checkins", "checkins_active_slot_idx", "(slot_id) WHERE active = true AND checkout_time IS NULL"),
+    ("users", "users_last_hello_idx", "(last_hello)"),
+    ("analytics_pos", "analytics_pos_created_idx", "(created)"),
+    ("analytics_event", "analytics_event_created_idx", "(created)"),
+    ("analytics_event", "analytics_event_user_id_event_created_idx", "(user_id, event, created)"),
+    ("analytics_search", "analytics_search_created_idx", "(created)"),
+    ("free_spaces", "free_spaces_time_slot_idx", "(time, slot_id)"),
+]
+
+
+@click.command()
+def migrate():
+    """
+    Upgrade the tables and build the indexes missing from the database, without locking the tables
+    """
+    CONFIG = create_app().config
+    db = PostgresWrapper(
+        "host='{PG_HOST}' port={PG_PORT} dbname={PG_DATABASE} "
+        "user={PG_USERNAME} password={PG_PASSWORD} ".format(**CONFIG))
+    if upgrade_free_spaces(db):
+        Logger.info('Table free_spaces upgraded')
+    for table, name, definition in INDEXES:
+        if db.create_index_concurrently(table, name, definition):
+            Logger.info('Index {} built'.format(name))
+        for partition, index, definition in missing_partition_indexes(db, table, name):
+            db.create_index_concurrently(partition, index, definition)
+            Logger.info('Index {} built'.format(index))
+    Logger.info('Database up to date')
+
+
+def missing_partition_indexes(db, table, name):
+    """
+    Find the partitions of a table (see ``update_partitions``) without a valid copy of one of
+    its indexes, whatever the name of the copy.
+
+    :param db: PostgresWrapper instance
+    :param table: table name (str)
+    :param name: name of the index of the table (str)
+    :returns: list of (partition, index name, definition after ``ON partition``) tuples
+    """
+    res = db.query("""
+        SELECT c.relname, substring(x.indexdef from ' USING .*$') AS definition
+        FROM pg_indexes x
+        JOIN pg_class p ON p.relname = x.tablename
+        JOIN pg_inherits h ON h.inhparent = p.oid
+        JOIN pg_class c ON c.oid = h.inhrelid
+        WHERE x.tablename = '{table}' AND x.indexname = '{name}'
+          AND NOT EXISTS (
+            SELECT 1 FROM pg_index i
+            WHERE i.indrelid = c.oid AND i.indisvalid
+              AND substring(pg_get_indexdef(i.indexrelid) from ' USING .*$')
+                = substring(x.indexdef from ' USING .*$')
+          )
+        ORDER BY c.relname
+    """.format(table=table, name=name))
+    return [(partition, partition + name[len(table):] if name.startswith(table) else
+        '{}_{}'.format(partition, name), definition) for partition, definition in res]
+
+
+def upgrade_free_spaces(db):
+    """
+    Move free spaces recorded as arrays of slot IDs (one row per run) to one row per slot.
+    Their index is then built with the others (see ``INDEXES``).
+
+    :param db: PostgresWrapper instance
+    :returns: True if the table was upgraded (bool)
+    """
+    if not db.query("""
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name = 'free_spaces' AND column_name = 'slot_ids'
+    """):
+        return False
+    db.queries([
+        "ALTER TABLE free_spaces ADD COLUMN slot_id integer",
+        """
+        INSERT INTO free_spaces (time, slot_id)
+          SELECT time, unnest(slot_ids) FROM free_spaces WHERE slot_ids IS NOT NULL
+        """,
+        "DELETE FROM free_spaces WHERE slot_id IS NULL",
+        """
+        ALTER TABLE free_spaces DROP COLUMN slot_ids, DROP COLUMN address,
+            ALTER COLUMN slot_id SET NOT NULL
+        """
+    ])
+    return True
+
+
 @click.command(name="init-tasks")
 def initialize_tasks():
     """
@@ -92,4 +208,5 @@ main.add_command(serve)
 main.add_command(backup)
 main.add_command(file_import)
 main.add_command(maintenance)
+main.add_command(migrate)
 main.add_command(initialize_tasks)
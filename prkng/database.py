@@ -4,6 +4,7 @@
 """
 from __future__ import print_function
 from contextlib import contextmanager
+import math
 
 import psycopg2
 from psycopg2.extras import NamedTupleCursor
@@ -109,6 +110,35 @@ class PostgresWrapper(object):
         self.query("CREATE INDEX on {table} USING {index_type}({column})"
                    .format(**locals()))
 
+    def create_index_concurrently(self, table, index_name, definition):
+        """
+        Create an index without locking writes to the table, unless it already exists.
+        An index left invalid by an interrupted build is dropped and built again.
+
+        :param table: table name
+        :param index_name: index name
+        :param definition: what follows ``ON table``, e.g. "(slot_id) WHERE active"
+        :returns: True if the index was built (bool)
+        """
+        valid = self.query("""
+            SELECT i.indisvalid FROM pg_index i
+            WHERE i.indexrelid = to_regclass('{}')
+        """.format(index_name))
+        if valid and valid[0][0]:
+            return False
+
+        # for executing in a non transaction block
+        self.db.set_session(autocommit=True)
+        try:
+            if valid:
+                self.query("DROP INDEX CONCURRENTLY {}".format(index_name))
+            Logger.info("CREATE INDEX CONCURRENTLY {} ON {}".format(index_name, table))
+            self.query("CREATE INDEX CONCURRENTLY {} ON {} {}".format(index_name, table, definition))
+        finally:
+            # switch to default isolation level
+            self.db.set_session(autocommit=False)
+        return True
+
     def vacuum_analyze(self, schema, table):
         """
         Free spaces for given table and collect statistics
@@ -132,14 +162,102 @@ class PostgresWrapper(object):
         """
         Uses the efficient PostgreSQL COPY command to move data
         from file-like object to tables
+
+        :param values: iterable of rows (sequences); None is written as NULL
         """
         from cStringIO import StringIO
         cur = self.db.cursor()
         cur.copy_from(
-            StringIO(
-                '\n'.join('\t'.join(str(col) if col else '\\N' for col in line) for line in values)
-            ),
+            StringIO(''.join(copy_line(line) for line in values)),
             '{}.{}'.format(schema, table),
             columns=columns,
         )
         self.db.commit()
+
+    def copy_to(self, table, fileobj):
+        """
+        Export a whole table to a file-like object with the COPY command (text format)
+
+        :param table: table name, optionally schema-qualified (str)
+        :param fileobj: writable file-like object
+        """
+        cur = self.db.cursor()
+        cur.copy_expert("COPY {} TO STDOUT".format(table), fileobj)
+        self.db.commit()
+
+
+def copy_value(value):
+    """
+    Format a value for the text format of the COPY command.
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    elif isinstance(value, float):
+        value = repr(value)
+    elif not isinstance(value, str):
+        value = str(value)
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def copy_line(values):
+    """
+    Format a row for the text format of the COPY command.
+    """
+    return '\t'.join(copy_value(value) for value in values) + '\n'
+
+
+def mercator_distance(meters, lat):
+    """
+    Convert a distance on the ground to the units of Web Mercator (3857) at a latitude, where
+    they are stretched by 1 / cos(latitude): about 1.43 per meter in Montreal.
+
+    :param meters: distance in meters (float)
+    :param lat: latitude (float)
+    :returns: distance in 3857 units (float)
+    """
+    return meters / math.cos(math.radians(float(lat)))
+
+
+def nearest(source, columns, x, y, limit, where="true", max_distance=None,
+            geom="geom", key="id", distance=False):
+    """
+    Build a query for the ``limit`` rows closest to a point, closest first.
+
+    Candidates are read from the GiST index of ``geom`` with the ``<->`` operator, so only
+    the rows returned are looked at instead of the whole table. For points it gives the
+    exact distance; a few more candidates than needed are taken so that rows at the same
+    distance are ordered by ``key`` whatever order the index returns them in.
+
+    :param source: FROM clause, e.g. "carshares c" (str)
+    :param columns: list of column expressions, e.g. ["c.id", "1 AS quantity"] (list of str)
+    :param x: longitude (float)
+    :param y: latitude (float)
+    :param limit: number of rows to return (int)
+    :param where: condition on the rows of ``source`` (str)
+    :param max_distance: ignore rows further than this, in meters (int)
+    :param geom: geometry column, in 3857 with a GiST index (str)
+    :param key: column breaking ties between rows at the same distance (str)
+    :param distance: also return the distance in meters, as ``knn_distance`` (bool)
+    :returns: SQL query (str)
+    """
+    point = "ST_Transform('SRID=4326;POINT({} {})'::geometry, 3857)".format(x, y)
+    names = [c.split(" AS ")[-1].split(".")[-1] for c in columns]
+    if max_distance:
+        where = "({}) AND ST_DWithin({}, {}, {})".format(where, geom, point,
+            mercator_distance(max_distance, y))
+    return """
+        SELECT {names}{distance} FROM (
+            SELECT {columns}, {key} AS knn_key, ST_Distance({geom}, {point}) * {scale} AS knn_distance
+            FROM {source}
+            WHERE {where}
+            ORDER BY {geom} <-> {point}
+            LIMIT {candidates}
+        ) knn
+        ORDER BY knn_distance, knn_key
+        LIMIT {limit}
+    """.format(names=", ".join(names), distance=", knn_distance" if distance else "",
+        columns=", ".join(columns), key=key, geom=geom, point=point, scale=1 / mercator_distance(1, y),
+        source=source,
+        where=where, candidates=limit + 10, limit=limit)
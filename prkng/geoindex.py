@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+Live index of parked carshares and carshare lots, kept in Redis.
+
+After each ingestion, the parked carshares and the carshare lots of a city are
+copied from PostgreSQL (which stays the system of record) into a Redis GEO set
+with a hash of the properties returned by the API. Radius and nearest searches
+are answered from there, sorted by distance. The keys expire if the ingestion
+stops; searches then return None and the caller falls back to PostgreSQL.
+
+GEO commands need Redis >= 3.2 and are sent with ``execute_command``, as our
+client library has no helpers for them.
+"""
+import datetime
+import json
+
+from redis.exceptions import RedisError
+
+
+# max distance of a nearest search, in meters
+NEAREST_RADIUS = 100000
+
+
+def key(kind, city):
+    """
+    Name of the GEO set of a city; the properties are in the ``:props`` hash next to it.
+
+    :param kind: "carshares" or "carshare_lots" (str)
+    :param city: city name (str)
+    :returns: str
+    """
+    return "prkng:geo:{}:{}".format(kind, city)
+
+
+def _value(x):
+    if isinstance(x, datetime.datetime):
+        return x.isoformat()
+    return x
+
+
+def store(r, kind, city, rows, ttl):
+    """
+    Replace the index of a city.
+
+    :param r: Redis connection
+    :param kind: "carshares" or "carshare_lots" (str)
+    :param city: city name (str)
+    :param rows: list of (member, longitude, latitude, properties (list)) tuples
+    :param ttl: seconds before the index expires if it is not stored again (int)
+    """
+    name = key(kind, city)
+    pipe = r.pipeline(transaction=False)
+    pipe.delete(name + ":new", name + ":new:props")
+    for i in range(0, len(rows), 500):
+        chunk = rows[i:i + 500]
+        pipe.execute_command("GEOADD", name + ":new", *[v for x in chunk for v in (x[1], x[2], x[0])])
+        pipe.hmset(name + ":new:props", {x[0]: json.dumps([_value(v) for v in x[3]]) for x in chunk})
+    pipe.execute()
+
+    # swap the new index in at once, readers never see a partial one
+    pipe = r.pipeline()
+    if rows:
+        pipe.rename(name + ":new", name)
+        pipe.rename(name + ":new:props", name + ":props")
+        pipe.expire(name, ttl)
+        pipe.expire(name + ":props", ttl)
+    else:
+        pipe.delete(name, name + ":props")
+    pipe.execute()
+
+
+def rebuild(db, r, city, ttl):
+    """
+    Copy the parked carshares and the carshare lots of a city from the database to the index.
+
+    Carshares are indexed one by one (``c:<id>`` members), and zipcars once more as one
+    vehicle per lot with the lot capacity as quantity (``z:<lot id>`` members), as returned
+    by the API when zipcar is asked for. Properties are in the order of
+    ``Carshares.select_properties`` and ``Carshares.lot_properties``.
+
+    :param db: PostgresWrapper instance
+    :param r: Redis connection
+    :param city: city name (str)
+    :param ttl: seconds before the index expires if it is not rebuilt (int)
+    """
+    cars = db.query("""
+        SELECT 'c:' || c.id, ST_X(ST_Transform(c.geom, 4326)), ST_Y(ST_Transform(c.geom, 4326)),
+            c.id, c.geojson::text, c.vin, c.company, c.name, c.fuel, c.electric, c.partner_id,
+            c.until, 1
+        FROM carshares c
+        WHERE c.city = '{city}' AND c.parked = true
+        UNION ALL
+        SELECT DISTINCT ON (c.lot_id)
+            'z:' || c.lot_id, ST_X(ST_Transform(c.geom, 4326)), ST_Y(ST_Transform(c.geom, 4326)),
+            c.id, c.geojson::text, c.vin, c.company, c.name, c.fuel, c.electric, c.partner_id,
+            c.until, l.capacity
+        FROM carshares c
+        JOIN carshare_lots l ON c.lot_id = l.id
+        WHERE c.city = '{city}' AND c.parked = true AND c.company = 'zipcar'
+    """.format(city=city))
+    store(r, "carshares", city,
+        [x[:3] + ([x[3], json.loads(x[4]) if x[4] else None] + list(x[5:]),) for x in cars], ttl)
+
+    lots = db.query("""
+        SELECT l.id, ST_X(ST_Transform(l.geom, 4326)), ST_Y(ST_Transform(l.geom, 4326)),
+            l.id, l.geojson::text, l.company, l.name, l.capacity, l.available
+        FROM carshare_lots l
+        WHERE l.city = '{city}'
+    """.format(city=city))
+    store(r, "carshare_lots", city,
+        [x[:3] + ([x[3], json.loads(x[4]) if x[4] else None] + list(x[5:]),) for x in lots], ttl)
+
+
+def search(r, kind, city, x, y, radius):
+    """
+    Find the indexed items around a point, closest first.
+
+    :param r: Redis connection
+    :param kind: "carshares" or "carshare_lots" (str)
+    :param city: city name (str)
+    :param x: longitude (float)
+    :param y: latitude (float)
+    :param radius: radius in meters (int)
+    :returns: list of (member, properties (list)) tuples, or None if the index cannot be used
+    """
+    name = key(kind, city)
+    try:
+        pipe = r.pipeline(transaction=False)
+        pipe.exists(name)
+        pipe.execute_command("GEORADIUS", name, x, y, radius, "m", "ASC")
+        exists, members = pipe.execute()
+        if not exists:
+            return None
+        props = r.hmget(name + ":props", members) if members else []
+    except RedisError:
+        # Redis unavailable, or without GEO commands
+        return None
+    return [(m, json.loads(p)) for m, p in zip(members, props) if p]
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+Staged ingestion of partner data (carshares, parking lots).
+
+Records received from a partner API are copied with COPY into temporary tables,
+then applied to the real tables with a few set-based statements. Everything is
+done in a single transaction: readers see either the previous state or the new
+one, and a failure leaves the tables untouched. The time spent and the number
+of rows affected by each stage are logged at the end of the run.
+
+Since most runs see few changes, the records last written for each provider and
+city are fingerprinted in Redis (see :class:`Fingerprints`), so that unchanged
+payloads and records can be left out. The rows changed by a run can also be
+published to clients as real-time events (see :mod:`prkng.live`).
+"""
+from cStringIO import StringIO
+import hashlib
+import json
+import time
+
+import psycopg2
+
+from database import copy_line
+import live
+from logger import Logger
+
+
+def point(lon, lat):
+    """
+    Format a WGS84 position as EWKT, which COPY accepts for a geometry column.
+
+    :param lon: longitude (float)
+    :param lat: latitude (float)
+    :returns: str
+    """
+    return "SRID=4326;POINT({} {})".format(lon, lat)
+
+
+def returning(kind, alias=None, columns=()):
+    """
+    RETURNING clause giving what a client needs to know about a changed row, for
+    :meth:`Ingestion.apply`. The table must have ``id``, ``city`` and ``geom`` (3857) columns.
+
+    :param kind: type of row, e.g. "carshare" (str)
+    :param alias: alias of the changed table in the statement, if any (str)
+    :param columns: other columns to return (list of str)
+    :returns: str
+    """
+    p = alias + "." if alias else ""
+    return "RETURNING '{kind}' AS type, {cols}, ST_X(ST_Transform({p}geom, 4326)) AS long, " \
+        "ST_Y(ST_Transform({p}geom, 4326)) AS lat".format(kind=kind, p=p,
+            cols=", ".join(p + x for x in ["id", "city"] + list(columns)))
+
+
+class Ingestion(object):
+    """
+    Context manager running one ingestion in a transaction::
+
+        with Ingestion(db, "car2go montreal") as run:
+            run.load("staged_cars", [("vin", "varchar"), ("city", "varchar"), ("geom", "geometry")], rows)
+            run.snap("staged_cars", "car2go")
+            run.apply("unpark", "UPDATE carshares c SET ... FROM staged_cars d WHERE ...")
+    """
+    def __init__(self, db, name, r=None):
+        """
+        :param db: PostgresWrapper instance
+        :param name: name of the run, used in the logs (str)
+        :param r: Redis connection to publish change events with, if any
+        """
+        self.db = db
+        self.name = name
+        self.r = r
+        self.stages = []
+        self.events = []
+
+    def __enter__(self):
+        self.started = time.time()
+        self.cur = self.db.db.cursor()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            if issubclass(exc_type, psycopg2.Error):
+                Logger.error(exc.message.strip())
+                Logger.error("Query : {}".format(self.cur.query))
+            Logger.warning("Rollbacking {}".format(self.name))
+            self.db.db.rollback()
+            return False
+        started = time.time()
+        self.db.db.commit()
+        self.stages.append(("commit", None, time.time() - started))
+        if self.r is not None and self.events:
+            live.publish(self.r, self.events)
+        Logger.info("{}: {} in {:.3f}s".format(self.name, ", ".join(
+            "{} {}{:.3f}s".format(stage, "" if rows is None else "{} rows ".format(rows), duration)
+            for stage, rows, duration in self.stages), time.time() - self.started))
+
+    def load(self, table, columns, rows):
+        """
+        Create a temporary table, dropped at the end of the transaction, and COPY rows into it.
+
+        :param table: name of the temporary table (str)
+        :param columns: list of tuples (column name, SQL type)
+        :param rows: iterable of rows (sequences), in the order of ``columns``
+        :returns: number of rows copied (int)
+        """
+        started = time.time()
+        self.cur.execute("CREATE TEMP TABLE {} ({}) ON COMMIT DROP".format(
+            table, ", ".join("{} {}".format(*x) for x in columns)))
+        lines = [copy_line(x) for x in rows]
+        self.cur.copy_from(StringIO(''.join(lines)), table, columns=[x[0] for x in columns])
+        count = len(lines)
+        # let the planner know the size of what was loaded
+        self.cur.execute("ANALYZE {}".format(table))
+        self.stages.append(("load " + table, count, time.time() - started))
+        return count
+
+    def apply(self, stage, stmt, event=None):
+        """
+        Execute a statement against the loaded tables.
+
+        :param stage: name of the stage, used in the logs (str)
+        :param stmt: SQL statement (str)
+        :param event: if given, the statement ends with a :func:`returning` clause and each row
+            it returns is published under this event name once the run is committed (str)
+        :returns: number of rows affected (int)
+        """
+        started = time.time()
+        self.cur.execute(stmt)
+        if event:
+            names = [x[0] for x in self.cur.description]
+            self.events.extend(dict(zip(names, x), event=event) for x in self.cur.fetchall())
+        self.stages.append((stage, self.cur.rowcount, time.time() - started))
+        return self.cur.rowcount
+
+    def snap(self, table, company, key="vin", radius=5, where="true"):
+        """
+        Find the slot each staged vehicle is parked on.
+
+        The staged table must have ``city`` (may be NULL) and ``geom`` (WGS84) columns, and ``key``
+        to identify the vehicle; it receives ``geom_m`` (the position in 3857, computed once),
+        ``slot_id`` and ``snapped`` columns. Vehicles whose position did not change since the
+        previous run keep their current slot; the others get the closest slot within ``radius``
+        meters, found with the spatial index and ordered by true distance (``<->`` would only
+        compare the bounding boxes of the slots). The city of vehicles without one is found from
+        their position.
+
+        :param table: staged table name (str)
+        :param company: carshare company, to compare with the stored positions (str)
+        :param key: column identifying a vehicle, in the staged table and in carshares (str)
+        :param radius: max distance to the slot, in meters (int)
+        :param where: condition on the staged rows (``d``) to snap, e.g. to skip cars in a lot (str)
+        """
+        self.cur.execute("""
+            ALTER TABLE {table} ADD COLUMN geom_m geometry, ADD COLUMN slot_id integer,
+                ADD COLUMN snapped boolean DEFAULT false
+        """.format(table=table))
+        self.apply("transform", "UPDATE {table} SET geom_m = ST_Transform(geom, 3857)".format(table=table))
+        self.apply("locate", """
+            UPDATE {table} d SET city = c.name
+            FROM cities c
+            WHERE d.city IS NULL AND ST_Intersects(d.geom_m, c.geom)
+        """.format(table=table))
+        self.apply("reuse slots", """
+            UPDATE {table} d SET slot_id = c.slot_id, snapped = true
+            FROM carshares c
+            WHERE c.company = '{company}'
+                AND c.{key} = d.{key}
+                AND c.parked = true
+                AND ST_Equals(c.geom, d.geom_m)
+                AND {where}
+        """.format(table=table, company=company, key=key, where=where))
+        self.apply("snap", """
+            UPDATE {table} d SET snapped = true, slot_id = (
+                SELECT s.id FROM slots s
+                WHERE s.city = d.city AND ST_DWithin(s.geom, d.geom_m, {radius})
+                ORDER BY ST_Distance(s.geom, d.geom_m), s.id
+                LIMIT 1
+            )
+            WHERE d.snapped = false
+                AND d.city IS NOT NULL
+                AND {where}
+        """.format(table=table, radius=radius, where=where))
+
+
+class Fingerprints(object):
+    """
+    Digests of the records last written for a provider (and city), kept in a Redis hash.
+
+    Only the records whose digest changed need to be written again. Every ``ttl`` seconds
+    the digests are ignored and everything is rewritten, in case the tables were modified by
+    something else. Digests must be saved once the records are committed.
+    """
+    def __init__(self, r, name, ttl):
+        """
+        :param r: Redis connection
+        :param name: provider and city, e.g. "car2go:montreal" (str)
+        :param ttl: max number of seconds before a full rewrite (int)
+        """
+        self.r = r
+        self.key = "prkng:fingerprints:" + name
+        self.ttl = ttl
+        self.current = {}
+        self.removed = False
+
+    @staticmethod
+    def _ident(value):
+        # Redis returns hash fields as UTF-8 byte strings
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        return str(value)
+
+    def diff(self, records, key):
+        """
+        Compare records with the ones last saved.
+
+        :param records: list of JSON-serializable records
+        :param key: function returning the identifier of a record
+        :returns: set of identifiers (unicode) of the new or modified records
+        """
+        pipe = self.r.pipeline(transaction=False)
+        pipe.hgetall(self.key)
+        pipe.exists(self.key + ":rewrite")
+        previous, fresh = pipe.execute()
+        self.current = {self._ident(key(x)): hashlib.sha1(json.dumps(x, sort_keys=True)).hexdigest()
+            for x in records}
+        if not fresh:
+            # time for a full rewrite: everything is new, and whatever is not there anymore removed
+            previous = {}
+            self.removed = True
+        else:
+            self.removed = bool(set(previous) - set(self.current))
+        return {k.decode('utf-8') for k, v in self.current.items() if previous.get(k) != v}
+
+    def unchanged(self, records, key):
+        """
+        Tell if records are exactly the ones last saved (none added, modified or removed).
+
+        :returns: bool
+        """
+        return not self.diff(records, key) and not self.removed
+
+    def save(self):
+        """
+        Remember the digests computed by the last call to :meth:`diff`. The time of the next
+        full rewrite is only set when there is none pending, so that it comes even if records
+        keep changing.
+        """
+        pipe = self.r.pipeline()
+        pipe.delete(self.key)
+        if self.current:
+            pipe.hmset(self.key, self.current)
+            pipe.expire(self.key, self.ttl * 2)
+        pipe.set(self.key + ":rewrite", 1, nx=True, ex=self.ttl)
+        pipe.execute()
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Real-time carshare and parking lot changes.
+
+Ingestion tasks publish the rows they changed to a Redis pub/sub channel per
+city, as one JSON list per run. Each event has a ``type`` (carshare,
+carshare_lot or lot), an ``event`` (parked, moved, unparked or availability),
+the row ``id``, its ``long`` / ``lat`` and a few properties depending on the type.
+Clients receive the events of their bounding box as Server-Sent Events.
+"""
+import json
+import time
+
+
+def channel(city):
+    """
+    Name of the pub/sub channel of a city.
+
+    :param city: city name (str)
+    :returns: str
+    """
+    return "prkng:live:" + city
+
+
+def publish(r, events):
+    """
+    Publish change events, one message per city.
+
+    :param r: Redis connection
+    :param events: list of events (dicts with at least ``city``)
+    """
+    cities = {}
+    for x in events:
+        cities.setdefault(x["city"], []).append(x)
+    pipe = r.pipeline(transaction=False)
+    for city, values in cities.items():
+        pipe.publish(channel(city), json.dumps(values))
+    pipe.execute()
+
+
+def stream(r, city, ne_lat, ne_lng, sw_lat, sw_lng, duration, heartbeat):
+    """
+    Generate Server-Sent Events with the changes inside a bounding box.
+
+    The stream ends after ``duration`` seconds so that a worker is not held forever;
+    browsers' EventSource reconnect by themselves. A comment is sent every ``heartbeat``
+    seconds to keep proxies from closing an idle connection.
+
+    :param r: Redis connection
+    :param city: name of the city to follow (str)
+    :param ne_lat, ne_lng, sw_lat, sw_lng: bounding box (float)
+    :param duration: max duration of the stream in seconds (int)
+    :param heartbeat: seconds between keep-alive comments (int)
+    :returns: generator of str
+    """
+    pubsub = r.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(channel(city))
+    try:
+        end = time.time() + duration
+        last = time.time()
+        yield "retry: 5000\n\n"
+        while time.time() < end:
+            msg = pubsub.get_message(timeout=1.0)
+            if msg and msg["type"] == "message":
+                events = [x for x in json.loads(msg["data"]) if x["long"] is not None
+                    and sw_lng <= x["long"] <= ne_lng and sw_lat <= x["lat"] <= ne_lat]
+                if events:
+                    last = time.time()
+                    yield "data: {}\n\n".format(json.dumps(events))
+            elif time.time() - last >= heartbeat:
+                last = time.time()
+                yield ": keep-alive\n\n"
+    finally:
+        pubsub.close()
@@ -2,11 +2,16 @@
 """
 :author: ludovic.delaune@oslandia.com
 """
+from prkng import passwords
+from prkng.database import db
 from prkng.models import User, UserAuth
+from prkng.sessions import get_session
+from prkng.stubs import OAuthStub
 
 from flask.ext.login import LoginManager, login_user
 from flask import current_app
-from passlib.hash import pbkdf2_sha256
+import hashlib
+import json
 import requests
 
 
@@ -45,6 +50,12 @@ def email_register(
     if user:
         return "User already exists", 409
 
+    # hash first, so that a saturated hashing pool doesn't leave a user without auth method
+    try:
+        crypt_pass = passwords.encrypt(password)
+    except passwords.PasswordPoolBusy:
+        return "Server busy, please try again", 503
+
     # primary user doesn't exists, creating it
     user = User.add_user(
         name=name,
@@ -61,7 +72,7 @@ def email_register(
         auth_id=auth_id,
         email=email,
         auth_type='email',
-        password=pbkdf2_sha256.encrypt(password, rounds=200, salt_size=16),
+        password=crypt_pass,
         fullprofile={'birthyear': birthyear}
     )
 
@@ -92,11 +103,20 @@ def email_update(
     :param image_url: URL to user profile image (opt str)
     :returns: User (obj) or status message, HTTP code
     """
-    user.update_profile(name, email, gender, image_url)
     auth_id = 'email${}'.format(user.id)
     ua = UserAuth.exists(auth_id)
+
+    # hash first, so that a saturated hashing pool doesn't leave the profile half-updated
+    crypt_pass = None
     if ua and password:
-        UserAuth.update_password(auth_id, password)
+        try:
+            crypt_pass = passwords.encrypt(password)
+        except passwords.PasswordPoolBusy:
+            return "Server busy, please try again", 503
+
+    user.update_profile(name, email, gender, image_url)
+    if crypt_pass:
+        UserAuth.update_password(auth_id, password, crypt_pass=crypt_pass)
     if ua:
         UserAuth.update(auth_id, birthyear)
 
@@ -128,9 +148,17 @@ def email_signin(email, password):
         return "Existing user with google or facebook account, not email", 401
 
     # check password validity
-    if not pbkdf2_sha256.verify(password, user_auth.password):
+    try:
+        valid, new_hash = passwords.verify(password, user_auth.password)
+    except passwords.PasswordPoolBusy:
+        return "Server busy, please try again", 503
+    if not valid:
         return "Incorrect password", 401
 
+    # the hashing cost has changed since this password was stored
+    if new_hash:
+        UserAuth.upgrade_password(auth_id, new_hash)
+
     user.update_apikey(User.generate_apikey(user.email))
 
     resp = {
@@ -141,39 +169,90 @@ def email_signin(email, password):
     return resp, 200
 
 
-def facebook_signin(access_token):
+def _oauth_session():
     """
-    Authorize user via Facebook oAuth login.
-    Add to the DB as authentication method if not already present.
+    Return the keep-alive session used to reach the OAuth providers.
+    """
+    session = get_session('oauth', pool_size=current_app.config['OAUTH_POOL_SIZE'])
+    if current_app.config['OAUTH_STUB'] and not hasattr(session, 'stub'):
+        session.stub = OAuthStub(current_app.config['OAUTH_CREDENTIALS'])
+        session.mount('https://', session.stub)
+    return session
 
-    :param access_token: access token as returned from Facebook login window on client (str)
-    :returns: User (obj) or status message, HTTP code
+
+def _oauth_get(url, params):
     """
-    # verify access token has been requested with the correct app id
-    resp = requests.get(
-        "https://graph.facebook.com/app/",
-        params={'access_token': access_token}
-    )
-    data = resp.json()
+    Call an OAuth provider endpoint.
+
+    :param url: endpoint URL (str)
+    :param params: query string parameters (dict)
+    :returns: decoded JSON response, HTTP code
+    """
+    resp = _oauth_session().get(url, params=params, timeout=current_app.config['OAUTH_TIMEOUT'])
+    return resp.json(), resp.status_code
+
+
+def _cached_profile(provider, access_token, fetch):
+    """
+    Validate an access token and get the associated profile.
+    Successful results are cached for OAUTH_CACHE_TTL seconds, so that the provider is
+    only contacted once for repeated logins with the same token.
+
+    :param provider: 'facebook' or 'google' (str)
+    :param access_token: access token given by the client (str)
+    :param fetch: function doing the validation, returning (profile, None) or (None, (message, HTTP code))
+    :returns: profile (dict) or None, error (tuple) or None
+    """
+    key = 'prkng:oauth:{}:{}'.format(provider, hashlib.sha1(access_token).hexdigest())
+    cached = db.redis.get(key)
+    if cached:
+        return json.loads(cached), None
+
+    try:
+        profile, error = fetch(access_token)
+    except requests.RequestException:
+        return None, ("Authentication provider unavailable, please try again", 503)
+
+    if profile:
+        db.redis.setex(key, json.dumps(profile), current_app.config['OAUTH_CACHE_TTL'])
+    return profile, error
+
 
-    if resp.status_code != 200:
-        return data, resp.status_code
+def _facebook_profile(access_token):
+    """
+    Validate a Facebook access token and fetch the user's profile.
+    """
+    # verify access token has been requested with the correct app id
+    data, status = _oauth_get("https://graph.facebook.com/app/", {'access_token': access_token})
+    if status != 200:
+        return None, (data, status)
 
     if data['id'] != current_app.config['OAUTH_CREDENTIALS']['facebook']['id']:
-        return "Authentication failed.", 401
+        return None, ("Authentication failed.", 401)
 
     # get user profile
-    resp = requests.get(
-        "https://graph.facebook.com/me",
-        params={'access_token': access_token, 'fields': 'id,email,name,first_name,last_name,gender,picture'}
-    )
-    me = resp.json()
-
-    if resp.status_code != 200:
-        return me, resp.status_code
+    me, status = _oauth_get("https://graph.facebook.com/me",
+        {'access_token': access_token, 'fields': 'id,email,name,first_name,last_name,gender,picture'})
+    if status != 200:
+        return None, (me, status)
 
     if 'email' not in me:
-        return 'Email information not provided, cannot register user', 401
+        return None, ('Email information not provided, cannot register user', 401)
+
+    return me, None
+
+
+def facebook_signin(access_token):
+    """
+    Authorize user via Facebook oAuth login.
+    Add to the DB as authentication method if not already present.
+
+    :param access_token: access token as returned from Facebook login window on client (str)
+    :returns: User (obj) or status message, HTTP code
+    """
+    me, error = _cached_profile('facebook', access_token, _facebook_profile)
+    if error:
+        return error
 
     # check if user exists with its email as unique identifier
     user = User.get_byemail(me['email'])
@@ -216,60 +295,63 @@ def facebook_signin(access_token):
     return resp, 200
 
 
-def google_signin(access_token):
+def _google_profile(access_token):
     """
-    Authorize user via Google Login.
-    Add to the DB as authentication method if not already present.
-
-    :param access_token: access token as returned from Google login window on client (str)
-    :returns: User (obj) or status message, HTTP code
+    Validate a Google access or ID token and fetch the user's profile.
     """
     # verify access token has been requested with the correct app id
     if access_token.startswith("eyJh"):
         # Google Sign-In (1.3.1+)
-        resp = requests.get(
-            "https://www.googleapis.com/oauth2/v3/tokeninfo",
-            params={'id_token': access_token}
-        )
-        data = resp.json()
-        if resp.status_code != 200:
-            return data, resp.status_code
+        data, status = _oauth_get("https://www.googleapis.com/oauth2/v3/tokeninfo",
+            {'id_token': access_token})
+        if status != 200:
+            return None, (data, status)
 
         if data['aud'] not in [current_app.config['OAUTH_CREDENTIALS']['google']['ios_id'],
                 current_app.config['OAUTH_CREDENTIALS']['google']['android_id']]:
-            return "Authentication failed.", 401
+            return None, ("Authentication failed.", 401)
 
-        me = {}
-        id, email, name, picture = data['sub'], data['email'], data['name'], data.get('picture', '')
-        first_name, last_name = data.get('given_name', ''), data.get('family_name', '')
-    else:
-        # Google OAuth 2.0 (1.3 and below)
-        resp = requests.get(
-            "https://www.googleapis.com/oauth2/v1/tokeninfo",
-            params={'access_token': access_token}
-        )
-        data = resp.json()
-        if resp.status_code != 200:
-            return data, resp.status_code
+        return {'id': data['sub'], 'email': data['email'], 'name': data['name'],
+            'picture': data.get('picture', ''), 'first_name': data.get('given_name', ''),
+            'last_name': data.get('family_name', ''), 'me': {}}, None
 
-        if data['audience'] != current_app.config['OAUTH_CREDENTIALS']['google']['id']:
-            return "Authentication failed.", 401
+    # Google OAuth 2.0 (1.3 and below)
+    data, status = _oauth_get("https://www.googleapis.com/oauth2/v1/tokeninfo",
+        {'access_token': access_token})
+    if status != 200:
+        return None, (data, status)
 
-        # get user profile
-        resp = requests.get(
-            "https://www.googleapis.com/oauth2/v1/userinfo",
-            params={'access_token': access_token}
-        )
+    if data['audience'] != current_app.config['OAUTH_CREDENTIALS']['google']['id']:
+        return None, ("Authentication failed.", 401)
+
+    # get user profile
+    me, status = _oauth_get("https://www.googleapis.com/oauth2/v1/userinfo",
+        {'access_token': access_token})
+    if status != 200:
+        return None, (me, status)
 
-        me = resp.json()
-        if resp.status_code != 200:
-            return me, resp.status_code
+    if 'email' not in me:
+        return None, ('Email information not provided, cannot register user', 401)
+
+    return {'id': me['id'], 'email': me['email'], 'name': me['name'],
+        'picture': me.get('picture', ''), 'first_name': me.get('given_name', ''),
+        'last_name': me.get('family_name', ''), 'me': me}, None
 
-        if 'email' not in me:
-            return 'Email information not provided, cannot register user', 401
 
-        id, email, name, picture = me['id'], me['email'], me['name'], me.get('picture', '')
-        first_name, last_name = me.get('given_name', ''), me.get('family_name', '')
+def google_signin(access_token):
+    """
+    Authorize user via Google Login.
+    Add to the DB as authentication method if not already present.
+
+    :param access_token: access token as returned from Google login window on client (str)
+    :returns: User (obj) or status message, HTTP code
+    """
+    profile, error = _cached_profile('google', access_token, _google_profile)
+    if error:
+        return error
+
+    id, email, name, picture = profile['id'], profile['email'], profile['name'], profile['picture']
+    first_name, last_name, me = profile['first_name'], profile['last_name'], profile['me']
 
     auth_id = 'google${}'.format(id)
 
@@ -1,8 +1,12 @@
+from prkng.buffer import WriteBehindBuffer
 from prkng.database import db, metadata
 
+import collections
 import datetime
+from flask import current_app
 import json
-from sqlalchemy import Column, DateTime, Float, Integer, String, Table, text
+from sqlalchemy import Column, Date, DateTime, Float, Index, Integer, String, Table, text
+import threading
 from geoalchemy2 import Geometry
 
 
@@ -16,6 +20,10 @@ search_table = Table(
     Column('query', String)
 )
 
+# analytics are queried by time range, and split into monthly partitions (see update_partitions)
+# that copy these indexes
+search_created_index = Index('analytics_search_created_idx', search_table.c.created)
+
 pos_table = Table(
     'analytics_pos',
     metadata,
@@ -28,6 +36,9 @@ pos_table = Table(
     Column('search_type', String)
 )
 
+# the heatmap aggregates the positions of the last hours
+pos_created_index = Index('analytics_pos_created_idx', pos_table.c.created)
+
 event_table = Table(
     'analytics_event',
     metadata,
@@ -39,6 +50,52 @@ event_table = Table(
     Column('event', String)
 )
 
+event_created_index = Index('analytics_event_created_idx', event_table.c.created)
+event_user_index = Index('analytics_event_user_id_event_created_idx',
+    event_table.c.user_id, event_table.c.event, event_table.c.created)
+
+rollup_table = Table(
+    'analytics_rollups',
+    metadata,
+    Column('period', String, primary_key=True),  # 'day' or 'month'
+    Column('metric', String, primary_key=True),
+    Column('date', Date, primary_key=True),  # first day of the period, US/Eastern
+    Column('count', Integer),
+    Column('updated', DateTime, server_default=text('NOW()'))
+)
+
+heatmap_table = Table(
+    'analytics_heatmap',
+    metadata,
+    Column('city', String, primary_key=True),
+    Column('hour', DateTime, primary_key=True),
+    Column('bin_x', Integer, primary_key=True),  # column of the grid cell, in HEATMAP_BIN_SIZE units
+    Column('bin_y', Integer, primary_key=True),
+    Column('long', Float),  # center of the grid cell, WGS84
+    Column('lat', Float),
+    Column('count', Integer)
+)
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def _flush(records):
+    """
+    Write a batch of analytics records taken from the write-behind buffer.
+    Map positions, searches and events go to their Redis processing queues in one round trip
+    (see the `update_analytics` task).
+
+    :param records: list of (kind, record dict) tuples
+    """
+    queues = collections.defaultdict(list)
+    for kind, record in records:
+        queues['prkng:analytics:' + kind].append(json.dumps(record))
+    pipe = db.redis.pipeline(transaction=False)
+    for key, values in queues.items():
+        pipe.rpush(key, *values)
+    pipe.execute()
+
 
 class Analytics(object):
     """
@@ -52,17 +109,37 @@ class Analytics(object):
     Search queries are simply the raw search data entered by users into the search bar.
 
     Events are emitted by the client when other notable actions happen. Presently there are many types of events, such as when the user switches from the On-Street to the Off-Street tab, or when the user logs in to a Car2Go account for use with Carshare capability. Events are stored as a predetermined `event` string.
+
+    Records submitted during requests are not written right away: they are collected in an in-process buffer and written in batches from a background thread, so that analytics never slow down the API. If the buffer fills up faster than it can be written, the oldest records are dropped. Geofence events are the exception: checkouts read them, so they are inserted right away.
     """
 
+    @staticmethod
+    def buffer():
+        """
+        Get the write-behind buffer for analytics records of this process.
+
+        :returns: WriteBehindBuffer (obj)
+        """
+        global _buffer
+        if _buffer is None:
+            with _buffer_lock:
+                if _buffer is None:
+                    _buffer = WriteBehindBuffer(_flush,
+                        maxlen=current_app.config['ANALYTICS_BUFFER_SIZE'],
+                        batch_size=current_app.config['ANALYTICS_BUFFER_BATCH'],
+                        interval=current_app.config['ANALYTICS_BUFFER_INTERVAL'])
+        return _buffer
+
     @staticmethod
     def add_search(user_id, query):
         """
-        Adds a search query to the analytics database.
+        Adds a search query to the processing buffer.
 
         :param user_id: user ID (int)
         :param query: query the user searched for (str)
         """
-        db.engine.execute(search_table.insert().values(user_id=user_id, query=query))
+        Analytics.buffer().add(('search', {"user_id": user_id, "query": query,
+            "created": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")}))
 
     @staticmethod
     def add_pos(stype, user_id, lat, lng, radius):
@@ -89,7 +166,7 @@ class Analytics(object):
         :param lng: longitude of the centerpoint (int)
         :param radius: radius of the map in meters while searching (int)
         """
-        db.redis.rpush('prkng:analytics:pos', json.dumps({"search_type": stype, "user_id": user_id,
+        Analytics.buffer().add(('pos', {"search_type": stype, "user_id": user_id,
             "created": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
             "lat": lat, "long": lng, "radius": radius}))
 
@@ -106,7 +183,8 @@ class Analytics(object):
     @staticmethod
     def add_event(user_id, lat, lng, event):
         """
-        Adds a user-generated event directly to the database.
+        Adds a user-generated event directly to the database, bypassing the buffer.
+        Used for geofence events, which must be available right away to compute checkout times.
 
         :param user_id: user ID (int)
         :param lat: latitude of the centerpoint (opt int)
@@ -125,6 +203,6 @@ class Analytics(object):
         :param lng: longitude of the centerpoint (opt int)
         :param event: identifier for the event that occurred (str)
         """
-        db.redis.rpush('prkng:analytics:event', json.dumps({"user_id": user_id, "lat": lat,
+        Analytics.buffer().add(('event', {"user_id": user_id, "lat": lat,
             "long": lng, "created": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
             "event": event}))
@@ -1,6 +1,7 @@
 import datetime
 
-from prkng.database import db, metadata
+from prkng import geoindex
+from prkng.database import db, mercator_distance, metadata, nearest
 
 from sqlalchemy import Boolean, Column, DateTime, Float, Integer, String, Table, text
 from sqlalchemy.dialects.postgresql import JSONB
@@ -98,10 +99,28 @@ class Carshares(object):
         """.format(company, name)).first()
         return {key: value for key, value in res.items()}
 
+    @staticmethod
+    def _from_index(res, company):
+        """
+        Filter carshares found in the live index (see prkng.geoindex) like the queries below do:
+        without a company, every parked vehicle; with zipcar among the companies, zipcars as one
+        vehicle per lot.
+
+        :param res: list of (member, properties) tuples
+        :param company: filter by carshare company name (str), or False to get all
+        :returns: list of Carshare objects (lists)
+        """
+        if not company:
+            return [x for m, x in res if m.startswith("c:")]
+        companies = company.split(",")
+        return [x for m, x in res if (m.startswith("c:") and x[3] != "zipcar" and x[3] in companies)
+            or (m.startswith("z:") and "zipcar" in companies)]
+
     @staticmethod
     def get_within(city, x, y, radius, company=False):
         """
         Get all parked carshares in a city within a particular radius.
+        Answered from the live index when there is one, closest first.
 
         :param city: city name that is being searched in (str)
         :param x: longitude (int)
@@ -110,6 +129,10 @@ class Carshares(object):
         :param company: filter by carshare company name (str), or False to get all
         :returns: list of Carshare objects (dicts)
         """
+        res = geoindex.search(db.redis, "carshares", city, x, y, radius)
+        if res is not None:
+            return Carshares._from_index(res, company)
+
         qry = """
             SELECT {properties}, 1 AS quantity FROM carshares c
             WHERE c.city = '{city}' AND c.parked = true AND
@@ -137,7 +160,7 @@ class Carshares(object):
                 AND c.company = 'zipcar'
             """
         res = db.engine.execute(qry.format(properties=', '.join(["c."+z for z in Carshares.properties]),
-            city=city, x=x, y=y, radius=radius)).fetchall()
+            city=city, x=x, y=y, radius=mercator_distance(radius, y))).fetchall()
         data = []
         for x in res:
             x = list(x)
@@ -151,6 +174,7 @@ class Carshares(object):
     def get_nearest(city, x, y, limit, company=False):
         """
         Get nearest parked carshares in a city to a certain lat/long.
+        Answered from the live index when there is one.
 
         :param city: city name that is being searched in (str)
         :param x: longitude (int)
@@ -159,32 +183,34 @@ class Carshares(object):
         :param company: filter by carshare company name (str), or False to get all
         :returns: list of Carshare objects (dicts)
         """
+        res = geoindex.search(db.redis, "carshares", city, x, y, geoindex.NEAREST_RADIUS)
+        if res is not None:
+            return Carshares._from_index(res, company)[:limit]
+
+        columns = ["c."+z for z in Carshares.properties]
+        companies = [z for z in company.split(",") if z != "zipcar"] if company else []
+        parts = []
+        if not company or companies:
+            where = "c.city = '{}' AND c.parked = true".format(city)
+            if companies:
+                where += " AND c.company = ANY(ARRAY[{}])".format(",".join(["'"+z+"'" for z in companies]))
+            parts.append(nearest("carshares c", columns + ["1 AS quantity"], x, y, limit, where=where,
+                max_distance=geoindex.NEAREST_RADIUS, key="c.id", geom="c.geom", distance=True))
+        if company and "zipcar" in company.split(","):
+            # one vehicle per lot, the lot capacity as quantity
+            parts.append(nearest("carshares c JOIN carshare_lots l ON c.lot_id = l.id",
+                columns + ["l.capacity AS quantity"], x, y, limit, where="""
+                    c.city = '{}' AND c.parked = true AND c.company = 'zipcar'
+                    AND c.id = (SELECT min(z.id) FROM carshares z WHERE z.lot_id = c.lot_id AND z.parked = true)
+                """.format(city), max_distance=geoindex.NEAREST_RADIUS, key="c.id", geom="c.geom",
+                distance=True))
         qry = """
-          WITH tmp AS (
-            (SELECT {properties}, 1 AS quantity FROM carshares c
-            WHERE c.city = '{city}' AND c.parked = true
-        """
-        if company and "," in company:
-            qry += "AND c.company = ANY(ARRAY[{}])".format(",".join(["'"+z+"'" for z in company.split(",") if z != "zipcar"]))
-        elif company and company != "zipcar":
-            qry += "AND c.company = '{}'".format(company)
-        qry += " ORDER BY ST_Distance(c.geom, st_transform('SRID=4326;POINT({x} {y})'::geometry, 3857)))"
-        if company and "zipcar" in company:
-            qry += """
-                UNION ALL
-                (SELECT DISTINCT ON (c.lot_id) {properties}, l.capacity AS quantity FROM carshares c
-                JOIN carshare_lots l ON c.lot_id = l.id
-                WHERE c.city = '{city}' AND c.parked = true
-                    AND c.company = 'zipcar'
-                ORDER BY c.lot_id, ST_Distance(c.geom, st_transform('SRID=4326;POINT({x} {y})'::geometry, 3857)))
-            """
-        qry += """
-            )
-            SELECT * FROM tmp
+            SELECT {properties}, quantity FROM ({parts}) u
+            ORDER BY knn_distance, id
             LIMIT {limit}
-        """
-        res = db.engine.execute(qry.format(properties=', '.join(["c."+z for z in Carshares.properties]),
-            city=city, x=x, y=y, limit=limit)).fetchall()
+        """.format(properties=", ".join(Carshares.properties),
+            parts=" UNION ALL ".join("(" + z + ")" for z in parts), limit=limit)
+        res = db.engine.execute(qry).fetchall()
         data = []
         for x in res:
             x = list(x)
@@ -253,6 +279,7 @@ class Carshares(object):
     def get_lots_within(city, x, y, radius, company=False):
         """
         Get all carshare lots in a city within a particular radius.
+        Answered from the live index when there is one, closest first.
 
         :param city: city name that is being searched in (str)
         :param x: longitude (int)
@@ -261,6 +288,10 @@ class Carshares(object):
         :param company: filter by carshare company name (str), or False to get all
         :returns: list of Carshare lot objects (dicts)
         """
+        res = geoindex.search(db.redis, "carshare_lots", city, x, y, radius)
+        if res is not None:
+            return [x for m, x in res if not company or x[2] in company.split(",")]
+
         qry = """
             SELECT {properties} FROM carshare_lots
             WHERE city = '{city}' AND
@@ -275,12 +306,13 @@ class Carshares(object):
         elif company:
             qry += "AND company = '{}'".format(company)
         return db.engine.execute(qry.format(properties=', '.join(Carshares.lot_properties),
-            city=city, x=x, y=y, radius=radius)).fetchall()
+            city=city, x=x, y=y, radius=mercator_distance(radius, y))).fetchall()
 
     @staticmethod
     def get_lots_nearest(city, x, y, limit, company=False):
         """
         Get nearest carshare lots in a city to a certain lat/long.
+        Answered from the live index when there is one.
 
         :param city: city name that is being searched in (str)
         :param x: longitude (int)
@@ -289,20 +321,15 @@ class Carshares(object):
         :param company: filter by carshare company name (str), or False to get all
         :returns: list of Carshare lot objects (dicts)
         """
-        qry = """
-            SELECT {properties} FROM carshare_lots
-            WHERE city = '{city}'
-        """
-        if company and "," in company:
-            qry += "AND company = ANY(ARRAY[{}])".format(",".join(["'"+z+"'" for z in company.split(",")]))
-        elif company:
-            qry += "AND company = '{}'".format(company)
-        qry += """
-            ORDER BY ST_Distance(geom, st_transform('SRID=4326;POINT({x} {y})'::geometry, 3857))
-            LIMIT {limit}
-        """
-        return db.engine.execute(qry.format(properties=', '.join(Carshares.lot_properties),
-            city=city, x=x, y=y, limit=limit)).fetchall()
+        res = geoindex.search(db.redis, "carshare_lots", city, x, y, geoindex.NEAREST_RADIUS)
+        if res is not None:
+            return [x for m, x in res if not company or x[2] in company.split(",")][:limit]
+
+        where = "city = '{}'".format(city)
+        if company:
+            where += " AND company = ANY(ARRAY[{}])".format(",".join(["'"+z+"'" for z in company.split(",")]))
+        return db.engine.execute(nearest("carshare_lots", Carshares.lot_properties, x, y, limit,
+            where=where, max_distance=geoindex.NEAREST_RADIUS)).fetchall()
 
     @staticmethod
     def get_all(company, city):
@@ -1,6 +1,6 @@
 from prkng.database import db, metadata
 from prkng.models.analytics import event_table
-from sqlalchemy import desc, Boolean, Column, DateTime, Float, ForeignKey, Integer, String, Table, text
+from sqlalchemy import desc, Boolean, Column, DateTime, Float, ForeignKey, Index, Integer, String, Table, text
 
 
 checkin_table = Table(
@@ -18,6 +18,13 @@ checkin_table = Table(
     Column('is_hidden', Boolean, default=False)
 )
 
+# partial index on the slots of current checkins, to find whom to notify of restrictions
+checkin_active_slot_index = Index(
+    'checkins_active_slot_idx',
+    checkin_table.c.slot_id,
+    postgresql_where=text('active = true AND checkout_time IS NULL')
+)
+
 class Checkins(object):
     """
     A class to manage user-generated Checkins.
@@ -125,10 +132,16 @@ class Checkins(object):
         :param left: True if the last fence departure should be used as checkout time (bool)
         :returns: True
         """
-        # get last fence departure time, use as checkout time if user has left
-        res = event_table.select((event_table.c.user_id == user_id) &\
-                (event_table.c.event == 'left_fence')).order_by(desc(event_table.c.created))\
-                .execute().first()
+        # get last fence departure time since checkin, use as checkout time if user has left
+        # (the time bound limits the search to the most recent monthly partitions of events)
+        res = None
+        checkin = checkin_table.select((checkin_table.c.user_id == user_id) &\
+                (checkin_table.c.id == checkin_id)).execute().first()
+        if checkin and left:
+            res = event_table.select((event_table.c.user_id == user_id) &\
+                    (event_table.c.event == 'left_fence') &\
+                    (event_table.c.created >= checkin["checkin_time"])).order_by(desc(event_table.c.created))\
+                    .execute().first()
 
         db.engine.execute(checkin_table.update().where((checkin_table.c.user_id == user_id) & \
             (checkin_table.c.id == checkin_id)).values(active=False,
@@ -1,6 +1,5 @@
 from prkng.database import db
-
-import aniso8601
+from prkng.utils import utc_timestamp
 
 
 class City(object):
@@ -125,8 +124,8 @@ class City(object):
             WHERE ct.name = '{}'
             {}
             """.format(city,
-                ((" AND (c.checkin_time AT TIME ZONE 'UTC') >= '{}'".format(aniso8601.parse_datetime(start).strftime("%Y-%m-%d %H:%M:%S"))) if start else "") +
-                ((" AND (c.checkin_time AT TIME ZONE 'UTC') <= '{}'".format(aniso8601.parse_datetime(end).strftime("%Y-%m-%d %H:%M:%S"))) if end else "")
+                ((" AND c.checkin_time >= '{}'".format(utc_timestamp(start))) if start else "") +
+                ((" AND c.checkin_time <= '{}'".format(utc_timestamp(end))) if end else "")
             )).fetchall()
 
         return [
@@ -1,8 +1,10 @@
 from prkng.database import db, metadata
 
 import datetime
-from sqlalchemy import Column, DateTime, Integer, String, Table, text
-from sqlalchemy.dialects.postgresql import ARRAY
+from flask import current_app
+from redis.exceptions import RedisError
+from sqlalchemy import Column, DateTime, Index, Integer, Table, text
+import time
 
 
 free_spaces_table = Table(
@@ -10,15 +12,30 @@ free_spaces_table = Table(
     metadata,
     Column('id', Integer, primary_key=True),
     Column('time', DateTime, server_default=text('NOW()')),
-    Column('address', String),
-    Column('slot_ids', ARRAY(Integer))
+    Column('slot_id', Integer, nullable=False)
 )
 
+# recent free spaces, and the sweep of expired ones, are found by time
+free_space_time_slot_index = Index(
+    'free_spaces_time_slot_idx',
+    free_spaces_table.c.time,
+    free_spaces_table.c.slot_id
+)
+
+# sorted set of the slots freed in the last FREE_SPACES_WINDOW seconds, scored by time (epoch),
+# usable while the key next to it (refreshed by each update) exists
+LIVE_KEY = 'prkng:frees'
+LIVE_UPDATED_KEY = 'prkng:frees:updated'
+
+
 class FreeSpaces(object):
     """
     An object to manage free space data.
 
     A 'free space' is created when a carshare has been recorded as leaving a slot on the street. It can be assumed that the departure of the carshare has created a free space to park on-street, which would be of use to users trying to park in that neighbourhood.
+
+    Free spaces are kept one row per slot for FREE_SPACES_TTL seconds, and the last
+    FREE_SPACES_WINDOW seconds of them are mirrored in Redis (see ``update_free_spaces``).
     """
 
     @staticmethod
@@ -30,6 +47,51 @@ class FreeSpaces(object):
         :param minutes: Max age of the carshare departure. Default 5 (int)
         :returns: Free Space object (dict)
         """
+        minutes = int(minutes)
+        if minutes * 60 <= current_app.config["FREE_SPACES_WINDOW"]:
+            live = FreeSpaces.get_live(db.redis, minutes)
+            if live is not None:
+                return FreeSpaces.with_slots(live)
+
+        res = db.engine.execute("""
+            SELECT DISTINCT ON (f.slot_id) f.slot_id, f.time
+            FROM free_spaces f
+            WHERE f.time >= (NOW() - INTERVAL '{} MIN')
+            ORDER BY f.slot_id, f.time DESC
+        """.format(minutes))
+        return FreeSpaces.with_slots({x[0]: x[1].strftime('%Y-%m-%dT%H:%M:%SZ') for x in res})
+
+    @staticmethod
+    def get_live(r, minutes):
+        """
+        Get the slots freed in the last minutes from the Redis mirror.
+
+        :param r: Redis connection
+        :param minutes: Max age of the carshare departure (int)
+        :returns: dict of slot ID: time of departure (str), or None if the mirror cannot be used
+        """
+        try:
+            pipe = r.pipeline(transaction=False)
+            pipe.exists(LIVE_UPDATED_KEY)
+            pipe.zrangebyscore(LIVE_KEY, time.time() - minutes * 60, '+inf', withscores=True)
+            exists, res = pipe.execute()
+        except RedisError:
+            return None
+        if not exists:
+            return None
+        return {int(x): datetime.datetime.utcfromtimestamp(y).strftime('%Y-%m-%dT%H:%M:%SZ')
+            for x, y in res}
+
+    @staticmethod
+    def with_slots(frees):
+        """
+        Add the details of the slots to free spaces.
+
+        :param frees: dict of slot ID: time of departure (str)
+        :returns: Free Space object (dict)
+        """
+        if not frees:
+            return []
         res = db.engine.execute("""
             SELECT
                 s.id,
@@ -37,13 +99,30 @@ class FreeSpaces(object):
                 s.geojson,
                 s.rules,
                 s.button_location->>'lat' AS lat,
-                s.button_location->>'long' AS long,
-                to_char(f.time, 'YYYY-MM-DD"T"HH24:MI:SS"Z"') AS since
+                s.button_location->>'long' AS long
             FROM slots s
-            JOIN free_spaces f ON f.time >= (NOW() - INTERVAL '{} MIN')
-                AND s.id = ANY(f.slot_ids)
-        """.format(minutes))
+            WHERE s.id IN ({})
+        """.format(",".join(str(int(x)) for x in frees)))
         return [
-            {key: value for key, value in row.items()}
+            dict({key: value for key, value in row.items()}, since=frees[row["id"]])
             for row in res
         ]
+
+    @staticmethod
+    def mirror(r, slot_ids, window, now=None):
+        """
+        Add newly freed slots to the Redis mirror and forget those older than the window.
+
+        :param r: Redis connection
+        :param slot_ids: list of slot IDs freed (int)
+        :param window: seconds of free spaces kept in the mirror (int)
+        :param now: time of departure (epoch), default now
+        """
+        now = now or time.time()
+        pipe = r.pipeline()
+        for i in range(0, len(slot_ids), 500):
+            pipe.zadd(LIVE_KEY, **{str(x): now for x in slot_ids[i:i + 500]})
+        pipe.zremrangebyscore(LIVE_KEY, '-inf', now - window)
+        pipe.expire(LIVE_KEY, window * 2)
+        pipe.set(LIVE_UPDATED_KEY, int(now), ex=window * 2)
+        pipe.execute()
@@ -1,4 +1,4 @@
-from prkng.database import db, metadata
+from prkng.database import db, metadata, nearest
 
 from sqlalchemy import Boolean, Column, Integer, String, Table
 from sqlalchemy.dialects.postgresql import JSONB
@@ -104,17 +104,7 @@ class ParkingLots(object):
         :param limit: number of nearest lots to return (int)
         :returns: list of Parking Lot objects (int)
         """
-        req = """
-        SELECT {properties} FROM parking_lots
-        WHERE active = true
-        ORDER BY ST_Distance(geom, st_transform('SRID=4326;POINT({x} {y})'::geometry, 3857))
-        LIMIT {limit}
-        """.format(
-            properties=','.join(ParkingLots.properties),
-            x=x,
-            y=y,
-            limit=limit
-        )
+        req = nearest("parking_lots", ParkingLots.properties, x, y, limit, where="active = true")
 
         return db.engine.execute(req).fetchall()
 
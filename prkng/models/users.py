@@ -1,3 +1,4 @@
+from prkng import passwords
 from prkng.database import db, metadata
 from prkng.utils import random_string
 
@@ -6,7 +7,6 @@ import datetime
 from flask import current_app
 from flask.ext.login import UserMixin
 from itsdangerous import JSONWebSignatureSerializer
-from passlib.hash import pbkdf2_sha256
 from sqlalchemy import Boolean, Column, DateTime, ForeignKey, func, Index, Integer, String, Table, text
 from sqlalchemy.dialects.postgresql import JSONB, ENUM
 import time
@@ -57,6 +57,12 @@ user_api_index = Index(
     func.substr(user_table.c.apikey, 0, 6)
 )
 
+# active users of the admin dashboard are counted by range scans on last_hello
+user_last_hello_index = Index(
+    'users_last_hello_idx',
+    user_table.c.last_hello
+)
+
 class User(UserMixin):
     """
     Subclassed UserMixin for the methods that Flask-Login expects user objects to have
@@ -318,7 +324,7 @@ class UserAuth(object):
         db.engine.execute(userauth_table.update().where(userauth_table.c.auth_id == auth_id).values(fullprofile={'birthyear': birthyear}))
 
     @staticmethod
-    def update_password(auth_id, password, reset_code=None):
+    def update_password(auth_id, password, reset_code=None, crypt_pass=None):
         """
         Update the password used for this authentication method.
         With a reset code (given during 'reset password' flow), will confirm that it is correct first.
@@ -326,16 +332,29 @@ class UserAuth(object):
         :param auth_id: auth ID (str)
         :param password: the new password to use (str)
         :param reset_code: the reset code to authorize with (str)
+        :param crypt_pass: the new password already hashed, instead of `password` (opt str)
         :returns: bool, True if the operation completed successfully, False if the reset code was incorrect
         """
         if reset_code:
             u = userauth_table.select(userauth_table.c.auth_id == auth_id).execute().first()
             if not u or reset_code != u["reset_code"]:
                 return False
-        crypt_pass = pbkdf2_sha256.encrypt(password, rounds=200, salt_size=16)
+        crypt_pass = crypt_pass or passwords.encrypt(password)
         db.engine.execute(userauth_table.update().where(userauth_table.c.auth_id == auth_id).values(password=crypt_pass, reset_code=None))
         return True
 
+    @staticmethod
+    def upgrade_password(auth_id, crypt_pass):
+        """
+        Replace the stored hash with one computed at the currently configured cost.
+        Unlike `update_password`, the given password is already hashed and any reset code is kept.
+
+        :param auth_id: auth ID (str)
+        :param crypt_pass: the new password hash (str)
+        :returns: None
+        """
+        db.engine.execute(userauth_table.update().where(userauth_table.c.auth_id == auth_id).values(password=crypt_pass))
+
     @staticmethod
     def add_userauth(user_id=None, name=None, auth_id=None, auth_type=None,
                      email=None, fullprofile=None, password=None):
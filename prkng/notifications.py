@@ -1,7 +1,56 @@
 from prkng.database import db
 from prkng.utils import random_string
 
+import boto.sns
+from boto.exception import BotoServerError
+import json
+from multiprocessing.pool import ThreadPool
 import redis
+import threading
+import time
+
+
+# Push queue: messages are kept in MESSAGES with the number of their chunks left in REFS, and
+# their devices are queued by chunks of CHUNK_SIZE. A worker moves a chunk to PROCESSING
+# (with the time in CLAIMS) while it sends it, and removes it once done (see ack).
+QUEUE = 'prkng:push:queue'
+PROCESSING = 'prkng:push:processing'
+CLAIMS = 'prkng:push:claims'
+MESSAGES = 'prkng:push:messages'
+REFS = 'prkng:push:refs'
+CHUNK_SIZE = 1000
+
+CLAIM_CHUNK = """
+local item = redis.call("rpoplpush", KEYS[1], KEYS[2])
+if item then
+    redis.call("zadd", KEYS[3], ARGV[1], item)
+end
+return item
+"""
+
+ACK_CHUNK = """
+if redis.call("lrem", KEYS[1], 1, ARGV[1]) == 0 then
+    return -1
+end
+redis.call("zrem", KEYS[2], ARGV[1])
+local left = redis.call("hincrby", KEYS[3], ARGV[2], -1)
+if left <= 0 then
+    redis.call("hdel", KEYS[3], ARGV[2])
+    redis.call("hdel", KEYS[4], ARGV[2])
+end
+return left
+"""
+
+REQUEUE_CHUNKS = """
+local items = redis.call("zrangebyscore", KEYS[1], "-inf", ARGV[1])
+for _, item in ipairs(items) do
+    if redis.call("lrem", KEYS[2], 1, item) > 0 then
+        redis.call("rpush", KEYS[3], item)
+    end
+    redis.call("zrem", KEYS[1], item)
+end
+return #items
+"""
 
 
 def schedule_notifications(device_ids, message):
@@ -12,8 +61,176 @@ def schedule_notifications(device_ids, message):
     :param message: message to send to said users (str/unicode)
     :returns: None
     """
+    if not device_ids:
+        return
     pid = random_string(16)
     if not db.redis:
         db.redis = redis.Redis(db=1)
-    db.redis.hset('prkng:push', pid, message)
-    db.redis.rpush('prkng:push:'+pid, *device_ids)
+    chunks = range(0, len(device_ids), CHUNK_SIZE)
+    pipe = db.redis.pipeline()
+    pipe.hset(MESSAGES, pid, message)
+    pipe.hset(REFS, pid, len(chunks))
+    for n, i in enumerate(chunks):
+        pipe.lpush(QUEUE, json.dumps({"pid": pid, "n": n, "devices": device_ids[i:i + CHUNK_SIZE]}))
+    pipe.execute()
+
+
+def claim(r):
+    """
+    Take the next chunk of devices to send a message to.
+
+    :param r: Redis connection
+    :returns: tuple (chunk to give to :func:`ack`, message id, message, list of device ids),
+        or None if the queue is empty
+    """
+    item = r.eval(CLAIM_CHUNK, 3, QUEUE, PROCESSING, CLAIMS, time.time())
+    if item is None:
+        return None
+    chunk = json.loads(item)
+    return item, chunk["pid"], r.hget(MESSAGES, chunk["pid"]), chunk["devices"]
+
+
+def ack(r, item, pid, stats):
+    """
+    Mark a chunk as sent and add up the delivery stats of its message, which are recorded
+    (see :func:`record_stats`) once all of its chunks are sent.
+
+    :param r: Redis connection
+    :param item: chunk returned by :func:`claim`
+    :param pid: message id (str)
+    :param stats: delivery stats of the chunk (dict of numbers)
+    """
+    pipe = r.pipeline()
+    for k, v in stats.items():
+        pipe.hincrbyfloat('prkng:push:stats:'+pid, k, v)
+    pipe.expire('prkng:push:stats:'+pid, 86400)
+    pipe.execute()
+    if r.eval(ACK_CHUNK, 4, PROCESSING, CLAIMS, REFS, MESSAGES, item, pid) == 0:
+        totals = r.hgetall('prkng:push:stats:'+pid)
+        r.delete('prkng:push:stats:'+pid)
+        record_stats(r, pid, {k: float(v) for k, v in totals.items()})
+
+
+def requeue(r, timeout):
+    """
+    Put back in the queue the chunks claimed for more than ``timeout`` seconds, by workers
+    that probably died. Their devices may get the message twice.
+
+    :param r: Redis connection
+    :param timeout: seconds (int)
+    :returns: number of chunks put back (int)
+    """
+    return r.eval(REQUEUE_CHUNKS, 3, CLAIMS, PROCESSING, QUEUE, time.time() - timeout)
+
+
+def sns_connection(CONFIG):
+    """
+    Open a connection to Amazon SNS, or to a local fake when SNS_STUB is set.
+
+    :param CONFIG: app configuration (dict)
+    :returns: boto SNSConnection (or prkng.stubs.FakeSNSConnection)
+    """
+    if CONFIG["SNS_STUB"]:
+        from prkng.stubs import FakeSNSConnection
+        return FakeSNSConnection()
+    return boto.sns.connect_to_region("us-west-2",
+        aws_access_key_id=CONFIG["AWS_ACCESS_KEY"],
+        aws_secret_access_key=CONFIG["AWS_SECRET_KEY"])
+
+
+class SNSPublisher(object):
+    """
+    Publish a message to many SNS targets (device endpoints or topics) concurrently.
+
+    Targets are split in chunks handed to a pool of threads, each with its own SNS connection
+    as boto connections must not be shared between threads. Throttled calls and server errors
+    are retried with an exponential backoff; other errors (e.g. a disabled endpoint) are not.
+    """
+    # error codes worth retrying besides 5xx
+    RETRY_CODES = ('Throttling', 'Throttled', 'ThrottledException', 'RequestLimitExceeded')
+    # error codes of endpoints that will never accept a message again
+    DISABLED_CODES = ('EndpointDisabled', 'NotFound')
+
+    def __init__(self, connect, workers=8, retries=3, backoff=0.5, chunk_size=100):
+        """
+        :param connect: function returning a new SNS connection
+        :param workers: number of threads publishing at once (int)
+        :param retries: max number of retries of a call (int)
+        :param backoff: seconds before the first retry, doubled after each one (float)
+        :param chunk_size: number of targets handed to a thread at once (int)
+        """
+        self.connect = connect
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.chunk_size = chunk_size
+        self.local = threading.local()
+        self.pool = None
+
+    def publish(self, targets, message, message_structure=None):
+        """
+        Publish a message to each target.
+
+        :param targets: list of SNS endpoint or topic ARNs (str)
+        :param message: message, or JSON message with a version per platform (str)
+        :param message_structure: "json" if the message is structured per platform (str)
+        :returns: delivery stats (dict)
+        """
+        started = time.time()
+        stats = {"targets": len(targets), "sent": 0, "failed": 0, "disabled": 0, "retries": 0}
+        if self.pool is None:
+            self.pool = ThreadPool(self.workers)
+        chunks = [targets[i:i + self.chunk_size] for i in range(0, len(targets), self.chunk_size)]
+        for res in self.pool.imap_unordered(
+                lambda chunk: self._publish_chunk(chunk, message, message_structure), chunks):
+            for k, v in res.items():
+                stats[k] += v
+        stats["duration"] = round(time.time() - started, 3)
+        return stats
+
+    def _publish_chunk(self, targets, message, message_structure):
+        if not hasattr(self.local, 'conn'):
+            self.local.conn = self.connect()
+        stats = {"sent": 0, "failed": 0, "disabled": 0, "retries": 0}
+        for arn in targets:
+            for attempt in range(self.retries + 1):
+                try:
+                    self.local.conn.publish(message=message, message_structure=message_structure,
+                        target_arn=arn)
+                    stats["sent"] += 1
+                    break
+                except BotoServerError as e:
+                    if e.error_code in self.DISABLED_CODES:
+                        stats["disabled"] += 1
+                        break
+                    if attempt == self.retries or not (e.status >= 500 or e.error_code in self.RETRY_CODES):
+                        stats["failed"] += 1
+                        break
+                except IOError:
+                    if attempt == self.retries:
+                        stats["failed"] += 1
+                        break
+                stats["retries"] += 1
+                time.sleep(self.backoff * 2 ** attempt)
+        return stats
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+
+def record_stats(r, pid, stats, length=100):
+    """
+    Keep the delivery stats of a message in the capped list ``prkng:push:stats``.
+
+    :param r: Redis connection
+    :param pid: message identifier (str)
+    :param stats: stats returned by :meth:`SNSPublisher.publish` (dict)
+    :param length: number of messages kept (int)
+    """
+    pipe = r.pipeline()
+    pipe.lpush('prkng:push:stats', json.dumps(dict(stats, pid=pid, sent_at=int(time.time()))))
+    pipe.ltrim('prkng:push:stats', 0, length - 1)
+    pipe.execute()
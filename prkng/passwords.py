@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+Password hashing and verification, run outside of the web worker.
+
+PBKDF2 is deliberately CPU-heavy. Instead of computing it inside the request
+thread, jobs are sent to a small process pool shared by the whole worker
+process. A bounded number of jobs may be pending at once; when the pool is
+saturated, callers wait at most ``PASSWORD_POOL_TIMEOUT`` seconds for a slot
+before giving up with :class:`PasswordPoolBusy`.
+
+Hashes created with a different cost than ``PASSWORD_ROUNDS`` are recomputed
+on the next successful verification, so that changing the setting upgrades
+stored passwords transparently.
+"""
+from __future__ import division
+
+import atexit
+import multiprocessing
+import os
+import Queue
+import threading
+import time
+
+from flask import current_app
+from passlib.hash import pbkdf2_sha256
+
+from logger import Logger
+
+
+SALT_SIZE = 16
+
+
+class PasswordPoolBusy(Exception):
+    """
+    Raised when no hashing slot became available in time.
+    """
+
+
+class _Pool(object):
+    """
+    Process pool with a bounded number of pending jobs.
+    """
+    def __init__(self, processes, max_pending):
+        self.pid = os.getpid()
+        self.processes = processes
+        self.pool = multiprocessing.Pool(processes=processes)
+        # a queue of tokens is used as a semaphore, since ours have no timeout in python 2
+        self.tokens = Queue.Queue(maxsize=max_pending)
+        for _ in range(max_pending):
+            self.tokens.put(None)
+
+    def run(self, func, args, timeout):
+        submitted = time.time()
+        try:
+            self.tokens.get(timeout=timeout)
+        except Queue.Empty:
+            _record('rejected')
+            raise PasswordPoolBusy("Password hashing pool is saturated")
+        # the token is given back when the job is over, even if we stop waiting for it,
+        # so that jobs left running in the pool still count as pending
+        job = self.pool.apply_async(_job, (func, args), callback=lambda res: self.tokens.put(None))
+        try:
+            started, ok, result = job.get(timeout)
+        except multiprocessing.TimeoutError:
+            _record('timeouts')
+            raise PasswordPoolBusy("Password hashing timed out")
+        if not ok:
+            raise result
+        _record('jobs', queue_time=started - submitted, run_time=time.time() - started)
+        return result
+
+    def close(self):
+        self.pool.terminate()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+_stats_lock = threading.Lock()
+_stats = {
+    'jobs': 0, 'upgraded': 0, 'rejected': 0, 'timeouts': 0,
+    'queue_time': 0.0, 'queue_time_max': 0.0, 'run_time': 0.0
+}
+
+
+def _record(counter, queue_time=None, run_time=None):
+    with _stats_lock:
+        _stats[counter] += 1
+        if queue_time is not None:
+            _stats['queue_time'] += queue_time
+            _stats['queue_time_max'] = max(_stats['queue_time_max'], queue_time)
+            _stats['run_time'] += run_time
+
+
+def _get_pool():
+    """
+    Return the process pool for the current process, creating it if needed.
+    The pool is recreated after a fork (uwsgi workers are forked from the master).
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.pid != os.getpid():
+            _pool = _Pool(current_app.config['PASSWORD_POOL_SIZE'],
+                current_app.config['PASSWORD_POOL_MAX_PENDING'])
+            Logger.debug("Password pool started with {} processes".format(_pool.processes))
+        return _pool
+
+
+@atexit.register
+def _close_pool():
+    if _pool is not None and _pool.pid == os.getpid():
+        _pool.close()
+
+
+def rounds_of(hashed):
+    """
+    Read the number of rounds a PBKDF2 hash was computed with.
+
+    :param hashed: hash as stored in the database (str)
+    :returns: number of rounds (int) or None if the hash is unreadable
+    """
+    try:
+        return int(hashed.split('$')[2])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+
+def _job(func, args):
+    # runs in a pool process; errors are returned, so that the job always calls back
+    started = time.time()
+    try:
+        return started, True, func(*args)
+    except Exception as e:
+        return started, False, e
+
+
+def _encrypt(password, rounds):
+    return pbkdf2_sha256.encrypt(password, rounds=rounds, salt_size=SALT_SIZE)
+
+
+def _verify(password, hashed, rounds):
+    if not pbkdf2_sha256.verify(password, hashed):
+        return False, None
+    if rounds_of(hashed) != rounds:
+        return True, pbkdf2_sha256.encrypt(password, rounds=rounds, salt_size=SALT_SIZE)
+    return True, None
+
+
+def encrypt(password):
+    """
+    Hash a password with the configured cost.
+
+    :param password: unhashed password (str)
+    :returns: PBKDF2 hash (str)
+    """
+    return _get_pool().run(_encrypt, (password, current_app.config['PASSWORD_ROUNDS']),
+        current_app.config['PASSWORD_POOL_TIMEOUT'])
+
+
+def verify(password, hashed):
+    """
+    Check a password against a stored hash.
+    If the hash was created with an outdated cost, a replacement is computed in the same job.
+
+    :param password: unhashed password (str)
+    :param hashed: stored PBKDF2 hash (str)
+    :returns: tuple (valid (bool), new hash to store (str) or None)
+    """
+    valid, new_hash = _get_pool().run(_verify,
+        (password, hashed, current_app.config['PASSWORD_ROUNDS']),
+        current_app.config['PASSWORD_POOL_TIMEOUT'])
+    if new_hash:
+        _record('upgraded')
+    return valid, new_hash
+
+
+def stats():
+    """
+    Return counters and timings for the current process' hashing pool.
+
+    :returns: dict
+    """
+    with _stats_lock:
+        res = dict(_stats)
+    jobs = res.pop('jobs')
+    res.update(jobs=jobs, pid=os.getpid(),
+        queue_time_avg=(res.pop('queue_time') / jobs) if jobs else 0.0,
+        run_time_avg=(res.pop('run_time') / jobs) if jobs else 0.0)
+    return res
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+Shared HTTP sessions for outbound calls to partner APIs.
+
+A ``requests.Session`` keeps connections alive between calls, so that the TLS
+handshake is paid once per process instead of once per request. Sessions are
+kept per name and per process (they must not be shared across a fork).
+"""
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+
+_sessions = {}
+_lock = threading.Lock()
+
+
+def get_session(name, pool_size=10, retries=0, backoff=0.0, methods=None):
+    """
+    Return the keep-alive session registered under ``name``, creating it if needed.
+
+    :param name: session identifier, usually the partner name (str)
+    :param pool_size: max number of connections kept per host (int)
+    :param retries: number of retries on connection errors and 5xx responses (int)
+    :param backoff: backoff factor between retries, in seconds (float)
+    :param methods: HTTP methods that can be retried, default idempotent ones (list)
+    :returns: requests.Session
+    """
+    key = (os.getpid(), name)
+    with _lock:
+        if key not in _sessions:
+            retry = Retry(total=retries, backoff_factor=backoff,
+                status_forcelist=[500, 502, 503, 504],
+                method_whitelist=methods or Retry.DEFAULT_METHOD_WHITELIST)
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                max_retries=retry)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _sessions[key] = session
+        return _sessions[key]
+
@@ -38,6 +38,98 @@ class Defaults(object):
         }
     }
 
+    # password hashing: PBKDF2 cost and off-worker process pool
+    PASSWORD_ROUNDS = 200
+    PASSWORD_POOL_SIZE = 1
+    PASSWORD_POOL_MAX_PENDING = 4
+    PASSWORD_POOL_TIMEOUT = 5
+
+    # OAuth token validation: (connect, read) timeouts in seconds, keep-alive
+    # connections per provider host, and how long a validated token is cached
+    OAUTH_TIMEOUT = (3.05, 5)
+    OAUTH_POOL_SIZE = 4
+    OAUTH_CACHE_TTL = 120
+    # answer provider calls locally (see prkng.stubs.OAuthStub)
+    OAUTH_STUB = False
+
+    # analytics write-behind buffer: max records held per process, records
+    # written per batch, and max seconds before a record is written
+    ANALYTICS_BUFFER_SIZE = 10000
+    ANALYTICS_BUFFER_BATCH = 500
+    ANALYTICS_BUFFER_INTERVAL = 1.0
+    # number of queued analytics records read from Redis at once by update_analytics
+    ANALYTICS_DRAIN_CHUNK = 5000
+    # size in meters of the grid cells used to aggregate map usage for the admin heatmap
+    HEATMAP_BIN_SIZE = 250
+
+    # carshare partner polling: (connect, read) timeouts in seconds per provider,
+    # retries with exponential backoff on connection errors and 5xx responses,
+    # and max number of provider/city fetches running at once
+    CARSHARE_TIMEOUTS = {
+        'car2go': (3.05, 10),
+        'auto-mobile': (3.05, 20),
+        'communauto': (3.05, 20),
+        'zipcar': (3.05, 60)
+    }
+    CARSHARE_RETRIES = 2
+    CARSHARE_BACKOFF = 0.5
+    CARSHARE_WORKERS = 6
+    # max seconds before partner records are written again even if unchanged, and
+    # before cached partner API responses (for conditional requests) are forgotten
+    FINGERPRINT_TTL = 1800
+    # seconds before the Redis index of carshares (see prkng.geoindex) expires if
+    # the ingestion tasks stop rebuilding it; searches then go to the database
+    GEOINDEX_TTL = 600
+    # seconds free spaces left by carshares are kept in the database, and in the
+    # Redis mirror read by recent searches (see prkng.models.FreeSpaces)
+    FREE_SPACES_TTL = 86400
+    FREE_SPACES_WINDOW = 300
+
+    # real-time changes stream (/v1/live): max seconds a client stays connected
+    # before reconnecting, and seconds between keep-alive comments
+    LIVE_STREAM_DURATION = 300
+    LIVE_HEARTBEAT = 15
+
+    # months of analytics and checkins kept in the database, older monthly
+    # partitions are exported to ARCHIVE_DIRECTORY then dropped (None: keep all).
+    # ARCHIVE_DIRECTORY must be on persistent storage (not tmpfs or /tmp), otherwise
+    # partitions are never dropped
+    PARTITION_RETENTION = {
+        'analytics_pos': None,
+        'analytics_event': None,
+        'analytics_search': None,
+        'checkins': None
+    }
+    ARCHIVE_DIRECTORY = None
+
+    # Info-Neige (Montreal snow removal) SOAP service: the WSDL is cached locally
+    # for PLANIFNEIGE_CACHE_DAYS, planifications are written by batches, each statement
+    # of a batch being cancelled after PLANIFNEIGE_WRITE_TIMEOUT seconds
+    PLANIFNEIGE_WSDL = 'https://servicesenligne2.ville.montreal.qc.ca/api/infoneige/InfoneigeWebService?WSDL'
+    PLANIFNEIGE_CACHE_DAYS = 7
+    PLANIFNEIGE_BATCH = 500
+    PLANIFNEIGE_WRITE_TIMEOUT = 30
+
+    # push notifications: threads publishing to SNS at once, retries (with a backoff
+    # doubling from SNS_BACKOFF seconds) and number of devices handed to a thread at once
+    SNS_WORKERS = 8
+    SNS_RETRIES = 3
+    SNS_BACKOFF = 0.5
+    SNS_CHUNK = 100
+    # push queue: tasks sending queued messages at once, and seconds after which
+    # devices claimed by a task that did not finish are queued again
+    PUSH_CONSUMERS = 2
+    PUSH_VISIBILITY = 900
+    # record calls locally instead of calling SNS (see prkng.stubs.FakeSNSConnection)
+    SNS_STUB = False
+
+    # database backups (see prkng.backup): bucket, size of the uploaded parts (at least
+    # 5 MB), parts uploaded at once and compression threads (None: one per core)
+    BACKUP_BUCKET = 'prkng-bak'
+    BACKUP_PART_SIZE = 64 * 1024 * 1024
+    BACKUP_UPLOADS = 4
+    BACKUP_THREADS = None
+
     # usefull to catch exceptions in uwsgi
     PROPAGATE_EXCEPTIONS = True
     # web admin view
@@ -47,3 +139,5 @@ class Defaults(object):
 
 class Testing(Defaults):
     TESTING = True
+    OAUTH_STUB = True
+    SNS_STUB = True
@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-ins for the external services we depend on.
+They allow running the tests and a development server without network access.
+"""
+import BaseHTTPServer
+import json
+import threading
+import urlparse
+from xml.sax.saxutils import escape
+
+from boto.exception import BotoServerError
+from requests.adapters import BaseAdapter
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+
+from prkng.utils import random_string
+
+
+class OAuthStub(BaseAdapter):
+    """
+    Transport adapter answering the Facebook and Google token validation endpoints.
+
+    Known access tokens are registered with a profile; any other token is rejected
+    like the providers do. It is used instead of the real providers when the
+    ``OAUTH_STUB`` setting is enabled.
+    """
+    def __init__(self, credentials, profiles=None):
+        """
+        :param credentials: OAUTH_CREDENTIALS setting (dict)
+        :param profiles: dict of access token -> (provider, profile dict)
+        """
+        super(OAuthStub, self).__init__()
+        self.credentials = credentials
+        self.profiles = profiles or {
+            'facebook-test-token': ('facebook', {
+                'id': '10001', 'email': 'facebook@prk.ng', 'name': 'Facebook User',
+                'first_name': 'Facebook', 'last_name': 'User', 'gender': 'female'}),
+            'google-test-token': ('google', {
+                'id': '20001', 'email': 'google@prk.ng', 'name': 'Google User',
+                'given_name': 'Google', 'family_name': 'User'}),
+            'eyJhgoogle-test-token': ('google', {
+                'id': '20002', 'email': 'google-signin@prk.ng', 'name': 'Google Signin',
+                'given_name': 'Google', 'family_name': 'Signin'})
+        }
+        self.calls = 0
+
+    def send(self, request, **kwargs):
+        self.calls += 1
+        url = urlparse.urlparse(request.url)
+        params = dict(urlparse.parse_qsl(url.query))
+        provider, profile = self.profiles.get(
+            params.get('access_token') or params.get('id_token'), (None, None))
+        endpoint = url.netloc + url.path
+
+        if endpoint == 'graph.facebook.com/app/' and provider == 'facebook':
+            return self._response(request, 200, {'id': self.credentials['facebook']['id']})
+        elif endpoint == 'graph.facebook.com/me' and provider == 'facebook':
+            return self._response(request, 200, profile)
+        elif endpoint == 'www.googleapis.com/oauth2/v3/tokeninfo' and provider == 'google':
+            return self._response(request, 200, dict(
+                aud=self.credentials['google'].get('ios_id'), sub=profile['id'],
+                **{k: v for k, v in profile.items() if k != 'id'}))
+        elif endpoint == 'www.googleapis.com/oauth2/v1/tokeninfo' and provider == 'google':
+            return self._response(request, 200, {'audience': self.credentials['google']['id']})
+        elif endpoint == 'www.googleapis.com/oauth2/v1/userinfo' and provider == 'google':
+            return self._response(request, 200, profile)
+        return self._response(request, 400, {'error': {'message': 'Invalid OAuth access token.'}})
+
+    def _response(self, request, status, data):
+        resp = Response()
+        resp.status_code = status
+        resp.headers = CaseInsensitiveDict({'Content-Type': 'application/json'})
+        resp._content = json.dumps(data)
+        resp.encoding = 'utf-8'
+        resp.url = request.url
+        resp.request = request
+        return resp
+
+    def close(self):
+        pass
+
+
+class InfoNeigeStub(object):
+    """
+    Local HTTP server answering like the Info-Neige (Montreal snow removal) SOAP service,
+    with its WSDL and the planifications it was given::
+
+        stub = InfoNeigeStub([{'coteRueId': 10, 'etatDeneig': 2,
+            'dateDebutPlanif': '2015-12-09T07:00:00', 'dateFinPlanif': '2015-12-09T19:00:00'}]).start()
+        CONFIG['PLANIFNEIGE_WSDL'] = stub.url + '?WSDL'
+        ...
+        stub.stop()
+    """
+    namespace = 'https://servicesenligne2.ville.montreal.qc.ca/api/infoneige/'
+    fields = ('munid', 'coteRueId', 'etatDeneig', 'dateDebutPlanif', 'dateFinPlanif',
+        'dateDebutReplanif', 'dateFinReplanif', 'dateMaj')
+
+    def __init__(self, planifications=(), status=0, desc='OK'):
+        """
+        :param planifications: list of dicts (field name -> value), missing fields are left out
+        :param status: responseStatus to answer with (0: ok, 8: no new data, others: errors)
+        :param desc: responseDesc to answer with (str)
+        """
+        self.planifications = list(planifications)
+        self.status = status
+        self.desc = desc
+        self.requests = []
+        self.server = self.url = None
+
+    def start(self):
+        stub = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                self._send(stub.wsdl())
+
+            def do_POST(self):
+                stub.requests.append(self.rfile.read(int(self.headers['Content-Length'])))
+                self._send(stub.response())
+
+            def _send(self, body):
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/xml; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}/infoneige'.format(self.server.server_port)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def response(self):
+        planifs = ''.join('<planification>{}</planification>'.format(''.join(
+            '<{0}>{1}</{0}>'.format(f, escape(unicode(x[f]).encode('utf-8')))
+            for f in self.fields if x.get(f) is not None)) for x in self.planifications)
+        return (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<S:Envelope xmlns:S="http://schemas.xmlsoap.org/soap/envelope/"><S:Body>'
+            '<ns2:GetPlanificationsForDateResponse xmlns:ns2="{ns}"><planificationResponse>'
+            '<responseStatus>{status}</responseStatus><responseDesc>{desc}</responseDesc>'
+            '<planifications>{planifs}</planifications>'
+            '</planificationResponse></ns2:GetPlanificationsForDateResponse>'
+            '</S:Body></S:Envelope>'
+        ).format(ns=self.namespace, status=self.status, desc=escape(self.desc), planifs=planifs)
+
+    def wsdl(self):
+        return """<?xml version="1.0" encoding="UTF-8"?>
+<definitions xmlns="http://schemas.xmlsoap.org/wsdl/" xmlns:soap="http://schemas.xmlsoap.org/wsdl/soap/"
+    xmlns:xs="http://www.w3.org/2001/XMLSchema" xmlns:tns="{ns}" targetNamespace="{ns}"
+    name="InfoneigeWebService">
+  <types>
+    <xs:schema targetNamespace="{ns}">
+      <xs:element name="GetPlanificationsForDate">
+        <xs:complexType><xs:sequence>
+          <xs:element name="getPlanificationsForDate" type="tns:getPlanificationsForDate"/>
+        </xs:sequence></xs:complexType>
+      </xs:element>
+      <xs:element name="GetPlanificationsForDateResponse">
+        <xs:complexType><xs:sequence>
+          <xs:element name="planificationResponse" type="tns:planificationResponse"/>
+        </xs:sequence></xs:complexType>
+      </xs:element>
+      <xs:complexType name="getPlanificationsForDate">
+        <xs:sequence>
+          <xs:element name="fromDate" type="xs:string"/>
+          <xs:element name="tokenString" type="xs:string"/>
+        </xs:sequence>
+      </xs:complexType>
+      <xs:complexType name="planificationResponse">
+        <xs:sequence>
+          <xs:element name="responseStatus" type="xs:int"/>
+          <xs:element name="responseDesc" type="xs:string" minOccurs="0"/>
+          <xs:element name="planifications" minOccurs="0">
+            <xs:complexType><xs:sequence>
+              <xs:element name="planification" type="tns:planification" minOccurs="0" maxOccurs="unbounded"/>
+            </xs:sequence></xs:complexType>
+          </xs:element>
+        </xs:sequence>
+      </xs:complexType>
+      <xs:complexType name="planification">
+        <xs:sequence>
+          <xs:element name="munid" type="xs:int" minOccurs="0"/>
+          <xs:element name="coteRueId" type="xs:long"/>
+          <xs:element name="etatDeneig" type="xs:int"/>
+          <xs:element name="dateDebutPlanif" type="xs:dateTime" minOccurs="0"/>
+          <xs:element name="dateFinPlanif" type="xs:dateTime" minOccurs="0"/>
+          <xs:element name="dateDebutReplanif" type="xs:dateTime" minOccurs="0"/>
+          <xs:element name="dateFinReplanif" type="xs:dateTime" minOccurs="0"/>
+          <xs:element name="dateMaj" type="xs:dateTime" minOccurs="0"/>
+        </xs:sequence>
+      </xs:complexType>
+    </xs:schema>
+  </types>
+  <message name="GetPlanificationsForDate">
+    <part name="parameters" element="tns:GetPlanificationsForDate"/>
+  </message>
+  <message name="GetPlanificationsForDateResponse">
+    <part name="parameters" element="tns:GetPlanificationsForDateResponse"/>
+  </message>
+  <portType name="InfoneigeWebService">
+    <operation name="GetPlanificationsForDate">
+      <input message="tns:GetPlanificationsForDate"/>
+      <output message="tns:GetPlanificationsForDateResponse"/>
+    </operation>
+  </portType>
+  <binding name="InfoneigeWebServiceBinding" type="tns:InfoneigeWebService">
+    <soap:binding style="document" transport="http://schemas.xmlsoap.org/soap/http"/>
+    <operation name="GetPlanificationsForDate">
+      <soap:operation soapAction=""/>
+      <input><soap:body use="literal"/></input>
+      <output><soap:body use="literal"/></output>
+    </operation>
+  </binding>
+  <service name="InfoneigeWebService">
+    <port name="InfoneigeWebServicePort" binding="tns:InfoneigeWebServiceBinding">
+      <soap:address location="{url}"/>
+    </port>
+  </service>
+</definitions>
+""".format(ns=self.namespace, url=self.url)
+
+
+class FakeSNSConnection(object):
+    """
+    Stand-in for a boto SNS connection, used when the ``SNS_STUB`` setting is enabled.
+
+    Calls are recorded in ``published``, ``endpoints`` and ``subscriptions`` (shared by all
+    instances, as the publisher opens one connection per thread). Failures can be set up per
+    target ARN in ``errors``, as a list of (status, error code) raised by the next calls.
+    """
+    lock = threading.Lock()
+    published, endpoints, subscriptions, errors = [], {}, [], {}
+
+    @classmethod
+    def reset(cls):
+        with cls.lock:
+            del cls.published[:], cls.subscriptions[:]
+            cls.endpoints.clear()
+            cls.errors.clear()
+
+    def _fail(self, arn):
+        with self.lock:
+            if self.errors.get(arn):
+                status, code = self.errors[arn].pop(0)
+                raise BotoServerError(status, code,
+                    body={'Error': {'Code': code, 'Message': code}})
+
+    def publish(self, topic=None, message=None, subject=None, target_arn=None,
+                message_structure=None, message_attributes=None):
+        self._fail(target_arn or topic)
+        with self.lock:
+            self.published.append((target_arn or topic, message))
+        return {'PublishResponse': {'PublishResult': {'MessageId': random_string(36)}}}
+
+    def create_platform_endpoint(self, platform_application_arn, token, custom_user_data=None,
+                                 attributes=None):
+        self._fail(token)
+        with self.lock:
+            arn = self.endpoints.setdefault(token, '{}/{}'.format(
+                platform_application_arn.replace(':app/', ':endpoint/'), random_string(36)))
+        return {'CreatePlatformEndpointResponse': {'CreatePlatformEndpointResult': {'EndpointArn': arn}}}
+
+    def subscribe(self, topic, protocol, endpoint):
+        self._fail(endpoint)
+        with self.lock:
+            self.subscriptions.append((topic, protocol, endpoint))
+        return {'SubscribeResponse': {'SubscribeResult': {'SubscriptionArn': topic + ':' + random_string(36)}}}
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 import datetime
+import random
 
 from redis import Redis
 from rq_scheduler import Scheduler
@@ -13,27 +14,41 @@ from general import *
 scheduler = Scheduler('scheduled_jobs', connection=Redis(db=1))
 
 
+def schedule(func, now, result_ttl=None):
+    """
+    Schedule a task decorated with ``scheduling.scheduled`` at its interval. Tasks start
+    at a random offset within the first 10% of their interval so that they don't all
+    run at the same time.
+    """
+    start = now + datetime.timedelta(seconds=random.uniform(0, func.interval / 10))
+    scheduler.schedule(scheduled_time=start, func=func, interval=func.interval,
+        result_ttl=result_ttl, timeout=func.timeout, repeat=None)
+
+
 def init_tasks(debug=True):
     now = datetime.datetime.now()
     stop_tasks()
 
     # Every 2 min
-    scheduler.schedule(scheduled_time=now, func=update_lots, interval=120, repeat=None)
-    scheduler.schedule(scheduled_time=now, func=update_carshares, interval=120, repeat=None)
-    scheduler.schedule(scheduled_time=now, func=update_analytics, interval=120, result_ttl=240, repeat=None)
+    schedule(update_lots, now)
+    schedule(update_carshares, now)
+    schedule(update_analytics, now, result_ttl=240)
 
     # Every 5 min
-    scheduler.schedule(scheduled_time=now, func=update_free_spaces, interval=300, result_ttl=600, repeat=None)
-    scheduler.schedule(scheduled_time=now, func=process_notifications, interval=300, repeat=None)
-    scheduler.schedule(scheduled_time=now, func=deneigement_notifications, interval=300, repeat=None)
+    schedule(update_free_spaces, now, result_ttl=600)
+    schedule(process_notifications, now)
+    schedule(deneigement_notifications, now)
+    schedule(update_analytics_rollups, now, result_ttl=600)
+    schedule(update_heatmap, now, result_ttl=600)
 
     # Every 30 min
-    scheduler.schedule(scheduled_time=now, func=update_deneigement, interval=1800, result_ttl=3600, repeat=None)
+    schedule(update_deneigement, now, result_ttl=3600)
 
     # Every day
     if not debug:
-        scheduler.schedule(scheduled_time=now, func=run_backup, interval=86400, result_ttl=172800, repeat=None)
-    scheduler.schedule(scheduled_time=now, func=update_zipcar, interval=86400, result_ttl=172800, repeat=None)
+        schedule(run_backup, now, result_ttl=172800)
+    schedule(update_zipcar, now, result_ttl=172800)
+    schedule(update_partitions, now, result_ttl=172800)
 
 
 def stop_tasks():
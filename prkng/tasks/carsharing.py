@@ -1,275 +1,436 @@
 # -*- coding: utf-8 -*-
 
-from prkng import create_app, notifications
-from prkng.database import PostgresWrapper
+from prkng import geoindex, notifications
+from prkng.ingest import Fingerprints, Ingestion, point, returning
+from prkng.logger import Logger
+from prkng.models import FreeSpaces
+from prkng.sessions import get_session
+from prkng.tasks.scheduling import scheduled
+from prkng.tasks.worker import get_config, get_db, get_redis
 
 import datetime
 import demjson
+import hashlib
+import json
+from multiprocessing.pool import ThreadPool
 import pytz
-from redis import Redis
-import requests
-from rq import Queue
+import time
 
 
+CAR2GO_CITIES = {"montreal": "montreal", "newyork": "newyorkcity", "seattle": "seattle"}
+COMMUNAUTO_CITIES = {"montreal": 59, "quebec": 90}
+
+# changes published to clients (see prkng.live), for statements on carshares (c) and carshare_lots (l)
+CAR_EVENT = returning("carshare", "c", ["company", "slot_id", "lot_id"])
+NEW_CAR_EVENT = returning("carshare", None, ["company", "slot_id", "lot_id"])
+LOT_EVENT = returning("carshare_lot", "l", ["company", "capacity", "available"])
+NEW_LOT_EVENT = returning("carshare_lot", None, ["company", "capacity", "available"])
+
+
+@scheduled(120)
 def update_carshares():
-    q = Queue('high', connection=Redis(db=1))
-    q.enqueue(update_car2go)
-    q.enqueue(update_automobile)
-    q.enqueue(update_communauto)
+    """
+    Task to update car2go, Auto-mobile and Communauto vehicles from all cities at once
+    """
+    CONFIG = get_config()
+    run_providers(CONFIG, [("car2go", x) for x in sorted(CAR2GO_CITIES)] + [("auto-mobile", None)] +
+        [("communauto", x) for x in sorted(COMMUNAUTO_CITIES)])
+
+
+def run_providers(CONFIG, jobs):
+    """
+    Fetch data for each provider and city concurrently, and write every payload
+    to the database as soon as it arrives. Writes are done one at a time from the calling thread,
+    and skip what did not change since the previous run (see prkng.ingest.Fingerprints).
+
+    :param CONFIG: app configuration (dict)
+    :param jobs: list of tuples (provider name, city name or None)
+    """
+    db = get_db(CONFIG)
+    r = get_redis()
+    fingerprints = lambda name: Fingerprints(r, name, CONFIG["FINGERPRINT_TTL"])
+
+    def fetch(job):
+        provider, city = job
+        started = time.time()
+        try:
+            payload = PROVIDERS[provider][0](CONFIG, city)
+        except Exception:
+            Logger.exception("Fetching {} data for {} failed".format(provider, city or "all cities"))
+            return job, None, False, time.time() - started
+        return job, payload, True, time.time() - started
+
+    started, failed = time.time(), []
+    pool = ThreadPool(min(len(jobs), CONFIG["CARSHARE_WORKERS"]))
+    try:
+        for (provider, city), payload, ok, elapsed in pool.imap_unordered(fetch, jobs):
+            if not ok:
+                failed.append((provider, city))
+                continue
+            if payload is None:
+                Logger.warning("No usable {} data for {}".format(provider, city or "all cities"))
+                continue
+            written = time.time()
+            try:
+                PROVIDERS[provider][1](db, fingerprints, city, payload)
+            except Exception:
+                Logger.exception("Writing {} data for {} failed".format(provider, city or "all cities"))
+                failed.append((provider, city))
+                continue
+            Logger.info("{} {}: fetched in {:.2f}s, written in {:.2f}s".format(provider,
+                city or "all cities", elapsed, time.time() - written))
+    finally:
+        pool.close()
+        pool.join()
+    rebuild_index(CONFIG, db, r)
+    Logger.info("Carshares updated in {:.2f}s".format(time.time() - started))
+    if failed:
+        raise RuntimeError("Carshare update failed for {}".format(
+            ", ".join("{} ({})".format(p, c or "all cities") for p, c in failed)))
+
+
+def rebuild_index(CONFIG, db, r):
+    """
+    Copy the parked carshares and carshare lots of every city to the Redis index
+    the API searches (see prkng.geoindex). An index that cannot be rebuilt expires,
+    and the API goes back to the database.
+    """
+    started = time.time()
+    cities = db.query("SELECT city FROM carshares UNION SELECT city FROM carshare_lots")
+    for city, in cities:
+        try:
+            geoindex.rebuild(db, r, city, CONFIG["GEOINDEX_TTL"])
+        except Exception:
+            Logger.exception("Rebuilding the carshare index of {} failed".format(city))
+    Logger.info("Carshare index of {} cities rebuilt in {:.2f}s".format(len(cities), time.time() - started))
+
+
+def _fetch(CONFIG, provider, url, method="get", conditional=False, **kwargs):
+    """
+    Call a partner API through the provider's keep-alive session, with its timeouts and retry policy.
+
+    With ``conditional``, the response is kept in Redis along with its ETag / Last-Modified
+    headers, and the next call asks the partner to answer 304 Not Modified if nothing changed.
+
+    :returns: response body (unicode)
+    """
+    # the communauto availability call is a POST but it is read-only, so it is safe to retry
+    session = get_session("carshare:" + provider, pool_size=len(CAR2GO_CITIES) * 2,
+        retries=CONFIG["CARSHARE_RETRIES"], backoff=CONFIG["CARSHARE_BACKOFF"], methods=["GET", "POST"])
+    if conditional:
+        r = get_redis()
+        key = "prkng:http:{}:{}".format(provider,
+            hashlib.sha1(url + json.dumps(kwargs.get("params"), sort_keys=True)).hexdigest())
+        cached = r.hgetall(key)
+        if cached.get("body"):
+            kwargs["headers"] = {k: v for k, v in [("If-None-Match", cached.get("etag")),
+                ("If-Modified-Since", cached.get("modified"))] if v}
+
+    raw = getattr(session, method)(url, timeout=CONFIG["CARSHARE_TIMEOUTS"][provider], **kwargs)
+    if conditional and raw.status_code == 304 and cached.get("body"):
+        return cached["body"].decode("utf-8")
+    raw.raise_for_status()
+
+    if conditional and (raw.headers.get("ETag") or raw.headers.get("Last-Modified")):
+        pipe = r.pipeline()
+        pipe.delete(key)
+        pipe.hmset(key, {k: v for k, v in [("etag", raw.headers.get("ETag")),
+            ("modified", raw.headers.get("Last-Modified")), ("body", raw.text.encode("utf-8"))] if v})
+        pipe.expire(key, CONFIG["FINGERPRINT_TTL"])
+        pipe.execute()
+    return raw.text
 
 
 def update_car2go():
     """
     Task to check with the car2go API, find moved cars and update their positions/slots
     """
-    CONFIG = create_app().config
-    db = PostgresWrapper(
-        "host='{PG_HOST}' port={PG_PORT} dbname={PG_DATABASE} "
-        "user={PG_USERNAME} password={PG_PASSWORD} ".format(**CONFIG))
-
-    for city in ["montreal", "newyork", "seattle"]:
-        # grab data from car2go api
-        c2city = city
-        if c2city == "newyork":
-            c2city = "newyorkcity"
-        raw = requests.get("https://www.car2go.com/api/v2.1/vehicles",
-            params={"loc": c2city, "format": "json", "oauth_consumer_key": CONFIG["CAR2GO_CONSUMER"]})
-        data = raw.json()["placemarks"]
-
-        raw = requests.get("https://www.car2go.com/api/v2.1/parkingspots",
-            params={"loc": c2city, "format": "json", "oauth_consumer_key": CONFIG["CAR2GO_CONSUMER"]})
-        lot_data = raw.json()["placemarks"]
+    run_providers(get_config(), [("car2go", x) for x in sorted(CAR2GO_CITIES)])
+
+
+def fetch_car2go(CONFIG, city):
+    """
+    Grab vehicles and parking lots from the car2go API.
+
+    :returns: tuple (vehicles (list), parking lots (list))
+    """
+    params = {"loc": CAR2GO_CITIES[city], "format": "json", "oauth_consumer_key": CONFIG["CAR2GO_CONSUMER"]}
+    data = _fetch(CONFIG, "car2go", "https://www.car2go.com/api/v2.1/vehicles",
+        conditional=True, params=params)
+    lot_data = _fetch(CONFIG, "car2go", "https://www.car2go.com/api/v2.1/parkingspots",
+        conditional=True, params=params)
+    return json.loads(data)["placemarks"], json.loads(lot_data)["placemarks"]
+
+
+def write_car2go(db, fingerprints, city, payload):
+    """
+    Update car2go parking lots and vehicles for a city.
+    """
+    data, lot_data = payload
+
+    fp = fingerprints("car2go:" + city)
+    if fp.unchanged([("lot", x) for x in lot_data] + [("car", x) for x in data],
+            key=lambda x: u"{}:{}".format(x[0], x[1]["name"] if x[0] == "lot" else x[1]["vin"])):
+        return
 
+    with Ingestion(db, "car2go " + city, r=fp.r) as run:
         # create or update car2go parking lots
-        values = ["('{}','{}',{},{})".format(city, x["name"].replace("'", "''").encode("utf-8"),
-            x["totalCapacity"], (x["totalCapacity"] - x["usedCapacity"])) for x in lot_data]
-        if values:
-            db.query("""
-                UPDATE carshare_lots l SET capacity = d.capacity, available = d.available
-                FROM (VALUES {}) AS d(city, name, capacity, available)
-                WHERE l.company = 'car2go' AND l.city = d.city AND l.name = d.name
-                    AND l.available != d.available
-            """.format(",".join(values)))
-
-        values = ["('{}','{}',{},{},'SRID=4326;POINT({} {})'::geometry)".format(city,
-            x["name"].replace("'", "''").encode("utf-8"), x["totalCapacity"],
-            (x["totalCapacity"] - x["usedCapacity"]), x["coordinates"][0],
-            x["coordinates"][1]) for x in lot_data]
-        if values:
-            db.query("""
-                INSERT INTO carshare_lots (company, city, name, capacity, available, geom, geojson)
-                    SELECT 'car2go', d.city, d.name, d.capacity, d.available,
-                            ST_Transform(d.geom, 3857), ST_AsGeoJSON(d.geom)::jsonb
-                    FROM (VALUES {}) AS d(city, name, capacity, available, geom)
-                    WHERE (SELECT 1 FROM carshare_lots l WHERE l.city = d.city AND l.name = d.name LIMIT 1) IS NULL
-            """.format(",".join(values)))
+        run.load("staged_lots", [("name", "varchar"), ("capacity", "integer"), ("available", "integer"),
+            ("geom", "geometry")], [(x["name"], x["totalCapacity"], x["totalCapacity"] - x["usedCapacity"],
+            point(*x["coordinates"][0:2])) for x in lot_data])
+        run.apply("update lots", """
+            UPDATE carshare_lots l SET capacity = d.capacity, available = d.available
+            FROM staged_lots d
+            WHERE l.company = 'car2go' AND l.city = '{city}' AND l.name = d.name
+                AND l.available != d.available
+        """.format(city=city) + LOT_EVENT, event="availability")
+        run.apply("insert lots", """
+            INSERT INTO carshare_lots (company, city, name, capacity, available, geom, geojson)
+                SELECT 'car2go', '{city}', d.name, d.capacity, d.available,
+                        ST_Transform(d.geom, 3857), ST_AsGeoJSON(d.geom)::jsonb
+                FROM staged_lots d
+                WHERE NOT EXISTS (SELECT 1 FROM carshare_lots l WHERE l.city = '{city}' AND l.name = d.name)
+        """.format(city=city) + NEW_LOT_EVENT, event="availability")
+
+        # an empty answer is more likely an API hiccup than a city without cars
+        if not data:
+            return
+
+        run.load("staged_cars", [("vin", "varchar"), ("city", "varchar"), ("name", "varchar"),
+            ("address", "varchar"), ("fuel", "integer"), ("lot_id", "integer"), ("geom", "geometry")],
+            [(x["vin"], city, x["name"], x["address"], x.get("fuel", 0), None,
+            point(*x["coordinates"][0:2])) for x in data])
+
+        # cars parked in a car2go lot are not on a street slot
+        run.apply("match lots", """
+            UPDATE staged_cars d SET lot_id = l.id
+            FROM carshare_lots l
+            WHERE l.city = d.city AND l.name = d.address
+        """)
+        run.snap("staged_cars", "car2go", where="d.lot_id IS NULL")
 
         # unpark stale entries in our database
-        db.query("""
+        run.apply("unpark", """
             UPDATE carshares c SET since = NOW(), parked = false
             WHERE c.company = 'car2go'
                 AND c.city = '{city}'
                 AND c.parked = true
-                AND (SELECT 1 FROM (VALUES {data}) AS d(pid) WHERE c.vin = d.pid LIMIT 1) IS NULL
-        """.format(city=city, data=",".join(["('{}')".format(x["vin"]) for x in data])))
+                AND NOT EXISTS (SELECT 1 FROM staged_cars d WHERE d.vin = c.vin)
+        """.format(city=city) + CAR_EVENT, event="unparked")
 
         # create or update car2go tracking with new data
-        values = ["('{}','{}','{}','{}',{},'SRID=4326;POINT({} {})'::geometry)".format(city, x["vin"],
-            x["name"].encode('utf-8'), x["address"].replace("'", "''").encode("utf-8"),
-            x.get("fuel", 0), x["coordinates"][0], x["coordinates"][1]) for x in data]
-        db.query("""
-            WITH tmp AS (
-                SELECT DISTINCT ON (d.vin) d.vin, d.name, d.fuel, d.address, d.geom,
-                    s.id AS slot_id, l.id AS lot_id
-                FROM (VALUES {}) AS d(city, vin, name, address, fuel, geom)
-                LEFT JOIN carshare_lots l ON d.city = l.city AND l.name = d.address
-                LEFT JOIN slots s ON l.id IS NULL AND d.city = s.city
-                    AND ST_DWithin(ST_Transform(d.geom, 3857), s.geom, 5)
-                ORDER BY d.vin, ST_Distance(ST_Transform(d.geom, 3857), s.geom)
-            )
-            UPDATE carshares c SET since = NOW(), name = t.name, address = t.address,
-                parked = true, slot_id = t.slot_id, lot_id = t.lot_id, fuel = t.fuel,
-                geom = ST_Transform(t.geom, 3857), geojson = ST_AsGeoJSON(t.geom)::jsonb
-            FROM tmp t
+        run.apply("update cars", """
+            UPDATE carshares c SET since = NOW(), name = d.name, address = d.address,
+                parked = true, slot_id = d.slot_id, lot_id = d.lot_id, fuel = d.fuel,
+                geom = d.geom_m, geojson = ST_AsGeoJSON(d.geom)::jsonb
+            FROM staged_cars d
             WHERE c.company = 'car2go'
-                AND c.vin = t.vin
+                AND c.vin = d.vin
                 AND c.parked = false
-        """.format(",".join(values)))
-        db.query("""
+        """ + CAR_EVENT, event="parked")
+        run.apply("insert cars", """
             INSERT INTO carshares (company, city, vin, name, address, slot_id, lot_id, parked, fuel, geom, geojson)
-                SELECT DISTINCT ON (d.vin) 'car2go', d.city, d.vin, d.name, d.address, s.id, l.id,
-                    true, d.fuel, ST_Transform(d.geom, 3857), ST_AsGeoJSON(d.geom)::jsonb
-                FROM (VALUES {}) AS d(city, vin, name, address, fuel, geom)
-                LEFT JOIN carshare_lots l ON d.city = l.city AND l.name = d.address
-                LEFT JOIN slots s ON l.id IS NULL AND s.city = d.city
-                    AND ST_DWithin(ST_Transform(d.geom, 3857), s.geom, 5)
-                WHERE (SELECT 1 FROM carshares c WHERE c.vin = d.vin LIMIT 1) IS NULL
-                ORDER BY d.vin, ST_Distance(ST_Transform(d.geom, 3857), s.geom)
-        """.format(",".join(values)))
+                SELECT DISTINCT ON (d.vin) 'car2go', d.city, d.vin, d.name, d.address, d.slot_id, d.lot_id,
+                    true, d.fuel, d.geom_m, ST_AsGeoJSON(d.geom)::jsonb
+                FROM staged_cars d
+                WHERE NOT EXISTS (SELECT 1 FROM carshares c WHERE c.vin = d.vin)
+                ORDER BY d.vin
+        """ + NEW_CAR_EVENT, event="parked")
+    fp.save()
 
 
 def update_automobile():
     """
     Task to check with the Auto-mobile API, find moved cars and update their positions/slots
     """
-    CONFIG = create_app().config
-    db = PostgresWrapper(
-        "host='{PG_HOST}' port={PG_PORT} dbname={PG_DATABASE} "
-        "user={PG_USERNAME} password={PG_PASSWORD} ".format(**CONFIG))
-
-    # grab data from Auto-mobile api
-    data = requests.get("https://www.reservauto.net/WCF/LSI/LSIBookingService.asmx/GetVehicleProposals",
-        params={"Longitude": "-73.56307727766432", "Latitude": "45.48420949674474", "CustomerID": '""'})
-    data = demjson.decode(data.text.lstrip("(").rstrip(");"))["Vehicules"]
-
-    # unpark stale entries in our database
-    if data:
-        db.query("""
+    run_providers(get_config(), [("auto-mobile", None)])
+
+
+def fetch_automobile(CONFIG, city):
+    """
+    Grab vehicles from the Auto-mobile API (it covers all cities at once).
+
+    :returns: vehicles (list)
+    """
+    data = _fetch(CONFIG, "auto-mobile", "https://www.reservauto.net/WCF/LSI/LSIBookingService.asmx/GetVehicleProposals",
+        conditional=True, params={"Longitude": "-73.56307727766432", "Latitude": "45.48420949674474", "CustomerID": '""'})
+    return demjson.decode(data.lstrip("(").rstrip(");"))["Vehicules"]
+
+
+def write_automobile(db, fingerprints, city, data):
+    """
+    Update Auto-mobile vehicles.
+    """
+    # an empty answer is more likely an API hiccup than no car at all
+    if not data:
+        return
+
+    fp = fingerprints("auto-mobile")
+    if fp.unchanged(data, key=lambda x: x["Id"]):
+        return
+
+    with Ingestion(db, "auto-mobile", r=fp.r) as run:
+        run.load("staged_cars", [("vin", "varchar"), ("city", "varchar"), ("name", "varchar"),
+            ("fuel", "integer"), ("electric", "boolean"), ("id", "varchar"), ("geom", "geometry")],
+            [(x["Id"], None, x["Immat"], x["EnergyLevel"], x["Name"].endswith("-R"), x["Name"],
+            point(x["Position"]["Lon"], x["Position"]["Lat"])) for x in data])
+        run.snap("staged_cars", "auto-mobile")
+
+        # unpark stale entries in our database
+        run.apply("unpark", """
             UPDATE carshares c SET since = NOW(), parked = false
             WHERE c.company = 'auto-mobile'
                 AND c.parked = true
-                AND (SELECT 1 FROM (VALUES {data}) AS d(pid) WHERE c.vin = d.pid LIMIT 1) IS NULL
-        """.format(data=",".join(["('{}')".format(x["Id"]) for x in data])))
-
-        # create or update Auto-mobile tracking with newly parked vehicles
-        values = ["('{}','{}',{},{},'{}','SRID=4326;POINT({} {})'::geometry)".format(x["Id"],
-            x["Immat"].encode('utf-8'), x["EnergyLevel"], ("true" if x["Name"].endswith("-R") else "false"),
-            x["Name"].encode('utf-8'), x["Position"]["Lon"], x["Position"]["Lat"]) for x in data]
-        db.query("""
-            WITH tmp AS (
-                SELECT DISTINCT ON (d.vin) d.vin, d.name, d.fuel, d.id, s.id AS slot_id, s.way_name, d.geom
-                FROM (VALUES {}) AS d(vin, name, fuel, electric, id, geom)
-                JOIN cities c ON ST_Intersects(ST_Transform(d.geom, 3857), c.geom)
-                LEFT JOIN slots s ON s.city = c.name
-                    AND ST_DWithin(ST_Transform(d.geom, 3857), s.geom, 5)
-                ORDER BY d.vin, ST_Distance(ST_Transform(d.geom, 3857), s.geom)
-            )
-            UPDATE carshares c SET partner_id = t.id, since = NOW(), name = t.name, address = t.way_name,
-                parked = true, slot_id = t.slot_id, fuel = t.fuel, geom = ST_Transform(t.geom, 3857),
-                geojson = ST_AsGeoJSON(t.geom)::jsonb
-            FROM tmp t
+                AND NOT EXISTS (SELECT 1 FROM staged_cars d WHERE d.vin = c.vin)
+        """ + CAR_EVENT, event="unparked")
+
+        # create or update Auto-mobile tracking with newly parked vehicles (only in the cities we serve)
+        run.apply("update cars", """
+            UPDATE carshares c SET partner_id = d.id, since = NOW(), name = d.name, address = s.way_name,
+                parked = true, slot_id = d.slot_id, fuel = d.fuel, geom = d.geom_m,
+                geojson = ST_AsGeoJSON(d.geom)::jsonb
+            FROM staged_cars d
+            LEFT JOIN slots s ON s.id = d.slot_id
             WHERE c.company = 'auto-mobile'
-                AND c.vin = t.vin
+                AND c.vin = d.vin
                 AND c.parked = false
-        """.format(",".join(values)))
-        db.query("""
+                AND d.city IS NOT NULL
+        """ + CAR_EVENT, event="parked")
+        run.apply("insert cars", """
             INSERT INTO carshares (company, city, partner_id, vin, name, address, slot_id, parked, fuel, electric, geom, geojson)
-                SELECT DISTINCT ON (d.vin) 'auto-mobile', c.name, d.id, d.vin, d.name, s.way_name, s.id,
-                    true, d.fuel, d.electric, ST_Transform(d.geom, 3857), ST_AsGeoJSON(d.geom)::jsonb
-                FROM (VALUES {}) AS d(vin, name, fuel, electric, id, geom)
-                JOIN cities c ON ST_Intersects(ST_Transform(d.geom, 3857), c.geom)
-                LEFT JOIN slots s ON s.city = c.name
-                    AND ST_DWithin(ST_Transform(d.geom, 3857), s.geom, 5)
-                WHERE (SELECT 1 FROM carshares c WHERE c.vin = d.vin LIMIT 1) IS NULL
-                ORDER BY d.vin, ST_Distance(ST_Transform(d.geom, 3857), s.geom)
-        """.format(",".join(values)))
+                SELECT DISTINCT ON (d.vin) 'auto-mobile', d.city, d.id, d.vin, d.name, s.way_name, d.slot_id,
+                    true, d.fuel, d.electric, d.geom_m, ST_AsGeoJSON(d.geom)::jsonb
+                FROM staged_cars d
+                LEFT JOIN slots s ON s.id = d.slot_id
+                WHERE d.city IS NOT NULL
+                    AND NOT EXISTS (SELECT 1 FROM carshares c WHERE c.vin = d.vin)
+                ORDER BY d.vin
+        """ + NEW_CAR_EVENT, event="parked")
+    fp.save()
 
 
 def update_communauto():
     """
     Task to check with the Communuauto API, find moved cars and update their positions/slots
     """
-    CONFIG = create_app().config
-    db = PostgresWrapper(
-        "host='{PG_HOST}' port={PG_PORT} dbname={PG_DATABASE} "
-        "user={PG_USERNAME} password={PG_PASSWORD} ".format(**CONFIG))
-
-    for city in ["montreal", "quebec"]:
-        # grab data from communauto api
-        if city == "montreal":
-            cacity = 59
-        elif city == "quebec":
-            cacity = 90
-        start = datetime.datetime.utcnow().replace(tzinfo=pytz.utc).astimezone(pytz.timezone('US/Eastern'))
-        finish = (start + datetime.timedelta(minutes=30))
-        data = requests.post("https://www.reservauto.net/Scripts/Client/Ajax/PublicCall/Get_Car_DisponibilityJSON.asp",
-            data={"CityID": cacity, "StartDate": start.strftime("%d/%m/%Y %H:%M"),
-                "EndDate": finish.strftime("%d/%m/%Y %H:%M"), "FeeType": 80})
-        # must use demjson here because returning format is non-standard JSON
-        try:
-            data = demjson.decode(data.text.lstrip("(").rstrip(")"))["data"]
-        except:
-            return
+    run_providers(get_config(), [("communauto", x) for x in sorted(COMMUNAUTO_CITIES)])
+
+
+def fetch_communauto(CONFIG, city):
+    """
+    Grab the vehicles available in the next 30 minutes from the Communauto API.
 
-        # create or update communauto parking spaces
-        values = ["('{}',{})".format(x["StationID"], (1 if x["NbrRes"] == 0 else 0)) for x in data]
-        db.query("""
+    :returns: vehicles (list) or None if the response could not be decoded
+    """
+    start = datetime.datetime.utcnow().replace(tzinfo=pytz.utc).astimezone(pytz.timezone('US/Eastern'))
+    finish = (start + datetime.timedelta(minutes=30))
+    data = _fetch(CONFIG, "communauto", "https://www.reservauto.net/Scripts/Client/Ajax/PublicCall/Get_Car_DisponibilityJSON.asp",
+        method="post", data={"CityID": COMMUNAUTO_CITIES[city], "StartDate": start.strftime("%d/%m/%Y %H:%M"),
+            "EndDate": finish.strftime("%d/%m/%Y %H:%M"), "FeeType": 80})
+    # must use demjson here because returning format is non-standard JSON
+    try:
+        return demjson.decode(data.lstrip("(").rstrip(")"))["data"]
+    except:
+        return None
+
+
+def write_communauto(db, fingerprints, city, data):
+    """
+    Update Communauto parking spaces and vehicles for a city.
+    Vehicles are only updated when their record changed since the previous run.
+    """
+    fp = fingerprints("communauto:" + city)
+    changed = fp.diff(data, key=lambda x: x["CarID"])
+    if not changed and not fp.removed:
+        return
+
+    with Ingestion(db, "communauto " + city, r=fp.r) as run:
+        run.load("staged_cars", [("pid", "varchar"), ("lot_pid", "varchar"), ("numres", "integer"),
+            ("name", "varchar"), ("address", "varchar"), ("until", "timestamp"), ("changed", "boolean"),
+            ("geom", "geometry")], [(x["CarID"], x["StationID"], x["NbrRes"], x["Model"],
+            x["strNomStation"], x["AvailableUntilDate"] or None, unicode(x["CarID"]) in changed,
+            point(x["Longitude"], x["Latitude"])) for x in data])
+
+        # create or update communauto parking spaces (available if any of its cars is free)
+        run.apply("update lots", """
             UPDATE carshare_lots l SET capacity = 1, available = d.available
-            FROM (VALUES {}) AS d(pid, available)
+            FROM (
+                SELECT lot_pid, max(CASE WHEN numres = 0 THEN 1 ELSE 0 END) AS available
+                FROM staged_cars GROUP BY lot_pid
+            ) AS d
             WHERE l.company = 'communauto'
-                AND l.partner_id = d.pid
+                AND l.partner_id = d.lot_pid
                 AND l.available != d.available
-        """.format(",".join(values)))
-
-        values = ["('{}','{}',{},'{}','SRID=4326;POINT({} {})'::geometry)".format(city,
-            x["strNomStation"].replace("'", "''").encode("utf-8"), (1 if x["NbrRes"] == 0 else 0),
-            x["StationID"], x["Longitude"], x["Latitude"]) for x in data]
-        db.query("""
+        """ + LOT_EVENT, event="availability")
+        run.apply("insert lots", """
             INSERT INTO carshare_lots (company, city, name, capacity, available, partner_id, geom, geojson)
-                SELECT 'communauto', d.city, d.name, 1, d.available, d.partner_id,
+                SELECT DISTINCT ON (d.lot_pid) 'communauto', '{city}', d.address, 1,
+                        CASE WHEN d.numres = 0 THEN 1 ELSE 0 END, d.lot_pid,
                         ST_Transform(d.geom, 3857), ST_AsGeoJSON(d.geom)::jsonb
-                FROM (VALUES {}) AS d(city, name, available, partner_id, geom)
-                WHERE (SELECT 1 FROM carshare_lots l WHERE l.partner_id = d.partner_id LIMIT 1) IS NULL
-        """.format(",".join(values)))
+                FROM staged_cars d
+                WHERE NOT EXISTS (SELECT 1 FROM carshare_lots l WHERE l.partner_id = d.lot_pid)
+                ORDER BY d.lot_pid, d.numres
+        """.format(city=city) + NEW_LOT_EVENT, event="availability")
 
-        # unpark stale entries in our database
-        db.query("""
+        # unpark stale entries in our database: reserved cars, and cars whose space is now taken by another
+        run.apply("unpark reserved", """
             UPDATE carshares c SET since = NOW(), parked = false
-            FROM (VALUES {data}) AS d(pid, lot_id, numres)
+            FROM staged_cars d
             WHERE c.parked = true
                 AND c.city = '{city}'
                 AND d.numres = 1
                 AND c.company = 'communauto'
-                AND c.partner_id = d.pid;
-
+                AND c.partner_id = d.pid
+        """.format(city=city) + CAR_EVENT, event="unparked")
+        run.apply("unpark moved", """
             UPDATE carshares c SET since = NOW(), parked = false
             WHERE c.parked = true
                 AND c.company = 'communauto'
                 AND c.city = '{city}'
-                AND (SELECT 1 FROM (VALUES {data}) AS d(pid, lot_id, numres) WHERE d.pid != c.partner_id
-                     AND d.lot_id = c.lot_id LIMIT 1) IS NOT NULL
-        """.format(city=city, data=",".join(["('{}',{},{})".format(x["CarID"],x["StationID"],x["NbrRes"]) for x in data])))
+                AND EXISTS (
+                    SELECT 1 FROM staged_cars d
+                    JOIN carshare_lots l ON l.company = 'communauto' AND l.partner_id = d.lot_pid
+                    WHERE d.pid != c.partner_id AND l.id = c.lot_id
+                )
+        """.format(city=city) + CAR_EVENT, event="unparked")
 
         # create or update communauto tracking with newly parked vehicles
-        values = ["('{}',{},'{}','{}','{}'::timestamp,'SRID=4326;POINT({} {})'::geometry)".format(x["CarID"],
-            x["NbrRes"], x["Model"].encode("utf-8"), x["strNomStation"].replace("'", "''").encode("utf-8"),
-            x["AvailableUntilDate"] or "NOW", x["Longitude"], x["Latitude"]) for x in data]
-        db.query("""
-            UPDATE carshares c SET since = NOW(), until = d.until, name = d.name, address = d.address,
-                parked = true, geom = ST_Transform(d.geom, 3857), geojson = ST_AsGeoJSON(d.geom)::jsonb
-            FROM (VALUES {}) AS d(pid, numres, name, address, until, geom)
-            WHERE c.company = 'communauto'
-                AND c.partner_id = d.pid
-                AND d.numres = 0
-        """.format(",".join(values)))
-
-        values = ["('{}','{}','{}','{}','{}',{},'{}'::timestamp,'SRID=4326;POINT({} {})'::geometry)".format(city,
-            x["StationID"], x["CarID"], x["Model"].encode("utf-8"), x["strNomStation"].replace("'", "''").encode("utf-8"),
-            x["NbrRes"], x["AvailableUntilDate"] or "NOW", x["Longitude"], x["Latitude"]) for x in data]
-        db.query("""
+        for stage, parked, event in [("move cars", "true", "moved"), ("park cars", "false", "parked")]:
+            run.apply(stage, """
+                UPDATE carshares c SET since = NOW(), until = COALESCE(d.until, NOW()), name = d.name,
+                    address = d.address, parked = true, geom = ST_Transform(d.geom, 3857),
+                    geojson = ST_AsGeoJSON(d.geom)::jsonb
+                FROM staged_cars d
+                WHERE c.company = 'communauto'
+                    AND c.partner_id = d.pid
+                    AND c.parked = {parked}
+                    AND d.numres = 0
+                    AND d.changed
+            """.format(parked=parked) + CAR_EVENT, event=event)
+        run.apply("insert cars", """
             INSERT INTO carshares (company, city, partner_id, name, address, lot_id, parked, until, geom, geojson)
-                SELECT 'communauto', d.city, d.partner_id, d.name, d.address, l.id, d.numres = 0,
-                        d.until, ST_Transform(d.geom, 3857), ST_AsGeoJSON(d.geom)::jsonb
-                FROM (VALUES {}) AS d(city, lot_pid, partner_id, name, address, numres, until, geom)
-                JOIN carshare_lots l ON l.company = 'communauto' AND l.city = d.city
+                SELECT 'communauto', '{city}', d.pid, d.name, d.address, l.id, d.numres = 0,
+                        COALESCE(d.until, NOW()), ST_Transform(d.geom, 3857), ST_AsGeoJSON(d.geom)::jsonb
+                FROM staged_cars d
+                JOIN carshare_lots l ON l.company = 'communauto' AND l.city = '{city}'
                     AND l.partner_id = d.lot_pid
-                WHERE (SELECT 1 FROM carshares c WHERE c.partner_id = d.partner_id LIMIT 1) IS NULL
-        """.format(",".join(values)))
+                WHERE NOT EXISTS (SELECT 1 FROM carshares c WHERE c.partner_id = d.pid)
+        """.format(city=city) + NEW_CAR_EVENT, event="parked")
+    fp.save()
 
 
+@scheduled(86400, timeout=600)
 def update_zipcar():
     """
     Task to check with the Zipcar API and update parking lot data
     """
-    CONFIG = create_app().config
-    db = PostgresWrapper(
-        "host='{PG_HOST}' port={PG_PORT} dbname={PG_DATABASE} "
-        "user={PG_USERNAME} password={PG_PASSWORD} ".format(**CONFIG))
+    CONFIG = get_config()
+    db = get_db(CONFIG)
 
-    lots, cars, vids = [], [], []
-    raw = requests.get("https://api.zipcar.com/partner-api/directory",
+    lots, cars = [], []
+    raw = _fetch(CONFIG, "zipcar", "https://api.zipcar.com/partner-api/directory", conditional=True,
         params={"country": "us", "embed": "vehicles", "apikey": CONFIG["ZIPCAR_KEY"]})
-    data = raw.json()["locations"]
+    data = json.loads(raw)["locations"]
     for x in data:
         if not x["address"]["city"] or not x["address"]["city"] \
                 in ["Seattle", "New York", "Brooklyn", "Queens", "Staten Island",
@@ -280,73 +441,96 @@ def update_zipcar():
             city = "newyork"
         if x["address"]["city"] in ["Boston", "Cambridge"]:
             city = "boston"
-        lots.append("('{}','{}','{}',{},'SRID=4326;POINT({} {})'::geometry)".format(
-            x["location_id"], city, x["display_name"].replace("'", "''").encode("utf-8"),
-            len(x["vehicles"]), x["coordinates"]["lng"], x["coordinates"]["lat"]
-        ))
+        geom = point(x["coordinates"]["lng"], x["coordinates"]["lat"])
+        lots.append((x["location_id"], city, x["display_name"], len(x["vehicles"]), geom))
         for y in x["vehicles"]:
-            cars.append("('{}','{}','{}','{}','{}','SRID=4326;POINT({} {})'::geometry)".format(
-                y["vehicle_id"], y["vehicle_name"].replace("'", "''").encode("utf-8"),
-                city, x["address"]["street"].replace("'", "''").encode("utf-8"),
-                x["location_id"], x["coordinates"]["lng"], x["coordinates"]["lat"]
-            ))
-            vids.append(y["vehicle_id"])
-
-    if lots:
-        db.query("""
+            cars.append((y["vehicle_id"], y["vehicle_name"], city, x["address"]["street"],
+                x["location_id"], geom))
+
+    # an empty answer is more likely an API hiccup than Zipcar leaving all our cities
+    if not lots:
+        return
+
+    r = get_redis()
+    fp = Fingerprints(r, "zipcar", CONFIG["FINGERPRINT_TTL"])
+    if fp.unchanged([("lot", x) for x in lots] + [("car", x) for x in cars],
+            key=lambda x: u"{}:{}".format(x[0], x[1][0])):
+        return
+
+    with Ingestion(db, "zipcar", r=r) as run:
+        run.load("staged_lots", [("pid", "varchar"), ("city", "varchar"), ("name", "varchar"),
+            ("capacity", "integer"), ("geom", "geometry")], lots)
+        run.load("staged_cars", [("pid", "varchar"), ("name", "varchar"), ("city", "varchar"),
+            ("address", "varchar"), ("lot_pid", "varchar"), ("geom", "geometry")], cars)
+        run.apply("update lots", """
             UPDATE carshare_lots l SET name = d.name, capacity = d.capacity, available = d.capacity
-            FROM (VALUES {}) AS d(pid, city, name, capacity, geom)
+            FROM staged_lots d
             WHERE l.company = 'zipcar'
                 AND l.partner_id = d.pid
                 AND (l.available != d.capacity OR l.capacity != d.capacity OR l.name != d.name)
-        """.format(",".join(lots)))
-        db.query("""
+        """ + LOT_EVENT, event="availability")
+        run.apply("insert lots", """
             INSERT INTO carshare_lots (company, partner_id, city, name, capacity, available, geom, geojson)
             SELECT 'zipcar', d.pid, d.city, d.name, d.capacity, d.capacity,
                     ST_Transform(d.geom, 3857), ST_AsGeoJSON(d.geom)::jsonb
-            FROM (VALUES {}) AS d(pid, city, name, capacity, geom)
-            WHERE (SELECT 1 FROM carshare_lots l WHERE l.city = d.city AND l.partner_id = d.pid LIMIT 1) IS NULL
-        """.format(",".join(lots)))
-    if cars:
-        db.query("""
+            FROM staged_lots d
+            WHERE NOT EXISTS (SELECT 1 FROM carshare_lots l WHERE l.city = d.city AND l.partner_id = d.pid)
+        """ + NEW_LOT_EVENT, event="availability")
+        run.apply("insert cars", """
             INSERT INTO carshares (company, city, partner_id, name, address, lot_id, parked, geom, geojson)
                 SELECT 'zipcar', d.city, d.pid, d.name, d.address, l.id, true,
                         ST_Transform(d.geom, 3857), ST_AsGeoJSON(d.geom)::jsonb
-                FROM (VALUES {}) AS d(pid, name, city, address, lot_pid, geom)
+                FROM staged_cars d
                 JOIN carshare_lots l ON l.company = 'zipcar' AND l.city = d.city
                     AND l.partner_id = d.lot_pid
-                WHERE (SELECT 1 FROM carshares c WHERE c.partner_id = d.pid LIMIT 1) IS NULL
-        """.format(",".join(cars)))
-    db.query("""
-        DELETE FROM carshare_lots l
-        WHERE l.company = 'zipcar'
-            AND (SELECT 1 FROM (VALUES {}) AS d(pid) WHERE l.company = 'zipcar' AND l.partner_id = d.pid) IS NULL
-    """.format(",".join(["('{}')".format(z["location_id"]) for z in data])))
-    db.query("""
-        DELETE FROM carshares l
-        WHERE l.company = 'zipcar'
-            AND (SELECT 1 FROM (VALUES {}) AS d(pid) WHERE l.company = 'zipcar' AND l.partner_id = d.pid) IS NULL
-    """.format(",".join(["('{}')".format(z) for z in vids])))
+                WHERE NOT EXISTS (SELECT 1 FROM carshares c WHERE c.partner_id = d.pid)
+        """ + NEW_CAR_EVENT, event="parked")
+        run.apply("delete lots", """
+            DELETE FROM carshare_lots l
+            WHERE l.company = 'zipcar'
+                AND NOT EXISTS (SELECT 1 FROM staged_lots d WHERE d.pid = l.partner_id)
+        """)
+        run.apply("delete cars", """
+            DELETE FROM carshares c
+            WHERE c.company = 'zipcar'
+                AND NOT EXISTS (SELECT 1 FROM staged_cars d WHERE d.pid = c.partner_id)
+        """ + CAR_EVENT, event="unparked")
+    fp.save()
+    rebuild_index(CONFIG, db, r)
+
 
+PROVIDERS = {
+    "car2go": (fetch_car2go, write_car2go),
+    "auto-mobile": (fetch_automobile, write_automobile),
+    "communauto": (fetch_communauto, write_communauto)
+}
 
+
+@scheduled(300)
 def update_free_spaces():
     """
     Task to check recently departed carshare spaces and record
     """
-    CONFIG = create_app().config
-    db = PostgresWrapper(
-        "host='{PG_HOST}' port={PG_PORT} dbname={PG_DATABASE} "
-        "user={PG_USERNAME} password={PG_PASSWORD} ".format(**CONFIG))
+    CONFIG = get_config()
+    db = get_db(CONFIG)
+    r = get_redis()
 
     start = datetime.datetime.now()
     finish = start - datetime.timedelta(minutes=5)
 
-    db.query("""
-        INSERT INTO free_spaces (slot_ids)
-          SELECT array_agg(s.id) FROM slots s
+    res = db.query("""
+        INSERT INTO free_spaces (slot_id)
+          SELECT DISTINCT s.id FROM slots s
             JOIN carshares c ON c.slot_id = s.id
             WHERE c.lot_id IS NULL
               AND c.parked = false
               AND c.since  > '{}'
               AND c.since  < '{}'
+        RETURNING slot_id
     """.format(finish.strftime('%Y-%m-%d %H:%M:%S'), start.strftime('%Y-%m-%d %H:%M:%S')))
+    FreeSpaces.mirror(r, [x[0] for x in res], CONFIG["FREE_SPACES_WINDOW"])
+
+    # sweep expired free spaces
+    db.query("""
+        DELETE FROM free_spaces WHERE time < NOW() - INTERVAL '{} SECONDS'
+    """.format(CONFIG["FREE_SPACES_TTL"]))
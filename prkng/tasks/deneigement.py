@@ -1,253 +1,388 @@
 # -*- coding: utf-8 -*-
 
-from prkng import create_app, notifications
-from prkng.database import PostgresWrapper
+from prkng import notifications
+from prkng.ingest import Ingestion
+from prkng.logger import Logger
+from prkng.tasks.scheduling import scheduled
+from prkng.tasks.worker import get_config, get_db, get_redis
 
 import aniso8601
 from babel.dates import format_datetime
+from cStringIO import StringIO
 import datetime
 import json
 import os
 import pytz
+import tempfile
 import time
-from redis import Redis
 from rq import Queue
+from suds.cache import ObjectCache
 from suds.client import Client
+from xml.etree import cElementTree as ElementTree
 
 
+@scheduled(300)
 def deneigement_notifications():
-    q = Queue('medium', connection=Redis(db=1))
+    q = Queue('medium', connection=get_redis())
     q.enqueue(push_deneigement_scheduled)
     q.enqueue(push_deneigement_8hr)
 
 
-def update_deneigement():
+# SOAP clients by WSDL location, kept for the life of the process
+CLIENTS = {}
+
+
+def get_client(CONFIG):
     """
-    Task to check with Montreal Planif-Neige API and note snow-clearing operations
+    Get the Info-Neige SOAP client. The WSDL is cached on disk for PLANIFNEIGE_CACHE_DAYS,
+    and the client answers with the raw XML response, to be read with :func:`parse_planifications`.
     """
-    CONFIG = create_app().config
-    db = PostgresWrapper(
-        "host='{PG_HOST}' port={PG_PORT} dbname={PG_DATABASE} "
-        "user={PG_USERNAME} password={PG_PASSWORD} ".format(**CONFIG))
-    r = Redis(db=1)
-    logfile = os.path.join(os.path.expanduser('~'), 'log', 'deneigement.log')
-    if not CONFIG["DEBUG"]:
-        logfile = '/home/parkng/log/deneigement.log'
+    url = CONFIG["PLANIFNEIGE_WSDL"]
+    if url not in CLIENTS:
+        cache = ObjectCache(location=os.path.join(tempfile.gettempdir(), 'prkng-suds'),
+            days=CONFIG["PLANIFNEIGE_CACHE_DAYS"])
+        CLIENTS[url] = Client(url, cache=cache, retxml=True)
+    return CLIENTS[url]
+
+
+def parse_planifications(source, status):
+    """
+    Read a GetPlanificationsForDate response incrementally, one planification at a time.
+
+    :param source: file-like object with the SOAP response
+    :param status: dict receiving the ``responseStatus`` and ``responseDesc`` of the response
+    :returns: generator of dicts (element name -> text, None if empty)
+    """
+    for event, elem in ElementTree.iterparse(source):
+        tag = elem.tag.rsplit('}', 1)[-1]
+        if tag == 'planification':
+            yield {x.tag.rsplit('}', 1)[-1]: x.text for x in elem}
+            elem.clear()
+        elif tag in ('responseStatus', 'responseDesc'):
+            status[tag] = elem.text
 
-    # get snow removal API changes that have occurred since our last known successful check
-    now = int(time.time())
-    since = r.get("prkng:snowdt")
-    if since:
-        since = datetime.datetime.fromtimestamp(int(since)).replace(tzinfo=pytz.utc)
+
+def snow_rule(debut, fin):
+    """
+    Create the rule object of a snow removal, with an agenda covering its start and end times.
+
+    :param debut: start (datetime)
+    :param fin: end (datetime)
+    :returns: rule (dict)
+    """
+    agenda = {str(z): [] for z in range(1,8)}
+    debutJour, finJour = debut.isoweekday(), fin.isoweekday()
+    debutHeure = float(debut.hour) + (float(debut.minute) / 60.0)
+    finHeure = float(fin.hour) + (float(fin.minute) / 60.0)
+    if debutJour == finJour:
+        agenda[str(debutJour)] = [[debutHeure, finHeure]]
     else:
-        since = (datetime.datetime.utcnow().replace(tzinfo=pytz.utc) - datetime.timedelta(minutes=30))
-    with open(logfile, 'a') as f:
-        f.write("Snow removal API check: {} ===\n".format(datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S')))
-    client = Client("https://servicesenligne2.ville.montreal.qc.ca/api/infoneige/InfoneigeWebService?WSDL")
-    planification_request = client.factory.create('getPlanificationsForDate')
-    planification_request.fromDate = since.astimezone(pytz.timezone('US/Eastern')).strftime('%Y-%m-%dT%H:%M:%S')
-    planification_request.tokenString = CONFIG["PLANIFNEIGE_API_KEY"]
-    response = client.service.GetPlanificationsForDate(planification_request)
-    with open(logfile, 'a') as f:
-        f.write(" > API contacted successfully.\n")
-
-    if response['responseStatus'] == 8:
-        # No new data
-        r.set("prkng:snowdt", now)
-        with open(logfile, 'a') as f:
-            f.write(" > No new data.\n\n")
-        return
-    elif response['responseStatus'] != 0:
-        # An error occurred
-        with open(logfile, 'a') as f:
-            f.write(" > CALL FAILED: code {}, message: {}\n\n".format(response['responseStatus'],
-                response['responseDesc'].encode('utf-8')))
-        raise Exception("Info-Neige call failed: code {}, message: {}".format(response['responseStatus'],
-            response['responseDesc'].encode('utf-8')))
-    r.set("prkng:snowdt", now)
-    with open(logfile, 'a') as f:
-        f.write(" > Contains {} changed objects.\n".format(len(response['planifications']['planification'])))
-
-    db.query("""
-        CREATE TABLE IF NOT EXISTS temporary_restrictions (
-            id serial primary key,
-            city varchar,
-            partner_id varchar,
-            slot_ids integer[],
-            modified timestamp default NOW(),
-            start timestamp,
-            finish timestamp,
-            type varchar,
-            meta varchar,
-            rule jsonb,
-            active boolean
-        )
-    """)
-    values, record = [], "({},'{}'::timestamp,'{}'::timestamp,{},'{}'::jsonb,{})"
-    for x in response['planifications']['planification']:
-        # if snow removal scheduled or rescheduled and we have a start time...
-        if x['etatDeneig'] in [2, 3] and hasattr(x, 'dateDebutPlanif'):
-            debut, fin = x['dateDebutPlanif'], x['dateFinPlanif']
-            if hasattr(x, 'dateDebutReplanif'):
-                debut, fin = x['dateDebutReplanif'], x['dateFinReplanif']
-            # translate start/end times into a rule agenda object
-            agenda = {str(z): [] for z in range(1,8)}
-            debutJour, finJour = debut.isoweekday(), fin.isoweekday()
-            debutHeure = float(debut.hour) + (float(debut.minute) / 60.0)
-            finHeure = float(fin.hour) + (float(fin.minute) / 60.0)
-            if debutJour == finJour:
-                agenda[str(debutJour)] = [[debutHeure, finHeure]]
+        # split multi-day restrictions over the midnight divide
+        agenda[str(debutJour)] = [[debutHeure, 24.0]]
+        agenda[str(finJour)] = [[0.0, finHeure]]
+        if (fin.day - debut.day) > 1:
+            if debutJour > finJour:
+                for z in range(debutJour, 8):
+                    agenda[str(z)] = [[0.0,24.0]]
+                for z in range(1, finJour + 1):
+                    agenda[str(z)] = [[0.0,24.0]]
             else:
-                # split multi-day restrictions over the midnight divide
-                agenda[str(debutJour)] = [[debutHeure, 24.0]]
-                agenda[str(finJour)] = [[0.0, finHeure]]
-                if (fin.day - debut.day) > 1:
-                    if debutJour > finJour:
-                        for z in range(debutJour, 8):
-                            agenda[str(z)] = [[0.0,24.0]]
-                        for z in range(1, finJour + 1):
-                            agenda[str(z)] = [[0.0,24.0]]
-                    else:
-                        for z in range(debutJour + 1, finJour + 1):
-                            agenda[str(z)] = [[0.0,24.0]]
-            # create the rule object with associated dates/times agenda
-            rule = {"code": "MTL-NEIGE", "description": "DÉNEIGEMENT PRÉVU DANS CE SECTEUR",
-                "periods": [], "agenda": agenda, "time_max_parking": None, "special_days": None,
-                "restrict_types": ["snow"], "permit_no": None}
-            values.append(record.format(x['coteRueId'], debut.strftime('%Y-%m-%d %H:%M:%S'),
-                fin.strftime('%Y-%m-%d %H:%M:%S'), 'true', json.dumps(rule), x['etatDeneig']))
-        # if snow removal is done or unscheduled, make sure the restriction is deactivated
-        elif x['etatDeneig'] in [0, 1, 4, 10]:
-            values.append(record.format(x['coteRueId'], datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'false', '{}', x['etatDeneig']))
-    with open(logfile, 'a') as f:
-        f.write(" > Parsed into {} values to update.\n".format(len(values)))
-
-    if values:
+                for z in range(debutJour + 1, finJour + 1):
+                    agenda[str(z)] = [[0.0,24.0]]
+    return {"code": "MTL-NEIGE", "description": "DÉNEIGEMENT PRÉVU DANS CE SECTEUR",
+        "periods": [], "agenda": agenda, "time_max_parking": None, "special_days": None,
+        "restrict_types": ["snow"], "permit_no": None}
+
+
+def planification_row(x, now):
+    """
+    Translate a planification into a row of (geobase_id, start, finish, active, rule, state),
+    or None if its state is not one we act upon.
+
+    :param x: planification, as given by :func:`parse_planifications` (dict)
+    :param now: current time, for restrictions to deactivate (str)
+    """
+    state = int(x['etatDeneig'])
+    # if snow removal scheduled or rescheduled and we have a start time...
+    if state in [2, 3] and x.get('dateDebutPlanif'):
+        debut, fin = x['dateDebutPlanif'], x['dateFinPlanif']
+        if x.get('dateDebutReplanif'):
+            debut, fin = x['dateDebutReplanif'], x['dateFinReplanif']
+        debut, fin = aniso8601.parse_datetime(debut), aniso8601.parse_datetime(fin)
+        return (int(x['coteRueId']), debut.strftime('%Y-%m-%d %H:%M:%S'),
+            fin.strftime('%Y-%m-%d %H:%M:%S'), True, json.dumps(snow_rule(debut, fin)), state)
+    # if snow removal is done or unscheduled, make sure the restriction is deactivated
+    elif state in [0, 1, 4, 10]:
+        return (int(x['coteRueId']), now, now, False, '{}', state)
+
+
+def write_planifications(db, rows, timeout):
+    """
+    Update the snow removal restrictions from a batch of planification rows, in one transaction.
+
+    Restrictions are stamped ``modified`` with the time they are written rather than the time
+    the transaction started, and no statement may take more than ``timeout``, so that they are
+    committed at most ``SNOW_PUSH_LAG`` timeouts after that time (see :func:`snow_push_targets`).
+
+    :param timeout: seconds after which a statement is cancelled (int)
+    :returns: number of restrictions updated and inserted (tuple)
+    """
+    with Ingestion(db, "info-neige") as run:
+        run.cur.execute("SET LOCAL statement_timeout = {}".format(int(timeout * 1000)))
+        run.load("staged_planifs", [("geobase_id", "integer"), ("start", "timestamp"),
+            ("finish", "timestamp"), ("active", "boolean"), ("rule", "jsonb"), ("state", "integer")], rows)
         # update temporary restrictions item when we are already tracking the blockface
-        db.query("""
-            WITH tmp AS (
-                SELECT x.*, g.name
-                FROM (VALUES {}) AS x(geobase_id, start, finish, active, rule, state)
-                JOIN montreal_geobase_double d ON x.geobase_id = d.cote_rue_i
-                JOIN montreal_roads_geobase g ON d.id_trc = g.id_trc
-            )
+        updated = run.apply("update", """
             UPDATE temporary_restrictions d SET start = x.start, finish = x.finish,
-                active = x.active, rule = x.rule, modified = NOW(), meta = x.state::text
-            FROM tmp x
+                active = x.active, rule = x.rule, modified = clock_timestamp(), meta = x.state::text
+            FROM staged_planifs x
             WHERE d.city = 'montreal' AND d.type = 'snow' AND x.geobase_id::text = d.partner_id
               AND (x.start != d.start OR x.finish != d.finish OR x.active != d.active
                 OR x.state::text != d.meta)
-        """.format(",".join(values)))
-        with open(logfile, 'a') as f:
-            f.write(" > Updated values.\n")
-
+        """)
         # insert temporary restrictions for newly-mentioned blockfaces, and link with current slot IDs
+        inserted = run.apply("insert", """
+            INSERT INTO temporary_restrictions (city, partner_id, slot_ids, start, finish,
+                    rule, type, active, meta, modified)
+                SELECT DISTINCT ON (x.geobase_id) 'montreal', x.geobase_id::text, t.slot_ids,
+                    x.start, x.finish, x.rule, 'snow', x.active, x.state::text, clock_timestamp()
+                FROM staged_planifs x
+                CROSS JOIN LATERAL (
+                    SELECT array_agg(b.slot_id) AS slot_ids
+                    FROM blockface_slots b
+                    WHERE b.cote_rue_id = x.geobase_id
+                ) t
+                WHERE t.slot_ids IS NOT NULL
+                    AND (SELECT 1 FROM temporary_restrictions l WHERE l.type = 'snow'
+                        AND l.partner_id = x.geobase_id::text LIMIT 1) IS NULL
+        """)
+    return updated, inserted
+
+
+@scheduled(1800, timeout=1500)
+def update_deneigement():
+    """
+    Task to check with Montreal Planif-Neige API and note snow-clearing operations
+    """
+    CONFIG = get_config()
+    db = get_db(CONFIG)
+    r = get_redis()
+    logfile = os.path.join(os.path.expanduser('~'), 'log', 'deneigement.log')
+    if not CONFIG["DEBUG"]:
+        logfile = '/home/parkng/log/deneigement.log'
+
+    with open(logfile, 'a') as log:
+        # get snow removal API changes that have occurred since our last known successful check
+        now = int(time.time())
+        since = r.get("prkng:snowdt")
+        if since:
+            since = datetime.datetime.fromtimestamp(int(since)).replace(tzinfo=pytz.utc)
+        else:
+            since = (datetime.datetime.utcnow().replace(tzinfo=pytz.utc) - datetime.timedelta(minutes=30))
+        log.write("Snow removal API check: {} ===\n".format(datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S')))
+        client = get_client(CONFIG)
+        planification_request = client.factory.create('getPlanificationsForDate')
+        planification_request.fromDate = since.astimezone(pytz.timezone('US/Eastern')).strftime('%Y-%m-%dT%H:%M:%S')
+        planification_request.tokenString = CONFIG["PLANIFNEIGE_API_KEY"]
+        response = client.service.GetPlanificationsForDate(planification_request)
+        log.write(" > API contacted successfully.\n")
+
         db.query("""
-            WITH tmp AS (
-                SELECT DISTINCT ON (d.cote_rue_i) d.cote_rue_i AS id,
-                    array_agg(s.id) AS slot_ids
-                FROM montreal_geobase_double d
-                JOIN montreal_roads_geobase g ON d.id_trc = g.id_trc
-                JOIN montreal_geobase r ON g.id_trc = r.id_trc
-                JOIN slots s ON city = 'montreal' AND s.rid = g.id
-                    AND ST_isLeft(ST_LineMerge(r.geom), ST_LineInterpolatePoint(ST_LineMerge(d.geom), 0.5))
-                      = ST_isLeft(g.geom, ST_LineInterpolatePoint(s.geom, 0.5))
-                WHERE ST_GeometryType(ST_LineMerge(d.geom)) = 'ST_LineString'
-                GROUP BY d.cote_rue_i
+            CREATE TABLE IF NOT EXISTS temporary_restrictions (
+                id serial primary key,
+                city varchar,
+                partner_id varchar,
+                slot_ids integer[],
+                modified timestamp default NOW(),
+                start timestamp,
+                finish timestamp,
+                type varchar,
+                meta varchar,
+                rule jsonb,
+                active boolean
             )
-            INSERT INTO temporary_restrictions (city, partner_id, slot_ids, start, finish,
-                    rule, type, active, meta)
-                SELECT 'montreal', x.geobase_id::text, t.slot_ids, x.start, x.finish,
-                    x.rule, 'snow', x.active, x.state::text
-                FROM (VALUES {}) AS x(geobase_id, start, finish, active, rule, state)
-                JOIN tmp t ON t.id = x.geobase_id
-                WHERE (SELECT 1 FROM temporary_restrictions l WHERE l.type = 'snow'
-                            AND l.partner_id = x.geobase_id::text LIMIT 1) IS NULL
-        """.format(",".join(values)))
-        with open(logfile, 'a') as f:
-            f.write(" > Inserted values.\n\n")
+        """)
+        update_blockface_slots(db)
+
+        # write planifications by batches while reading the response
+        status, rows, count, updated, inserted = {}, [], 0, 0, 0
+        deactivated = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        for x in parse_planifications(StringIO(response), status):
+            count += 1
+            row = planification_row(x, deactivated)
+            if row:
+                rows.append(row)
+            if len(rows) >= CONFIG["PLANIFNEIGE_BATCH"]:
+                res = write_planifications(db, rows, CONFIG["PLANIFNEIGE_WRITE_TIMEOUT"])
+                updated, inserted, rows = updated + res[0], inserted + res[1], []
+        if rows:
+            res = write_planifications(db, rows, CONFIG["PLANIFNEIGE_WRITE_TIMEOUT"])
+            updated, inserted = updated + res[0], inserted + res[1]
+
+        code = int(status.get('responseStatus', -1))
+        if code == 8:
+            # No new data
+            r.set("prkng:snowdt", now)
+            log.write(" > No new data.\n\n")
+            return
+        elif code != 0:
+            # An error occurred
+            desc = (status.get('responseDesc') or '').encode('utf-8')
+            log.write(" > CALL FAILED: code {}, message: {}\n\n".format(code, desc))
+            raise Exception("Info-Neige call failed: code {}, message: {}".format(code, desc))
+        r.set("prkng:snowdt", now)
+        log.write(" > Contains {} changed objects.\n".format(count))
+        log.write(" > Updated {} and inserted {} values.\n\n".format(updated, inserted))
+
+
+def update_blockface_slots(db):
+    """
+    Rebuild the ``blockface_slots`` table, mapping each side of a street in the Montreal
+    geobase (``cote_rue_id``, as used by Info-Neige) to the slots on that side.
+
+    Matching slots to blockfaces is a costly geometric join, so the table is only rebuilt
+    when one of the tables it comes from was replaced or modified since the last build.
+    Their signature (storage file and number of changed rows) is kept as the table comment.
+
+    :param db: PostgresWrapper instance
+    :returns: True if the table was rebuilt (bool)
+    """
+    signature = db.query("""
+        SELECT string_agg(c.relname || ':' || c.relfilenode || ':' ||
+                coalesce(s.n_tup_ins + s.n_tup_upd + s.n_tup_del, 0), ',' ORDER BY c.relname),
+            obj_description(to_regclass('blockface_slots'), 'pg_class')
+        FROM pg_class c
+        LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid
+        WHERE c.oid IN (to_regclass('slots'), to_regclass('montreal_geobase_double'),
+            to_regclass('montreal_roads_geobase'), to_regclass('montreal_geobase'))
+    """)[0]
+    if signature[0] == signature[1]:
+        return False
 
+    started = time.time()
+    db.queries([
+        "DROP TABLE IF EXISTS blockface_slots_new",
+        """
+        CREATE TABLE blockface_slots_new AS
+        SELECT DISTINCT d.cote_rue_i AS cote_rue_id, s.id AS slot_id
+        FROM montreal_geobase_double d
+        JOIN montreal_roads_geobase g ON d.id_trc = g.id_trc
+        JOIN montreal_geobase r ON g.id_trc = r.id_trc
+        JOIN slots s ON city = 'montreal' AND s.rid = g.id
+            AND ST_isLeft(ST_LineMerge(r.geom), ST_LineInterpolatePoint(ST_LineMerge(d.geom), 0.5))
+              = ST_isLeft(g.geom, ST_LineInterpolatePoint(s.geom, 0.5))
+        WHERE ST_GeometryType(ST_LineMerge(d.geom)) = 'ST_LineString'
+        """,
+        "ALTER TABLE blockface_slots_new ADD PRIMARY KEY (cote_rue_id, slot_id)",
+        "DROP TABLE IF EXISTS blockface_slots",
+        "ALTER TABLE blockface_slots_new RENAME TO blockface_slots",
+        "ALTER INDEX blockface_slots_new_pkey RENAME TO blockface_slots_pkey",
+        "COMMENT ON TABLE blockface_slots IS '{}'".format(signature[0])
+    ])
+    Logger.info("blockface_slots rebuilt in {:.1f}s".format(time.time() - started))
+    return True
 
+
+# users to notify of the snow removals selected by a condition on temporary_restrictions (x),
+# with one row per language and start time
+SNOW_PUSH_TARGETS = """
+    SELECT u.lang, x.start, array_agg(DISTINCT u.sns_id)
+    FROM temporary_restrictions x
+    CROSS JOIN LATERAL unnest(x.slot_ids) AS s(slot_id)
+    JOIN checkins c ON c.slot_id = s.slot_id
+        AND c.active = true AND c.checkout_time IS NULL
+        AND c.checkin_time > (NOW() - INTERVAL '14 DAYS')
+    JOIN users u ON c.user_id = u.id
+    WHERE (x.meta = '2' OR x.meta = '3') AND x.active = true AND x.type = 'snow'
+        AND {condition}
+        AND u.push_on_temp = true AND u.sns_id IS NOT NULL
+    GROUP BY u.lang, x.start
+"""
+
+# max minutes of changes looked at when a push task did not run for a while
+SNOW_PUSH_CATCHUP = 60
+# restrictions are committed at most this many PLANIFNEIGE_WRITE_TIMEOUT after being modified
+# (the rest of the update, the insert and the commit of their batch, see write_planifications)
+SNOW_PUSH_LAG = 3
+
+
+def snow_push_targets(db, r, name, column, until):
+    """
+    Find the users to notify of snow removals whose ``column`` is between the last time
+    the ``name`` task ran and ``until``; each removal is notified once, even if the task
+    runs late or twice. Call :func:`snow_push_done` once the notifications are scheduled.
+
+    ``until`` must be far enough in the past that no restriction with an earlier ``column``
+    remains to be committed, or it would never be notified.
+
+    :param db: PostgresWrapper instance
+    :param r: Redis connection
+    :param name: name of the push task, for its watermark (str)
+    :param column: timestamp column of temporary_restrictions (str)
+    :param until: upper bound (datetime)
+    :returns: list of (lang, start (datetime), device IDs (list))
+    """
+    since = until - datetime.timedelta(minutes=SNOW_PUSH_CATCHUP)
+    watermark = r.get("prkng:snowpush:" + name)
+    if watermark:
+        since = max(since, datetime.datetime.strptime(watermark, '%Y-%m-%d %H:%M:%S'))
+    else:
+        since = until - datetime.timedelta(minutes=5)
+    return db.query(SNOW_PUSH_TARGETS.format(condition="x.{0} > '{1}' AND x.{0} <= '{2}'".format(
+        column, since.strftime('%Y-%m-%d %H:%M:%S'), until.strftime('%Y-%m-%d %H:%M:%S'))))
+
+
+def snow_push_done(r, name, until):
+    """
+    Move the watermark of a push task, see :func:`snow_push_targets`.
+    """
+    r.set("prkng:snowpush:" + name, until.strftime('%Y-%m-%d %H:%M:%S'))
+
+
+@scheduled(300)
 def push_deneigement_scheduled():
     """
     Push messages to users when snow removal is initially scheduled for their checkin location.
     """
-    CONFIG = create_app().config
-    db = PostgresWrapper(
-        "host='{PG_HOST}' port={PG_PORT} dbname={PG_DATABASE} "
-        "user={PG_USERNAME} password={PG_PASSWORD} ".format(**CONFIG))
-
-    # grab the appropriate checkins to send pushes to by slot ID
-    start = datetime.datetime.now()
-    finish = start - datetime.timedelta(minutes=5)
-    res = db.query("""
-        SELECT DISTINCT x.start, u.lang, u.sns_id
-        FROM temporary_restrictions x
-        JOIN checkins c ON c.slot_id = ANY(x.slot_ids)
-        JOIN users u ON c.user_id = u.id
-        WHERE (x.meta = '2' OR x.meta = '3') AND x.active = true AND x.type = 'snow'
-            AND x.modified > '{}' AND x.modified < '{}'
-            AND c.active = true AND c.checkout_time IS NULL
-            AND u.push_on_temp = true AND u.sns_id IS NOT NULL
-            AND c.checkin_time > (NOW() - INTERVAL '14 DAYS')
-    """.format(finish.strftime('%Y-%m-%d %H:%M:%S'), start.strftime('%Y-%m-%d %H:%M:%S')))
-
-    # group device IDs by start time, then send messages
-    lang_en, lang_fr = filter(lambda x: x[1] == 'en', res), filter(lambda x: x[1] == 'fr', res)
-    data = {"en": {x: [] for x in set([z[0].isoformat() for z in lang_en])},
-        "fr": {x: [] for x in set([z[0].isoformat() for z in lang_fr])}}
-    for x in lang_en:
-        data["en"][x[0].isoformat()].append(x[2])
-    for x in lang_fr:
-        data["fr"][x[0].isoformat()].append(x[2])
-    for x in data["en"].keys():
-        dt = format_datetime(aniso8601.parse_datetime(x), u"h:mm a 'on' EEEE d MMM")
-        notifications.schedule_notifications(data["en"][x],
-            "❄️ Snow removal scheduled! Move your car before {}".format(dt))
-    for x in data["fr"].keys():
-        dt = format_datetime(aniso8601.parse_datetime(x), u"H'h'mm', 'EEEE 'le 'd MMM", locale='fr_FR')
-        notifications.schedule_notifications(data["fr"][x],
-            "❄️ Déneigement annoncé ! Déplacez votre véhicule avant {}".format(dt))
+    CONFIG = get_config()
+    db = get_db(CONFIG)
+    r = get_redis()
 
+    # restrictions modified since the last run, on the clock of the database that set them,
+    # leaving out the last ones as batches modified before now may not be committed yet
+    until = db.query("SELECT date_trunc('second', LOCALTIMESTAMP - INTERVAL '{} SECONDS')".format(
+        SNOW_PUSH_LAG * CONFIG["PLANIFNEIGE_WRITE_TIMEOUT"]))[0][0]
+    for lang, start, device_ids in snow_push_targets(db, r, "scheduled", "modified", until):
+        if lang == 'fr':
+            dt = format_datetime(start, u"H'h'mm', 'EEEE 'le 'd MMM", locale='fr_FR')
+            notifications.schedule_notifications(device_ids,
+                "❄️ Déneigement annoncé ! Déplacez votre véhicule avant {}".format(dt))
+        elif lang == 'en':
+            dt = format_datetime(start, u"h:mm a 'on' EEEE d MMM")
+            notifications.schedule_notifications(device_ids,
+                "❄️ Snow removal scheduled! Move your car before {}".format(dt))
+    snow_push_done(r, "scheduled", until)
 
+
+@scheduled(300)
 def push_deneigement_8hr():
     """
     Push messages to users when the snow removal period for their checkin location is exactly eight hours away
     """
-    CONFIG = create_app().config
-    db = PostgresWrapper(
-        "host='{PG_HOST}' port={PG_PORT} dbname={PG_DATABASE} "
-        "user={PG_USERNAME} password={PG_PASSWORD} ".format(**CONFIG))
-
-    # grab the appropriate checkins to send pushes to by slot ID
-    start = (datetime.datetime.utcnow().replace(tzinfo=pytz.utc).astimezone(pytz.timezone('US/Eastern')) + datetime.timedelta(hours=8))
-    finish = start - datetime.timedelta(minutes=5)
-    res = db.query("""
-        SELECT DISTINCT x.start, u.lang, u.sns_id
-        FROM temporary_restrictions x
-        JOIN checkins c ON c.slot_id = ANY(x.slot_ids)
-        JOIN users u ON c.user_id = u.id
-        WHERE (x.meta = '2' OR x.meta = '3') AND x.active = true AND x.type = 'snow'
-            AND x.start > '{}' AND x.start < '{}'
-            AND c.active = true AND c.checkout_time IS NULL
-            AND u.push_on_temp = true AND u.sns_id IS NOT NULL
-            AND c.checkin_time > (NOW() - INTERVAL '14 DAYS')
-    """.format(finish.strftime('%Y-%m-%d %H:%M:%S'), start.strftime('%Y-%m-%d %H:%M:%S')))
-
-    # group device IDs by start time, then send messages
-    lang_en, lang_fr = filter(lambda x: x[1] == 'en', res), filter(lambda x: x[1] == 'fr', res)
-    data = {"en": {x: [] for x in set([z[0].isoformat() for z in lang_en])},
-        "fr": {x: [] for x in set([z[0].isoformat() for z in lang_fr])}}
-    for x in lang_en:
-        data["en"][x[0].isoformat()].append(x[2])
-    for x in lang_fr:
-        data["fr"][x[0].isoformat()].append(x[2])
-    for x in data["en"].keys():
-        dt = format_datetime(aniso8601.parse_datetime(x), u"h:mm a")
-        notifications.schedule_notifications(data["en"][x],
-            u"❄️ Attention, snow removal starts in 8 hours, at {}!".format(dt))
-    for x in data["fr"].keys():
-        dt = format_datetime(aniso8601.parse_datetime(x), u"H'h'mm", locale='fr_FR')
-        notifications.schedule_notifications(data["fr"][x],
-            u"❄️ Attention, le déneigement commence dans 8h, à {} !".format(dt))
+    CONFIG = get_config()
+    db = get_db(CONFIG)
+    r = get_redis()
+
+    # restrictions starting within eight hours that were not notified yet (start times are local)
+    until = (datetime.datetime.utcnow().replace(tzinfo=pytz.utc).astimezone(pytz.timezone('US/Eastern'))
+        + datetime.timedelta(hours=8)).replace(tzinfo=None, microsecond=0)
+    for lang, start, device_ids in snow_push_targets(db, r, "8hr", "start", until):
+        if lang == 'fr':
+            dt = format_datetime(start, u"H'h'mm", locale='fr_FR')
+            notifications.schedule_notifications(device_ids,
+                u"❄️ Attention, le déneigement commence dans 8h, à {} !".format(dt))
+        elif lang == 'en':
+            dt = format_datetime(start, u"h:mm a")
+            notifications.schedule_notifications(device_ids,
+                u"❄️ Attention, snow removal starts in 8 hours, at {}!".format(dt))
+    snow_push_done(r, "8hr", until)
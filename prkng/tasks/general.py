@@ -1,165 +1,192 @@
 # -*- coding: utf-8 -*-
 
-from prkng import create_app, notifications
-from prkng.database import PostgresWrapper
+from prkng import backup, notifications
+from prkng.analytics import METRICS
+from prkng.ingest import Fingerprints, Ingestion, point, returning
+from prkng.logger import Logger
+from prkng.tasks.scheduling import scheduled
+from prkng.tasks.worker import get_config, get_db, get_redis
 
 import boto.ses
-import boto.sns
-from boto.exception import BotoServerError
-from boto.s3.connection import S3Connection
 import datetime
+import gzip
 import json
+from multiprocessing.pool import ThreadPool
 import os
 import pytz
 import re
-from redis import Redis
+from redis.exceptions import ResponseError
 import requests
 from rq import Queue
-import subprocess
+import tempfile
+import threading
+import time
 
 
+# changes published to clients (see prkng.live), for statements on parking_lots (l)
+LOT_EVENT = returning("lot", "l", ["partner_name", "capacity", "available"])
+NEW_LOT_EVENT = returning("lot", None, ["partner_name", "capacity", "available"])
+
+
+@scheduled(300)
 def process_notifications():
-    q = Queue('medium', connection=Redis(db=1))
+    CONFIG = get_config()
+    q = Queue('medium', connection=get_redis())
     q.enqueue(hello_amazon)
-    q.enqueue(send_notifications)
+    for _ in range(CONFIG["PUSH_CONSUMERS"]):
+        q.enqueue(send_notifications)
 
+@scheduled(120)
 def update_lots():
-    q = Queue('medium', connection=Redis(db=1))
+    q = Queue('medium', connection=get_redis())
     q.enqueue(update_parkingpanda)
     q.enqueue(update_seattle_lots)
 
 
+# remove hash fields, but only those still holding the given values
+HDEL_IF_EQUAL = """
+local n = 0
+for i = 1, #ARGV, 2 do
+    if redis.call("hget", KEYS[1], ARGV[i]) == ARGV[i + 1] then
+        n = n + redis.call("hdel", KEYS[1], ARGV[i])
+    end
+end
+return n
+"""
+
+
+@scheduled(300)
 def hello_amazon():
     """
     Fetch newly-registered users' device IDs and register with Amazon SNS for push notifications.
     """
-    CONFIG = create_app().config
-    db = PostgresWrapper(
-        "host='{PG_HOST}' port={PG_PORT} dbname={PG_DATABASE} "
-        "user={PG_USERNAME} password={PG_PASSWORD} ".format(**CONFIG))
-    r = Redis(db=1)
-    amz = boto.sns.connect_to_region("us-west-2",
-        aws_access_key_id=CONFIG["AWS_ACCESS_KEY"],
-        aws_secret_access_key=CONFIG["AWS_SECRET_KEY"])
-    values = []
+    CONFIG = get_config()
+    db = get_db(CONFIG)
+    r = get_redis()
+
+    pending = [(d, uid, device_id) for d in ["ios", "ios-sbx", "android"]
+        for uid, device_id in r.hgetall('prkng:hello-amazon:'+d).items()]
+    if not pending:
+        return
 
-    # register the user's device ID with Amazon, and add to the associated notification topics
-    for d in ["ios", "ios-sbx", "android"]:
-        for x in r.hkeys('prkng:hello-amazon:'+d):
+    # boto connections can't be shared between threads
+    local = threading.local()
+
+    def register(job):
+        d, uid, device_id = job
+        if not hasattr(local, 'amz'):
+            local.amz = notifications.sns_connection(CONFIG)
+        try:
+            # create SNS platform endpoint with saved user device ID
+            arn = local.amz.create_platform_endpoint(CONFIG["AWS_SNS_APPS"][d], device_id, uid.encode('utf-8'))
+            arn = arn['CreatePlatformEndpointResponse']['CreatePlatformEndpointResult']['EndpointArn']
+        except Exception, e:
+            # if the token already exists, grab and save the existing one instead
+            arn = re.search("Endpoint (arn:aws:sns\S*)\s.?", e.message) \
+                if "already exists with the same Token" in e.message else None
+            if not arn:
+                Logger.warning("Registering device of user {} failed: {}".format(uid, e.message))
+                return job, None
+            return job, arn.group(1)
+        if not CONFIG["DEBUG"]:
+            # add the user to associated mass-push topics
             try:
-                # create SNS platform endpoint with saved user device ID, and save endpoint to DB
-                device_id = r.hget('prkng:hello-amazon:'+d, x)
-                arn = amz.create_platform_endpoint(CONFIG["AWS_SNS_APPS"][d], device_id, x.encode('utf-8'))
-                arn = arn['CreatePlatformEndpointResponse']['CreatePlatformEndpointResult']['EndpointArn']
-                values.append("({},'{}')".format(x, arn))
-                r.hdel('prkng:hello-amazon:'+d, x)
-                if not CONFIG["DEBUG"]:
-                    # add the user to associated mass-push topics
-                    amz.subscribe(CONFIG["AWS_SNS_TOPICS"]["all_users"], "application", arn)
-                    amz.subscribe(CONFIG["AWS_SNS_TOPICS"][d+"_users"], "application", arn)
+                local.amz.subscribe(CONFIG["AWS_SNS_TOPICS"]["all_users"], "application", arn)
+                local.amz.subscribe(CONFIG["AWS_SNS_TOPICS"][d+"_users"], "application", arn)
             except Exception, e:
-                # if the token already exists, grab and save the existing one instead
-                if "already exists with the same Token" in e.message:
-                    arn = re.search("Endpoint (arn:aws:sns\S*)\s.?", e.message)
-                    if not arn:
-                        continue
-                    values.append("({},'{}')".format(x, arn.group(1)))
-                    r.hdel('prkng:hello-amazon:'+d, x)
-
-    # Update the local user records with their new Amazon SNS ARNs
-    if values:
-        db.query("""
-            UPDATE users u SET sns_id = d.arn
-            FROM (VALUES {}) AS d(uid, arn)
-            WHERE u.id = d.uid
-        """.format(",".join(values)))
-
-
+                Logger.warning("Subscribing device of user {} failed: {}".format(uid, e.message))
+        return job, arn
+
+    # register the user's device ID with Amazon, and add to the associated notification topics;
+    # devices are handed out one at a time so that no thread sits idle while others have a backlog
+    started = time.time()
+    pool = ThreadPool(CONFIG["SNS_WORKERS"])
+    try:
+        done = [(job, arn) for job, arn in pool.imap_unordered(register, pending) if arn]
+    finally:
+        pool.close()
+        pool.join()
+
+    # update the local user records with their new Amazon SNS ARNs, then forget those devices,
+    # unless they were registered again in the meantime
+    if done:
+        with Ingestion(db, "hello-amazon") as run:
+            run.load("staged_arns", [("uid", "integer"), ("arn", "varchar")],
+                [(job[1], arn) for job, arn in done])
+            run.apply("update users", """
+                UPDATE users u SET sns_id = d.arn
+                FROM staged_arns d
+                WHERE u.id = d.uid AND u.sns_id IS DISTINCT FROM d.arn
+            """)
+        for d in ["ios", "ios-sbx", "android"]:
+            fields = [v for job, arn in done if job[0] == d for v in job[1:]]
+            for i in range(0, len(fields), 2000):
+                r.eval(HDEL_IF_EQUAL, 1, 'prkng:hello-amazon:'+d, *fields[i:i + 2000])
+    Logger.info("Registered {} of {} devices with SNS in {:.2f}s".format(
+        len(done), len(pending), time.time() - started))
+
+
+# as many runs at once as consumers enqueued by process_notifications
+@scheduled(300, concurrency=lambda: get_config()["PUSH_CONSUMERS"])
 def send_notifications():
     """
-    Send a push notification to specified user IDs via Amazon SNS
+    Send a push notification to specified user IDs via Amazon SNS.
+    Several of these tasks can run at once, each sending the queued chunks of devices one by one.
     """
-    CONFIG = create_app().config
-    r = Redis(db=1)
-    amz = boto.sns.connect_to_region("us-west-2",
-        aws_access_key_id=CONFIG["AWS_ACCESS_KEY"],
-        aws_secret_access_key=CONFIG["AWS_SECRET_KEY"])
-
-    keys = r.hkeys('prkng:push')
-    if not keys:
-        return
-
-    # for each message to push...
-    for pid in keys:
-        message = r.hget('prkng:push', pid)
-        r.hdel('prkng:push', pid)
-        device_ids = r.lrange('prkng:push:'+pid, 0, -1)
-        r.delete('prkng:push:'+pid)
-
-        # if the message looks like a JSON, structure it accordingly
-        message_structure = None
-        if message.startswith("{") and message.endswith("}"):
-            message_structure = "json"
-        mg_title = "message-group-{}".format(datetime.datetime.now().strftime("%Y%m%d-%H%M%S"))
-        mg_arn = None
-
-        if device_ids == ["all"]:
-            # Automatically publish messages destined for "all" via our All Users notification topic
-            amz.publish(message=message, message_structure=message_structure,
-                target_arn=CONFIG["AWS_SNS_TOPICS"]["all_users"])
-        elif device_ids == ["ios"]:
-            # Automatically publish messages destined for all iOS users
-            amz.publish(message=message, message_structure=message_structure,
-                target_arn=CONFIG["AWS_SNS_TOPICS"]["ios_users"])
-        elif device_ids == ["android"]:
-            # Automatically publish messages destined for all Android users
-            amz.publish(message=message, message_structure=message_structure,
-                target_arn=CONFIG["AWS_SNS_TOPICS"]["android_users"])
-        elif device_ids == ["en"]:
-            # Automatically publish messages destined for all English-language users
-            amz.publish(message=message, message_structure=message_structure,
-                target_arn=CONFIG["AWS_SNS_TOPICS"]["en_users"])
-        elif device_ids == ["fr"]:
-            # Automatically publish messages destined for all French-language users
-            amz.publish(message=message, message_structure=message_structure,
-                target_arn=CONFIG["AWS_SNS_TOPICS"]["fr_users"])
-
-        if len(device_ids) >= 10:
-            # If more than 10 real device IDs at once:
-            for id in device_ids:
-                if id.startswith("arn:aws:sns") and "endpoint" in id:
-                    # this is a user device ID
-                    # Create a temporary topic for a manually specified list of users
-                    if not mg_arn:
-                        mg_arn = amz.create_topic(mg_title)
-                        mg_arn = mg_arn["CreateTopicResponse"]["CreateTopicResult"]["TopicArn"]
-                    try:
-                        amz.subscribe(mg_arn, "application", id)
-                    except:
-                        continue
-                elif id.startswith("arn:aws:sns"):
-                    # this must be a topic ARN, send to it immediately
-                    amz.publish(message=message, message_structure=message_structure, target_arn=id)
-            if mg_arn:
-                # send to all user device IDs that we queued up in the prior loop
-                amz.publish(message=message, message_structure=message_structure, target_arn=mg_arn)
-        else:
-            # Less than 10 device IDs or topic ARNs. Send to them immediately
-            for id in [x for x in device_ids if x.startswith("arn:aws:sns")]:
-                try:
-                    amz.publish(message=message, message_structure=message_structure, target_arn=id)
-                except BotoServerError:
-                    continue
-
-
+    CONFIG = get_config()
+    r = get_redis()
+
+    # messages queued in the previous format, before an upgrade
+    for pid in r.hkeys('prkng:push'):
+        message, device_ids = r.hget('prkng:push', pid), r.lrange('prkng:push:'+pid, 0, -1)
+        # only one of the consumers gets to move each of them
+        if r.hdel('prkng:push', pid):
+            notifications.schedule_notifications(device_ids, message)
+            r.delete('prkng:push:'+pid)
+
+    notifications.requeue(r, CONFIG["PUSH_VISIBILITY"])
+
+    # topics of the user groups messages can be sent to
+    groups = {"all": "all_users", "ios": "ios_users", "android": "android_users",
+        "en": "en_users", "fr": "fr_users"}
+    publisher = notifications.SNSPublisher(lambda: notifications.sns_connection(CONFIG),
+        workers=CONFIG["SNS_WORKERS"], retries=CONFIG["SNS_RETRIES"],
+        backoff=CONFIG["SNS_BACKOFF"], chunk_size=CONFIG["SNS_CHUNK"])
+    try:
+        # for each chunk of devices to push a message to...
+        claimed = notifications.claim(r)
+        while claimed:
+            item, pid, message, device_ids = claimed
+            stats = {}
+            if message:
+                # if the message looks like a JSON, structure it accordingly
+                message_structure = None
+                if message.startswith("{") and message.endswith("}"):
+                    message_structure = "json"
+
+                if len(device_ids) == 1 and device_ids[0] in groups:
+                    # publish messages destined for a whole group of users via its notification topic
+                    targets = [CONFIG["AWS_SNS_TOPICS"][groups[device_ids[0]]]]
+                else:
+                    # user device endpoints and topic ARNs
+                    targets = [x for x in device_ids if x.startswith("arn:aws:sns")]
+                stats = publisher.publish(targets, message, message_structure)
+                Logger.info("Push {}: {} sent, {} failed, {} disabled endpoints, {} retries in {}s".format(
+                    pid, stats["sent"], stats["failed"], stats["disabled"], stats["retries"], stats["duration"]))
+            notifications.ack(r, item, pid, stats)
+            claimed = notifications.claim(r)
+    finally:
+        publisher.close()
+
+
+@scheduled(120)
 def update_parkingpanda():
     """
     Task to check with the Parking Panda API, update data on associated parking lots
     """
-    CONFIG = create_app().config
-    db = PostgresWrapper(
-        "host='{PG_HOST}' port={PG_PORT} dbname={PG_DATABASE} "
-        "user={PG_USERNAME} password={PG_PASSWORD} ".format(**CONFIG))
+    CONFIG = get_config()
+    db = get_db(CONFIG)
+    r = get_redis()
 
     parkingpanda_url = "https://www.parkingpanda.com/api/v2/locations" if not CONFIG["DEBUG"] else "http://dev.parkingpanda.com/api/v2/locations"
 
@@ -181,10 +208,6 @@ def update_parkingpanda():
         values = []
         # for each lot received from their API...
         for x in data:
-            x["displayName"] = x["displayName"].replace("'","''").encode("utf-8")
-            x["displayAddress"] = x["displayAddress"].replace("'","''").encode("utf-8")
-            x["description"] = x["description"].replace("'","''").encode("utf-8")
-            basic = "('{}','{}','{}',{},{},'{}','{}','SRID=4326;POINT({} {})'::geometry,'{}'::jsonb,'{}'::jsonb)"
             # if it's open 24/7, give it a standard all-open agenda
             if x["isOpen247"]:
                 agenda = {str(y): [{"max": None, "hourly": None, "daily": x["price"],
@@ -226,86 +249,91 @@ def update_parkingpanda():
             attrs = {"card": True, "indoor": "covered" in [y["name"] for y in x["amenities"]],
                 "handicap": "accessible" in [y["name"] for y in x["amenities"]],
                 "valet": "valet" in [y["name"] for y in x["amenities"]]}
-            values.append(basic.format(x["id"], city, x["displayName"], json.dumps(x["isLive"]),
-                x["availableSpaces"], x["displayAddress"], x["description"],
-                x["longitude"], x["latitude"], json.dumps(agenda), json.dumps(attrs)))
+            values.append((x["id"], x["displayName"], x["isLive"], x["availableSpaces"],
+                x["displayAddress"], x["description"], point(x["longitude"], x["latitude"]),
+                json.dumps(agenda), json.dumps(attrs)))
 
         # persist the new lots or updated ones to the database
-        if values:
-            db.query("""
-                UPDATE parking_lots l SET available = d.available, agenda = d.agenda, attrs = d.attrs,
-                    active = d.active
-                FROM (VALUES {}) AS d(pid, city, name, active, available, address, description,
-                    geom, agenda, attrs)
-                WHERE l.partner_name = 'Parking Panda'
-                    AND l.partner_id = d.pid
-            """.format(",".join(values)))
-            db.query("""
-                INSERT INTO parking_lots (partner_id, partner_name, city, name, active,
-                    available, address, description, geom, geojson, agenda, attrs, street_view)
-                SELECT d.pid, 'Parking Panda', d.city, d.name, d.active, d.available, d.address,
-                    d.description, ST_Transform(d.geom, 3857), ST_AsGeoJSON(d.geom)::jsonb,
-                    d.agenda, d.attrs, json_build_object('head', p.street_view_head, 'id', p.street_view_id)::jsonb
-                FROM (VALUES {}) AS d(pid, city, name, active, available, address, description,
-                    geom, agenda, attrs)
-                LEFT JOIN parking_lots_streetview p ON p.partner_name = 'Parking Panda' AND p.partner_id = d.pid
-                WHERE (SELECT 1 FROM parking_lots l WHERE l.partner_id = d.pid LIMIT 1) IS NULL
-            """.format(",".join(values)))
-
-
+        fp = Fingerprints(r, "parkingpanda:" + city, CONFIG["FINGERPRINT_TTL"])
+        changed = fp.diff(values, key=lambda x: x[0])
+        if changed:
+            with Ingestion(db, "parking panda " + city, r=r) as run:
+                run.load("staged_lots", [("pid", "varchar"), ("name", "varchar"), ("active", "boolean"),
+                    ("available", "integer"), ("address", "varchar"), ("description", "varchar"),
+                    ("geom", "geometry"), ("agenda", "jsonb"), ("attrs", "jsonb")],
+                    [x for x in values if unicode(x[0]) in changed])
+                run.apply("update lots", """
+                    UPDATE parking_lots l SET available = d.available, agenda = d.agenda, attrs = d.attrs,
+                        active = d.active
+                    FROM staged_lots d
+                    WHERE l.partner_name = 'Parking Panda'
+                        AND l.partner_id = d.pid
+                """ + LOT_EVENT, event="availability")
+                run.apply("insert lots", """
+                    INSERT INTO parking_lots (partner_id, partner_name, city, name, active,
+                        available, address, description, geom, geojson, agenda, attrs, street_view)
+                    SELECT d.pid, 'Parking Panda', '{city}', d.name, d.active, d.available, d.address,
+                        d.description, ST_Transform(d.geom, 3857), ST_AsGeoJSON(d.geom)::jsonb,
+                        d.agenda, d.attrs, json_build_object('head', p.street_view_head, 'id', p.street_view_id)::jsonb
+                    FROM staged_lots d
+                    LEFT JOIN parking_lots_streetview p ON p.partner_name = 'Parking Panda' AND p.partner_id = d.pid
+                    WHERE NOT EXISTS (SELECT 1 FROM parking_lots l WHERE l.partner_id = d.pid)
+                """.format(city=city) + NEW_LOT_EVENT, event="availability")
+        if changed or fp.removed:
+            fp.save()
+
+
+@scheduled(120)
 def update_seattle_lots():
     """
     Fetch Seattle parking lot data and real-time availability from City of Seattle GIS
     """
-    CONFIG = create_app().config
-    db = PostgresWrapper(
-        "host='{PG_HOST}' port={PG_PORT} dbname={PG_DATABASE} "
-        "user={PG_USERNAME} password={PG_PASSWORD} ".format(**CONFIG))
+    CONFIG = get_config()
+    db = get_db(CONFIG)
 
     # grab data from city of seattle DOT
     data = requests.get("http://web6.seattle.gov/sdot/wsvcEparkGarageOccupancy/Occupancy.asmx/GetGarageList",
         params={"prmGarageID": "G", "prmMyCallbackFunctionName": ""})
     data = json.loads(data.text.lstrip("(").rstrip(");"))
 
-    if data:
-        db.query("""
-            UPDATE parking_lots l SET available = d.available
-            FROM (VALUES {}) AS d(pid, available)
-            WHERE l.partner_name = 'Seattle ePark'
-                AND l.partner_id = d.pid
-        """.format(",".join(["('{}',{})".format(x["Id"], x["VacantSpaces"]) for x in data])))
+    fp = Fingerprints(get_redis(), "seattle", CONFIG["FINGERPRINT_TTL"])
+    changed = fp.diff(data, key=lambda x: x["Id"])
+    if changed:
+        with Ingestion(db, "seattle lots", r=fp.r) as run:
+            run.load("staged_lots", [("pid", "varchar"), ("available", "integer")],
+                [(x["Id"], x["VacantSpaces"]) for x in data if unicode(x["Id"]) in changed])
+            run.apply("update lots", """
+                UPDATE parking_lots l SET available = d.available
+                FROM staged_lots d
+                WHERE l.partner_name = 'Seattle ePark'
+                    AND l.partner_id = d.pid
+                    AND l.available IS DISTINCT FROM d.available
+            """ + LOT_EVENT, event="availability")
+    if changed or fp.removed:
+        fp.save()
 
 
+@scheduled(86400, timeout=3600)
 def run_backup():
     """
     Backs up our local database to an encrypted bucket on Amazon S3.
 
     :returns: Path to database backup in S3 (str)
     """
-    CONFIG = create_app().config
+    CONFIG = get_config()
     file_name = 'prkng-{}.sql.gz'.format(datetime.datetime.now().strftime('%Y%m%d-%H%M%S'))
-    c = S3Connection(CONFIG["AWS_ACCESS_KEY"], CONFIG["AWS_SECRET_KEY"])
-
-    # dump the DB to compressed temporary file
-    subprocess.check_call('pg_dump -c -U {PG_USERNAME} {PG_DATABASE} | gzip > {file_name}'.format(
-        file_name=os.path.join('/tmp', file_name), **CONFIG),
-        shell=True)
 
-    # upload and encrypt database dump and remove the temp file
-    b = c.get_bucket('prkng-bak')
-    k = b.initiate_multipart_upload(file_name, encrypt_key=True)
-    with open(os.path.join('/tmp', file_name), 'rb') as f:
-        k.upload_part_from_file(f, 1)
-    k.complete_upload()
-    os.unlink(os.path.join('/tmp', file_name))
-    return os.path.join('prkng-bak/', file_name)
+    # stream the compressed dump to S3 as it is produced
+    target = backup.s3_target(CONFIG, CONFIG["BACKUP_BUCKET"], file_name)
+    backup.backup(CONFIG, target)
+    return target.location
 
 
 def parking_panda_welcome_email(uname, uemail):
     """
     Send a welcome email to users that have just signed up for Parking Panda features.
     """
-    CONFIG = create_app().config
+    CONFIG = get_config()
     c = boto.ses.connect_to_region("us-west-2",
         aws_access_key_id=CONFIG["AWS_ACCESS_KEY"],
         aws_secret_access_key=CONFIG["AWS_SECRET_KEY"])
@@ -315,25 +343,86 @@ def parking_panda_welcome_email(uname, uemail):
             "", uemail, html_body=f.read().replace("{{ uname }}", uname))
 
 
+# Redis queue, staging table and columns for each type of buffered analytics record
+ANALYTICS_QUEUES = (
+    ('prkng:analytics:pos', 'analytics_pos_staging', ('user_id', 'lat', 'long', 'created', 'search_type')),
+    ('prkng:analytics:event', 'analytics_event_staging', ('user_id', 'lat', 'long', 'created', 'event')),
+    ('prkng:analytics:search', 'analytics_search_staging', ('user_id', 'query', 'created'))
+)
+
+
+def claim_queue(r, key):
+    """
+    Atomically take over the records of a Redis list, by renaming it to a processing list.
+    New records keep being pushed to the original list in the meantime.
+    If a processing list was left over by a failed run, it is returned instead, and the
+    original list waits for the next run.
+
+    :param r: Redis connection
+    :param key: name of the list (str)
+    :returns: name of the processing list (str), or None if there is nothing to process
+    """
+    processing = key + ':processing'
+    if not r.exists(processing):
+        try:
+            r.rename(key, processing)
+        except ResponseError:
+            # no such key, nothing was queued
+            return None
+    return processing
+
+
+def iter_queue(r, key, chunk_size):
+    """
+    Read a Redis list by chunks without removing its items.
+
+    :param r: Redis connection
+    :param key: name of the list (str)
+    :param chunk_size: number of items to read at once (int)
+    :returns: generator of lists of items
+    """
+    for start in xrange(0, r.llen(key), chunk_size):
+        yield r.lrange(key, start, start + chunk_size - 1)
+
+
+@scheduled(120)
 def update_analytics():
     """
     Task to push analytics submissions from Redis to DB
+
+    Each queue is renamed before being read, then copied by chunks into a staging table.
+    The queue is only deleted once its content has been moved to the analytics tables,
+    so that records are never lost if the task fails midway.
     """
-    CONFIG = create_app().config
-    db = PostgresWrapper(
-        "host='{PG_HOST}' port={PG_PORT} dbname={PG_DATABASE} "
-        "user={PG_USERNAME} password={PG_PASSWORD} ".format(**CONFIG))
-    r = Redis(db=1)
-
-    data = r.lrange('prkng:analytics:pos', 0, -1)
-    r.delete('prkng:analytics:pos')
-
-    # insert Map Location Data (positions)
-    values = ["({}, {}, {}, '{}'::timestamp, '{}')".format(x["user_id"], x["lat"], x["long"],
-        x["created"], x["search_type"]) for x in map(lambda y: json.loads(y), data)]
-    if values:
+    CONFIG = get_config()
+    db = get_db(CONFIG)
+    r = get_redis()
+
+    db.queries(["""
+        CREATE UNLOGGED TABLE IF NOT EXISTS analytics_pos_staging (
+            user_id integer, lat float, long float, created timestamp, search_type varchar)
+    ""","""
+        CREATE UNLOGGED TABLE IF NOT EXISTS analytics_event_staging (
+            user_id integer, lat float, long float, created timestamp, event varchar)
+    ""","""
+        CREATE UNLOGGED TABLE IF NOT EXISTS analytics_search_staging (
+            user_id integer, query varchar, created timestamp)
+    """])
+
+    processing = {}
+    for key, table, columns in ANALYTICS_QUEUES:
+        processing[key] = claim_queue(r, key)
+        # remove rows copied by a failed run, its queue is processed again from the start
+        db.query("TRUNCATE {}".format(table))
+        if not processing[key]:
+            continue
+        for chunk in iter_queue(r, processing[key], CONFIG["ANALYTICS_DRAIN_CHUNK"]):
+            db.copy_from('public', table, columns,
+                ([x[col] for col in columns] for x in map(lambda y: json.loads(y), chunk)))
+
+    db.queries([
         # create MultiPoint with positions that occur within five-minute increments
-        pos_query = """
+        """
             WITH tmp AS (
                 SELECT
                     user_id,
@@ -342,7 +431,7 @@ def update_analytics():
                     date_trunc('hour', created) AS hour_stump,
                     (extract(minute FROM created)::int / 5) AS min_by5,
                     ST_Collect(ST_Transform(ST_SetSRID(ST_MakePoint(long, lat), 4326), 3857)) AS geom
-                FROM (VALUES {}) AS d(user_id, lat, long, created, search_type)
+                FROM analytics_pos_staging
                 GROUP BY 1, 2, 4, 5
                 ORDER BY 1, 2, 4, 5
             )
@@ -350,15 +439,238 @@ def update_analytics():
                 SELECT user_id, geom, ST_Centroid(geom), count, hour_stump + (INTERVAL '5 MINUTES' * min_by5),
                     search_type
                 FROM tmp
-        """.format(",".join(values))
-        db.query(pos_query)
-
-    data = r.lrange('prkng:analytics:event', 0, -1)
-    r.delete('prkng:analytics:event')
-
-    # insert buffered Event data
-    if data:
-        event_query = "INSERT INTO analytics_event (user_id, lat, long, created, event) VALUES "
-        event_query += ",".join(["({}, {}, {}, '{}', '{}')".format(x["user_id"], x["lat"] or "NULL",
-            x["long"] or "NULL", x["created"], x["event"]) for x in map(lambda y: json.loads(y), data)])
-        db.query(event_query)
+        """,
+        "INSERT INTO analytics_event (user_id, lat, long, created, event) "
+        "SELECT user_id, lat, long, created, event FROM analytics_event_staging",
+        "INSERT INTO analytics_search (user_id, query, created) "
+        "SELECT user_id, query, created FROM analytics_search_staging",
+        "TRUNCATE analytics_pos_staging, analytics_event_staging, analytics_search_staging"
+    ])
+
+    # everything is safely stored, forget about the processed records
+    for key in processing.values():
+        if key:
+            r.delete(key)
+
+
+@scheduled(300)
+def update_analytics_rollups():
+    """
+    Task to maintain the daily and monthly figures of the admin dashboard.
+
+    Only the periods touched since the previous run are recomputed (plus the previous day, for
+    late records); the first run fills a year of history. Each figure is computed with a range
+    scan on the indexed time column, instead of converting the time of every row.
+    """
+    CONFIG = get_config()
+    db = get_db(CONFIG)
+    r = get_redis()
+
+    today = datetime.datetime.utcnow().replace(tzinfo=pytz.utc).astimezone(pytz.timezone('US/Eastern')).date()
+    last = r.get('prkng:analytics:rollups')
+    if last:
+        start = min(datetime.datetime.strptime(last, '%Y-%m-%d').date(), today) - datetime.timedelta(days=1)
+    else:
+        start = today - datetime.timedelta(days=400)
+
+    queries = []
+    for metric, (table, column, aggregate) in METRICS.items():
+        for period, first in [('day', start), ('month', start.replace(day=1))]:
+            queries.append("""
+                DELETE FROM analytics_rollups
+                WHERE period = '{period}' AND metric = '{metric}' AND date >= '{first}'
+            """.format(period=period, metric=metric, first=first.isoformat()))
+            queries.append("""
+                INSERT INTO analytics_rollups (period, metric, date, count)
+                SELECT '{period}', '{metric}', d.date::date, (
+                    SELECT {aggregate} FROM {table}
+                    WHERE {column} >= (d.date AT TIME ZONE 'US/Eastern') AT TIME ZONE 'UTC'
+                      AND {column} < ((d.date + INTERVAL '1 {period}') AT TIME ZONE 'US/Eastern') AT TIME ZONE 'UTC'
+                )
+                FROM generate_series('{first}'::timestamp, '{today}'::timestamp, INTERVAL '1 {period}') AS d(date)
+            """.format(period=period, metric=metric, first=first.isoformat(), today=today.isoformat(),
+                table=table, column=column, aggregate=aggregate))
+    db.queries(queries)
+    r.set('prkng:analytics:rollups', today.isoformat())
+
+
+@scheduled(300)
+def update_heatmap():
+    """
+    Task to aggregate map positions by city, hour and grid cell for the admin heatmap.
+    Hours since the previous run are recomputed, as well as the one before since
+    map positions are only moved to the database every few minutes.
+    """
+    CONFIG = get_config()
+    db = get_db(CONFIG)
+    r = get_redis()
+
+    now = datetime.datetime.now().replace(minute=0, second=0, microsecond=0)
+    last = r.get('prkng:analytics:heatmap')
+    if last:
+        start = min(datetime.datetime.strptime(last, '%Y-%m-%d %H:%M:%S'), now) - datetime.timedelta(hours=1)
+    else:
+        start = now - datetime.timedelta(days=30)
+
+    db.queries(["""
+        DELETE FROM analytics_heatmap WHERE hour >= '{start}'
+    """.format(start=start.strftime('%Y-%m-%d %H:%M:%S')), """
+        INSERT INTO analytics_heatmap (city, hour, bin_x, bin_y, long, lat, count)
+        SELECT b.city, b.hour, b.bin_x, b.bin_y, ST_X(center), ST_Y(center), b.count
+        FROM (
+            SELECT
+                coalesce(c.name, 'none') AS city,
+                date_trunc('hour', p.created) AS hour,
+                floor(ST_X(p.centerpoint) / {size})::int AS bin_x,
+                floor(ST_Y(p.centerpoint) / {size})::int AS bin_y,
+                sum(p.count) AS count
+            FROM analytics_pos p
+            LEFT JOIN cities c ON ST_Intersects(c.geom, p.centerpoint)
+            WHERE p.created >= '{start}'
+            GROUP BY 1, 2, 3, 4
+        ) AS b,
+        ST_Transform(ST_SetSRID(ST_MakePoint((b.bin_x + 0.5) * {size}, (b.bin_y + 0.5) * {size}), 3857), 4326) AS center
+    """.format(start=start.strftime('%Y-%m-%d %H:%M:%S'), size=CONFIG["HEATMAP_BIN_SIZE"])])
+    r.set('prkng:analytics:heatmap', now.strftime('%Y-%m-%d %H:%M:%S'))
+
+
+# tables split by month, and their time column (partitions copy the indexes of the
+# table declared in its model)
+PARTITIONED_TABLES = (
+    ('analytics_pos', 'created'),
+    ('analytics_event', 'created'),
+    ('analytics_search', 'created'),
+    ('checkins', 'checkin_time')
+)
+
+
+def add_months(date, months):
+    """
+    Return the first day of the month ``months`` months after the one of ``date``.
+    """
+    month = date.month - 1 + months
+    return date.replace(year=date.year + month // 12, month=month % 12 + 1, day=1)
+
+
+@scheduled(86400, timeout=600)
+def update_partitions():
+    """
+    Task to split analytics and checkins tables into monthly partitions, and archive old ones.
+
+    The current month stays in the parent table, so that inserts (and RETURNING clauses) work
+    as usual. Once a month is over, its rows are moved to a child table named like
+    `analytics_pos_y2015m11`, with a CHECK constraint on the time column so that queries with
+    a time range only scan the relevant partitions.
+
+    Partitions older than the retention set in PARTITION_RETENTION are exported to a
+    compressed file in ARCHIVE_DIRECTORY, then dropped once the file is safely on disk.
+    Nothing is dropped if ARCHIVE_DIRECTORY is not set or is on volatile storage.
+    """
+    CONFIG = get_config()
+    db = get_db(CONFIG)
+    this_month = datetime.date.today().replace(day=1)
+
+    for table, column in PARTITIONED_TABLES:
+        # move the rows of past months to their partition
+        months = db.query("""
+            SELECT DISTINCT date_trunc('month', {column})::date
+            FROM ONLY {table}
+            WHERE {column} < '{this_month}'
+        """.format(table=table, column=column, this_month=this_month))
+        for month, in months:
+            partition = '{}_y{}m{:02d}'.format(table, month.year, month.month)
+            bounds = "{column} >= '{start}' AND {column} < '{end}'".format(column=column,
+                start=month, end=add_months(month, 1))
+            queries = []
+            if not db.query("SELECT 1 FROM pg_tables WHERE tablename = '{}'".format(partition)):
+                queries.append("""
+                    CREATE TABLE {partition} (
+                        LIKE {table} INCLUDING DEFAULTS INCLUDING INDEXES,
+                        CHECK ({bounds})
+                    ) INHERITS ({table})
+                """.format(partition=partition, table=table, bounds=bounds))
+            queries.append("""
+                WITH moved AS (
+                    DELETE FROM ONLY {table} WHERE {bounds} RETURNING *
+                )
+                INSERT INTO {partition} SELECT * FROM moved
+            """.format(partition=partition, table=table, bounds=bounds))
+            db.queries(queries)
+
+        # archive and drop expired partitions
+        if CONFIG["PARTITION_RETENTION"].get(table) is None:
+            continue
+        if not persistent_directory(CONFIG["ARCHIVE_DIRECTORY"]):
+            Logger.error("Not dropping expired partitions of {}: ARCHIVE_DIRECTORY ({}) is not "
+                "a persistent directory".format(table, CONFIG["ARCHIVE_DIRECTORY"]))
+            continue
+        oldest = add_months(this_month, -CONFIG["PARTITION_RETENTION"][table])
+        partitions = db.query("""
+            SELECT c.relname
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            JOIN pg_class p ON p.oid = i.inhparent
+            WHERE p.relname = '{}'
+        """.format(table))
+        for partition, in partitions:
+            month = re.search("_y(\d{4})m(\d{2})$", partition)
+            if not month or datetime.date(int(month.group(1)), int(month.group(2)), 1) >= oldest:
+                continue
+            archive_partition(db, partition, CONFIG["ARCHIVE_DIRECTORY"])
+            db.query("DROP TABLE {}".format(partition))
+
+
+def persistent_directory(path):
+    """
+    Check that a directory can hold archives: it exists, and is neither in the temporary
+    directory nor on a memory-backed filesystem, which are emptied on reboot.
+
+    :param path: path of the directory (str)
+    :returns: bool
+    """
+    if not path or not os.path.isdir(path):
+        return False
+    path = os.path.realpath(path)
+    for tmp in set([tempfile.gettempdir(), '/tmp', '/var/tmp', '/dev/shm']):
+        tmp = os.path.realpath(tmp)
+        if path == tmp or path.startswith(tmp + os.sep):
+            return False
+    # filesystem of the closest mount point
+    fstype, mountpoint = None, ''
+    with open('/proc/mounts') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) < 3:
+                continue
+            if (path == fields[1] or path.startswith(fields[1].rstrip(os.sep) + os.sep)) \
+                    and len(fields[1]) > len(mountpoint):
+                fstype, mountpoint = fields[2], fields[1]
+    return fstype not in ('tmpfs', 'ramfs')
+
+
+def archive_partition(db, partition, directory):
+    """
+    Export a partition to a compressed file in COPY text format, and make sure the file is
+    written to disk. The file is only given its final name (`<partition>.copy.gz`) once complete.
+
+    :param db: PostgresWrapper instance
+    :param partition: table name (str)
+    :param directory: archive directory (str)
+    :returns: path of the archive (str)
+    """
+    path = os.path.join(directory, '{}.copy.gz'.format(partition))
+    with open(path + '.part', 'wb') as raw:
+        f = gzip.GzipFile(filename='{}.copy'.format(partition), mode='wb', fileobj=raw)
+        try:
+            db.copy_to(partition, f)
+        finally:
+            f.close()
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.rename(path + '.part', path)
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    return path
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+Guards around the periodic tasks.
+
+rq-scheduler enqueues tasks at fixed intervals whether or not the previous run
+is over. Tasks decorated with :func:`scheduled` take a Redis lock while they run,
+so that a run starting while another one holds the lock is skipped instead of
+fighting over the same rows. The lock expires after the task timeout in case the
+worker died without releasing it. Tasks meant to run several at once (such as the
+consumers of a queue) get as many locks as runs allowed at the same time.
+
+When a task takes longer than its interval allows, the next runs are deferred
+(with some jitter, so that slow tasks don't all come back at once) until
+``RUNTIME_FACTOR`` times its average runtime has passed. Each run is recorded in
+a capped history that the admin can query (see :func:`status`).
+"""
+import datetime
+import functools
+import json
+import random
+import time
+import uuid
+
+from prkng.logger import Logger
+from prkng.tasks.worker import get_redis
+
+
+# number of runs kept in the history of each task
+HISTORY_LENGTH = 100
+# a task runs at most once every RUNTIME_FACTOR times its average runtime
+RUNTIME_FACTOR = 2
+# weight of the last run in the average runtime
+RUNTIME_WEIGHT = 0.3
+# seconds a lock outlives the task timeout
+LOCK_MARGIN = 60
+
+# delete the lock only if it is still ours
+RELEASE_LOCK = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+def key(name, kind=None):
+    """
+    Redis key of a task: its state hash, or its ``lock`` / ``history``.
+    """
+    return "prkng:tasks:{}:{}".format(kind, name) if kind else "prkng:tasks:" + name
+
+
+def scheduled(interval, timeout=180, jitter=0.2, concurrency=1):
+    """
+    Decorator for periodic tasks, see the module documentation.
+
+    :param interval: seconds between runs (int)
+    :param timeout: max seconds a run may take, given to rq as the job timeout (int)
+    :param jitter: max fraction of the delay added at random to deferred runs (float)
+    :param concurrency: runs allowed at the same time, or a function returning it,
+        called at each run (int)
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            runs = concurrency() if callable(concurrency) else concurrency
+            return run(get_redis(), func, interval, timeout, jitter, args, kwargs, runs)
+        wrapper.interval = interval
+        wrapper.timeout = timeout
+        return wrapper
+    return decorator
+
+
+def lock_key(name, slot=0):
+    """
+    Redis key of one of the locks of a task (the first one is the ``lock`` key).
+    """
+    return key(name, "lock") + (":{}".format(slot) if slot else "")
+
+
+def run(r, func, interval, timeout, jitter, args, kwargs, concurrency=1):
+    """
+    Run a task under the first of its locks that is free, and record the outcome.
+    """
+    name = func.__name__
+    started = time.time()
+    state = r.hgetall(key(name))
+    if float(state.get("next_run") or 0) > started:
+        Logger.info("Deferring {} until {}".format(name, _isoformat(state["next_run"])))
+        return
+
+    token = uuid.uuid4().hex
+    for slot in range(max(concurrency, 1)):
+        if r.set(lock_key(name, slot), token, nx=True, ex=timeout + LOCK_MARGIN):
+            break
+    else:
+        Logger.warning("Skipping {}: the previous run is not over".format(name))
+        record(r, name, interval, timeout, started, "skipped")
+        return
+
+    outcome, error = "failed", None
+    try:
+        res = func(*args, **kwargs)
+        outcome = "ok"
+        return res
+    except Exception as e:
+        error = "{}: {}".format(e.__class__.__name__, e)
+        raise
+    finally:
+        r.eval(RELEASE_LOCK, 1, lock_key(name, slot), token)
+        runtime = time.time() - started
+        average = runtime
+        if state.get("runtime"):
+            average = RUNTIME_WEIGHT * runtime + (1 - RUNTIME_WEIGHT) * float(state["runtime"])
+        next_run = 0
+        if average * RUNTIME_FACTOR > interval:
+            next_run = started + average * RUNTIME_FACTOR * (1 + random.uniform(0, jitter))
+        record(r, name, interval, timeout, started, outcome, runtime, average, next_run, error)
+
+
+def record(r, name, interval, timeout, started, outcome, runtime=None, average=None,
+           next_run=None, error=None):
+    """
+    Add a run to the history of a task and update its state.
+    """
+    run = {"started": _isoformat(started), "outcome": outcome, "runtime": runtime, "error": error}
+    state = {"interval": interval, "timeout": timeout, "last_outcome": outcome}
+    if runtime is not None:
+        state.update(runtime=average, next_run=next_run)
+    pipe = r.pipeline()
+    pipe.sadd("prkng:tasks", name)
+    pipe.hmset(key(name), state)
+    pipe.lpush(key(name, "history"), json.dumps(run))
+    pipe.ltrim(key(name, "history"), 0, HISTORY_LENGTH - 1)
+    pipe.execute()
+
+
+def status(r, count=20):
+    """
+    Get the state and last runs of every task that ran at least once.
+
+    :param r: Redis connection
+    :param count: number of runs to return for each task (int)
+    :returns: list of dicts
+    """
+    names = sorted(r.smembers("prkng:tasks"))
+    pipe = r.pipeline(transaction=False)
+    for name in names:
+        pipe.hgetall(key(name))
+        pipe.exists(key(name, "lock"))
+        pipe.lrange(key(name, "history"), 0, count - 1)
+    res = pipe.execute()
+    tasks = []
+    for i, name in enumerate(names):
+        state, running, history = res[i * 3:i * 3 + 3]
+        tasks.append({
+            "name": name,
+            "interval": int(state.get("interval", 0)),
+            "timeout": int(state.get("timeout", 0)),
+            "running": bool(running),
+            "runtime": float(state["runtime"]) if state.get("runtime") else None,
+            "next_run": _isoformat(state["next_run"]) if float(state.get("next_run") or 0) else None,
+            "last_outcome": state.get("last_outcome"),
+            "history": [json.loads(x) for x in history]
+        })
+    return tasks
+
+
+def _isoformat(ts):
+    return datetime.datetime.utcfromtimestamp(float(ts)).isoformat()
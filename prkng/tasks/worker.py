@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Configuration and connections shared by the tasks run in a worker process.
+
+The app configuration is loaded once per process, and the database connection
+opened by a task is kept (one per thread) and handed to the next tasks after a
+health check: a transaction left open by a failed task is rolled back, and a
+connection unused for a while is checked with a query, then opened again if it
+is broken. Connections are counted per process in Redis (see :func:`stats`).
+
+This needs the worker to run jobs in its own process, as rq's SimpleWorker does
+(see contrib/rq-worker.conf); the default worker forks a child for each job,
+which then starts from scratch.
+"""
+import os
+import socket
+import threading
+import time
+
+import psycopg2
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from redis import Redis
+from redis.exceptions import RedisError
+
+from prkng import create_app
+from prkng.database import PostgresWrapper
+
+
+# seconds a connection may stay unused before it is checked with a query
+CHECK_AFTER = 60
+# seconds the counters of a worker process outlive its last task
+STATS_TTL = 86400
+
+_config = None
+_redis = None
+_lock = threading.Lock()
+_local = threading.local()
+
+
+def get_config():
+    """
+    Get the app configuration, loaded once per process.
+
+    :returns: dict
+    """
+    global _config
+    if _config is None:
+        with _lock:
+            if _config is None:
+                _config = create_app().config
+    return _config
+
+
+def get_redis():
+    """
+    Get the Redis connection of the process (with its own connection pool).
+
+    :returns: Redis connection
+    """
+    global _redis
+    if _redis is None:
+        with _lock:
+            if _redis is None:
+                _redis = Redis(db=1)
+    return _redis
+
+
+def get_db(CONFIG=None):
+    """
+    Get the database connection of the current thread, opening it if needed.
+
+    :param CONFIG: app configuration, default :func:`get_config` (dict)
+    :returns: PostgresWrapper instance
+    """
+    started = time.time()
+    db = getattr(_local, 'db', None)
+    event = "reused"
+    if db is not None and _local.pid != os.getpid():
+        # opened before a fork, it belongs to the parent process
+        db, event = None, "connected"
+    elif db is not None and not healthy(db, _local.used):
+        try:
+            db.db.close()
+        except psycopg2.Error:
+            pass
+        db, event = None, "reconnected"
+    if db is None:
+        CONFIG = CONFIG or get_config()
+        db = PostgresWrapper(
+            "host='{PG_HOST}' port={PG_PORT} dbname={PG_DATABASE} "
+            "user={PG_USERNAME} password={PG_PASSWORD} ".format(**CONFIG))
+        if event == "reused":
+            event = "connected"
+    _local.db, _local.pid, _local.used = db, os.getpid(), time.time()
+    record(get_redis(), event, time.time() - started)
+    return db
+
+
+def healthy(db, used):
+    """
+    Check a connection before handing it to a task.
+
+    :param db: PostgresWrapper instance
+    :param used: time it was last handed to a task (epoch)
+    :returns: True if it can be used
+    """
+    conn = db.db
+    if conn.closed:
+        return False
+    try:
+        if conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            # left in a transaction by a task that failed
+            conn.rollback()
+        if time.time() - used > CHECK_AFTER:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            conn.rollback()
+    except psycopg2.Error:
+        return False
+    return True
+
+
+def worker_name():
+    return "{}:{}".format(socket.gethostname(), os.getpid())
+
+
+def record(r, event, seconds):
+    """
+    Count a connection request of this process.
+
+    :param r: Redis connection
+    :param event: "connected", "reused" or "reconnected" (str)
+    :param seconds: time spent getting the connection (float)
+    """
+    name = "prkng:tasks:workers:" + worker_name()
+    try:
+        pipe = r.pipeline(transaction=False)
+        pipe.sadd("prkng:tasks:workers", name)
+        pipe.hincrby(name, event, 1)
+        pipe.hincrbyfloat(name, "seconds", seconds)
+        pipe.expire(name, STATS_TTL)
+        pipe.execute()
+    except RedisError:
+        # counters are not worth failing a task
+        pass
+
+
+def stats(r):
+    """
+    Get the connection counters of the worker processes that ran a task recently.
+
+    :param r: Redis connection
+    :returns: list of dicts
+    """
+    names = sorted(r.smembers("prkng:tasks:workers"))
+    pipe = r.pipeline(transaction=False)
+    for name in names:
+        pipe.hgetall(name)
+    workers = []
+    for name, counters in zip(names, pipe.execute()):
+        if not counters:
+            # expired, the process is gone
+            r.srem("prkng:tasks:workers", name)
+            continue
+        workers.append({
+            "name": name.split(":", 3)[3],
+            "connected": int(counters.get("connected", 0)),
+            "reused": int(counters.get("reused", 0)),
+            "reconnected": int(counters.get("reconnected", 0)),
+            "seconds": round(float(counters.get("seconds", 0)), 3)
+        })
+    return workers
@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+"""
+Fakes of Redis and of the database connection shared by the tests that run without servers.
+"""
+import math
+
+import pytest
+from psycopg2 import OperationalError
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from redis.exceptions import ResponseError
+
+
+def _str(value):
+    # Redis only stores byte strings
+    return value.encode('utf-8') if isinstance(value, unicode) else str(value)
+
+
+class FakeRedis(object):
+    """
+    Just enough of Redis for the tests, all in ``data`` (key -> str, dict, list or set;
+    sorted sets are dicts of member -> score).
+
+    Lua scripts are played by the Python functions in ``scripts`` (script -> function taking
+    the instance, the keys and the arguments), geo commands go through ``execute_command``
+    unless ``geo`` is False (Redis < 3.2), and pubsub gets the ``messages``.
+    """
+    def __init__(self, geo=True, messages=None):
+        self.data = {}
+        self.scripts = {}
+        self.geo = geo
+        self.messages = messages or []
+        self.published = []
+        self.pubsub_ = None
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    # keys
+
+    def exists(self, key):
+        return key in self.data
+
+    def delete(self, *keys):
+        return len([self.data.pop(k) for k in keys if k in self.data])
+
+    def rename(self, src, dst):
+        self.data[dst] = self.data.pop(src)
+        return True
+
+    def expire(self, key, ttl):
+        return key in self.data
+
+    # strings
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None, px=None, nx=False, xx=False):
+        if nx and key in self.data:
+            return None
+        self.data[key] = _str(value)
+        return True
+
+    # hashes
+
+    def hset(self, key, field, value):
+        h = self.data.setdefault(key, {})
+        new = _str(field) not in h
+        h[_str(field)] = _str(value)
+        return int(new)
+
+    def hget(self, key, field):
+        return self.data.get(key, {}).get(_str(field))
+
+    def hgetall(self, key):
+        return dict(self.data.get(key, {}))
+
+    def hmset(self, key, mapping):
+        self.data.setdefault(key, {}).update({_str(k): _str(v) for k, v in mapping.items()})
+        return True
+
+    def hmget(self, key, fields):
+        return [self.data.get(key, {}).get(_str(x)) for x in fields]
+
+    def hincrby(self, key, field, value=1):
+        h = self.data.setdefault(key, {})
+        h[_str(field)] = str(int(h.get(_str(field), 0)) + value)
+        return int(h[_str(field)])
+
+    def hincrbyfloat(self, key, field, value=1.0):
+        h = self.data.setdefault(key, {})
+        h[_str(field)] = str(float(h.get(_str(field), 0)) + value)
+        return float(h[_str(field)])
+
+    # lists
+
+    def lpush(self, key, *values):
+        l = self.data.setdefault(key, [])
+        for value in values:
+            l.insert(0, _str(value))
+        return len(l)
+
+    def ltrim(self, key, start, end):
+        self.data[key] = self.data.get(key, [])[start:None if end == -1 else end + 1]
+        return True
+
+    def lrange(self, key, start, end):
+        return self.data.get(key, [])[start:None if end == -1 else end + 1]
+
+    # sets
+
+    def sadd(self, key, *values):
+        s = self.data.setdefault(key, set())
+        count = len(s)
+        s.update(_str(x) for x in values)
+        return len(s) - count
+
+    def srem(self, key, *values):
+        s = self.data.get(key, set())
+        count = len(s)
+        s.difference_update(_str(x) for x in values)
+        return count - len(s)
+
+    def smembers(self, key):
+        return set(self.data.get(key, ()))
+
+    # sorted sets
+
+    def zadd(self, key, **pairs):
+        z = self.data.setdefault(key, {})
+        count = len(z)
+        z.update(pairs)
+        return len(z) - count
+
+    def zremrangebyscore(self, key, low, high):
+        z = self.data.get(key, {})
+        removed = [k for k, v in z.items() if _score(low) <= v <= _score(high)]
+        for k in removed:
+            del z[k]
+        return len(removed)
+
+    def zrangebyscore(self, key, low, high, withscores=False):
+        res = sorted(((k, v) for k, v in self.data.get(key, {}).items()
+            if _score(low) <= v <= _score(high)), key=lambda x: x[1])
+        return res if withscores else [k for k, v in res]
+
+    # pubsub
+
+    def publish(self, channel, message):
+        self.published.append((channel, message))
+        return 1
+
+    def pubsub(self, ignore_subscribe_messages=False):
+        if self.pubsub_ is None:
+            self.pubsub_ = FakePubSub(self.messages)
+        return self.pubsub_
+
+    # scripting
+
+    def eval(self, script, numkeys, *args):
+        return self.scripts[script](self, args[:numkeys], args[numkeys:])
+
+    # geo, GEORADIUS in meters and ASC only
+
+    def execute_command(self, cmd, key, *args):
+        if not self.geo:
+            raise ResponseError("unknown command '{}'".format(cmd))
+        if cmd == "GEOADD":
+            points = self.data.setdefault(key, {})
+            for i in range(0, len(args), 3):
+                points[_str(args[i + 2])] = (args[i], args[i + 1])
+            return len(args) / 3
+        elif cmd == "GEORADIUS":
+            x, y, radius = args[:3]
+            dist = lambda p: 6372797.56 * 2 * math.asin(math.sqrt(
+                math.sin(math.radians(p[1] - y) / 2) ** 2 + math.cos(math.radians(y)) *
+                math.cos(math.radians(p[1])) * math.sin(math.radians(p[0] - x) / 2) ** 2))
+            found = [(dist(p), m) for m, p in self.data.get(key, {}).items() if dist(p) <= radius]
+            return [m for d, m in sorted(found)]
+        raise ResponseError("unknown command '{}'".format(cmd))
+
+
+def _score(value):
+    return {'-inf': float('-inf'), '+inf': float('inf')}.get(value, value)
+
+
+class FakePipeline(object):
+    """
+    Commands are run at once, their results returned by ``execute``.
+    """
+    def __init__(self, r):
+        self.r, self.results = r, []
+
+    def __getattr__(self, name):
+        command = getattr(self.r, name)
+        return lambda *args, **kwargs: self.results.append(command(*args, **kwargs))
+
+    def execute(self):
+        res, self.results = self.results, []
+        return res
+
+
+class FakePubSub(object):
+    def __init__(self, messages):
+        self.messages = messages
+        self.channels = []
+        self.closed = False
+
+    def subscribe(self, name):
+        self.channels.append(name)
+
+    def get_message(self, timeout=0):
+        return self.messages.pop(0) if self.messages else None
+
+    def close(self):
+        self.closed = True
+
+
+class FakeCursor(object):
+    """
+    Records the statements executed and the data copied (table -> (data, columns)).
+    """
+    def __init__(self):
+        self.statements, self.copied = [], {}
+        self.query, self.rowcount = None, 0
+
+    def execute(self, stmt, args=None):
+        self.statements.append(stmt)
+        self.query = stmt
+
+    def copy_from(self, f, table, columns=None):
+        self.copied[table] = (f.read(), columns)
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+    """
+    psycopg2 connection, which fails to roll back once ``broken``.
+    """
+    def __init__(self):
+        self.cursor_ = FakeCursor()
+        self.closed = 0
+        self.status = TRANSACTION_STATUS_IDLE
+        self.commits = self.rollbacks = 0
+        self.broken = False
+
+    def cursor(self, cursor_factory=None):
+        return self.cursor_
+
+    def get_transaction_status(self):
+        return self.status
+
+    def commit(self):
+        self.commits += 1
+        self.status = TRANSACTION_STATUS_IDLE
+
+    def rollback(self):
+        if self.broken:
+            raise OperationalError("server closed the connection unexpectedly")
+        self.rollbacks += 1
+        self.status = TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = 1
+
+
+class FakeWrapper(object):
+    """
+    PostgresWrapper over a :class:`FakeConnection`.
+    """
+    def __init__(self, connect_string=None):
+        self.db = FakeConnection()
+
+
+@pytest.fixture
+def fake_redis():
+    """
+    Make FakeRedis instances: ``fake_redis()``, ``fake_redis(geo=False)``...
+    """
+    return FakeRedis
+
+
+@pytest.fixture
+def fake_db():
+    """
+    Make fake PostgresWrapper instances, usable in place of the class.
+    """
+    return FakeWrapper
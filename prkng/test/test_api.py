@@ -7,9 +7,12 @@ import pytest
 
 from flask import g
 
-from prkng import create_app
+from prkng import create_app, passwords
+from prkng.database import PostgresWrapper
+from prkng.geoindex import store
+from prkng.ingest import Ingestion, point
 from prkng.api.public import init_api, v1
-from prkng.models import db, init_model, User, metadata
+from prkng.models import db, init_model, Carshares, User, UserAuth, metadata
 from prkng.login import init_login
 
 
@@ -187,6 +190,21 @@ def test_api_loginemail_badpass(client):
     assert resp.status_code == 401
 
 
+def test_api_loginfacebook_ok(client):
+    resp = client.post('/v1/login', data=dict(
+        type='facebook',
+        access_token='facebook-test-token'))
+    assert json.loads(resp.data)['email'] == 'facebook@prk.ng'
+    assert resp.status_code == 200
+
+
+def test_api_loginfacebook_badtoken(client):
+    resp = client.post('/v1/login', data=dict(
+        type='facebook',
+        access_token='expired-token'))
+    assert resp.status_code == 400
+
+
 def test_api_update_profile(client):
     resp = client.put('/v1/user/profile', data=dict(
         email='test@prk.ng',
@@ -196,6 +214,24 @@ def test_api_update_profile(client):
     assert resp.status_code == 200
 
 
+def test_api_update_profile_busy(client, monkeypatch):
+    auth_id = 'email${}'.format(g.user.id)
+    if not UserAuth.exists(auth_id):
+        UserAuth.add_userauth(user_id=g.user.id, name=g.user.name, auth_id=auth_id, email=g.user.email,
+            auth_type='email', password=passwords.encrypt('password'))
+
+    def busy(password):
+        raise passwords.PasswordPoolBusy()
+    monkeypatch.setattr(passwords, 'encrypt', busy)
+    resp = client.put('/v1/user/profile', data=dict(
+        name='Busy User',
+        password='newpassword'),
+        headers={'X-API-KEY': g.user.apikey})
+    assert resp.status_code == 503
+    # nothing was changed, the request can be retried as a whole
+    assert User.get(g.user.id).name != 'Busy User'
+
+
 def test_api_generate_s3_url(client):
     resp = client.post('/v1/images', data=dict(
         image_type='avatar',
@@ -221,3 +257,58 @@ def test_submit_report_no_slot(client):
         image_url='http://prk.ng/img/logo.png'),
         headers={'X-API-KEY': g.user.apikey})
     assert resp.status_code == 201
+
+
+def test_snap_true_distance(app):
+    # the long slot passes 1 m from the car, but its bounding box center is 450 m away;
+    # the short one is 2 m away, its bounding box center too
+    conn = PostgresWrapper(
+        "host='{PG_TEST_HOST}' port={PG_TEST_PORT} dbname={PG_TEST_DATABASE} "
+        "user={PG_TEST_USERNAME} password={PG_TEST_PASSWORD} ".format(**app.config))
+    long_slot, short_slot = [x[0] for x in conn.query("""
+        INSERT INTO slots (city, geom) VALUES
+            ('snaptest', 'SRID=3857;LINESTRING(100 0, 1000 0)'::geometry),
+            ('snaptest', 'SRID=3857;LINESTRING(100 3, 101 3)'::geometry)
+        RETURNING id
+    """)]
+    lon, lat = conn.query("""
+        SELECT ST_X(g), ST_Y(g) FROM ST_Transform('SRID=3857;POINT(100 1)'::geometry, 4326) g
+    """)[0]
+    try:
+        with Ingestion(conn, 'test') as run:
+            run.load("staged_cars", [("vin", "varchar"), ("city", "varchar"), ("geom", "geometry")],
+                [('snap1', 'snaptest', point(lon, lat))])
+            run.snap("staged_cars", "test")
+            run.cur.execute("SELECT slot_id FROM staged_cars")
+            assert run.cur.fetchall() == [(long_slot,)]
+    finally:
+        conn.query("DELETE FROM slots WHERE city = 'snaptest'")
+
+
+def test_carshares_within_radius(app, fake_redis, monkeypatch):
+    # cars 900 m and 1100 m east of the point searched, found alike from the index and the database
+    x, y = -73.56, 45.5
+    ids = [row[0] for row in db.engine.execute("""
+        INSERT INTO carshares (city, company, vin, name, parked, geom, geojson)
+        SELECT 'radiustest', 'car2go', 'radius' || d, 'radius' || d, true, g,
+            ST_AsGeoJSON(ST_Transform(g, 4326))::jsonb
+        FROM unnest(ARRAY[900, 1100]) AS d,
+            ST_Transform(ST_Project('SRID=4326;POINT({x} {y})'::geography, d, radians(90))::geometry,
+                3857) AS g
+        RETURNING id
+    """.format(x=x, y=y))]
+    try:
+        monkeypatch.setattr(db, 'redis', fake_redis(geo=False))
+        from_db = Carshares.get_within('radiustest', x, y, 1000)
+
+        rows = db.engine.execute("""
+            SELECT 'c:' || id, ST_X(ST_Transform(geom, 4326)), ST_Y(ST_Transform(geom, 4326)), {}
+            FROM carshares WHERE city = 'radiustest'
+        """.format(", ".join(Carshares.properties))).fetchall()
+        monkeypatch.setattr(db, 'redis', fake_redis())
+        store(db.redis, 'carshares', 'radiustest', [(r[0], r[1], r[2], list(r[3:])) for r in rows], 600)
+        from_index = Carshares.get_within('radiustest', x, y, 1000)
+
+        assert [r[0] for r in from_db] == [r[0] for r in from_index] == ids[:1]
+    finally:
+        db.engine.execute("DELETE FROM carshares WHERE city = 'radiustest'")
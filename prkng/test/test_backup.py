@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+import gzip
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import zlib
+
+import pytest
+
+from ..backup import DirectoryTarget, S3Target, TABLE_DATA, filter_toc, stream
+
+
+class FakeS3(object):
+    """
+    Multipart uploads kept in memory, recording the thread using each connection.
+    Parts are written with boto's MultiPartUpload, which only needs new_key from the bucket.
+    """
+    def __init__(self, fail_part=None):
+        self.fail_part = fail_part
+        self.connections = []
+        self.uploads = {}
+        self.objects = {}
+        self.cancelled = []
+        self.lock = threading.Lock()
+
+    def connect(self):
+        conn = FakeS3Connection(self)
+        with self.lock:
+            self.connections.append(conn)
+        return conn
+
+
+class FakeS3Connection(object):
+    def __init__(self, s3):
+        self.s3 = s3
+        self.threads = set()
+
+    def get_bucket(self, name, validate=True):
+        return FakeS3Bucket(self, name)
+
+
+class FakeS3Bucket(object):
+    def __init__(self, connection, name):
+        self.connection = connection
+        self.s3 = connection.s3
+        self.name = name
+
+    def initiate_multipart_upload(self, key_name, encrypt_key=False):
+        upload = FakeS3Upload(self, key_name, "upload-{}".format(len(self.s3.uploads) + 1))
+        self.s3.uploads[upload.id] = {}
+        return upload
+
+    def new_key(self, key_name):
+        return FakeS3Key(self, key_name)
+
+
+class FakeS3Key(object):
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+
+    def set_contents_from_file(self, fp, query_args=None, size=None, **kwargs):
+        s3 = self.bucket.s3
+        self.bucket.connection.threads.add(threading.current_thread().ident)
+        args = dict(x.split('=') for x in query_args.split('&'))
+        num = int(args['partNumber'])
+        if num == s3.fail_part:
+            raise IOError("connection reset")
+        with s3.lock:
+            s3.uploads[args['uploadId']][num] = (self.bucket.name, self.name, fp.read(size))
+
+
+class FakeS3Upload(object):
+    def __init__(self, bucket, key_name, id):
+        self.bucket = bucket
+        self.key_name = key_name
+        self.id = id
+
+    def complete_upload(self):
+        parts = self.bucket.s3.uploads.pop(self.id)
+        assert sorted(parts) == range(1, len(parts) + 1)
+        assert set(x[:2] for x in parts.values()) == set([(self.bucket.name, self.key_name)])
+        self.bucket.s3.objects[(self.bucket.name, self.key_name)] = \
+            "".join(parts[x][2] for x in sorted(parts))
+
+    def cancel_upload(self):
+        self.bucket.s3.uploads.pop(self.id)
+        self.bucket.s3.cancelled.append(self.id)
+
+
+def test_stream_to_directory():
+    directory = tempfile.mkdtemp()
+    try:
+        target = DirectoryTarget(directory, 'dump.sql.gz')
+        stats = stream([sys.executable, '-c', 'import os, sys; sys.stdout.write(os.urandom(300000))'],
+            target, part_size=50000, uploads=3)
+        assert stats['parts'] == 7
+        assert stats['bytes'] == os.path.getsize(target.location)
+        assert os.listdir(directory) == ['dump.sql.gz']
+        with gzip.open(target.location, 'rb') as f:
+            assert len(f.read()) == 300000
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_stream_failure():
+    directory = tempfile.mkdtemp()
+    try:
+        target = DirectoryTarget(directory, 'dump.sql.gz')
+        with pytest.raises(subprocess.CalledProcessError):
+            stream([sys.executable, '-c', 'import sys; sys.stdout.write("x" * 100000); sys.exit(1)'],
+                target, part_size=1000)
+        assert os.listdir(directory) == []
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_stream_to_s3():
+    s3 = FakeS3()
+    target = S3Target(s3.connect, 'backups', 'dump.sql.gz')
+    stats = stream([sys.executable, '-c', 'import os, sys; sys.stdout.write(os.urandom(300000))'],
+        target, part_size=50000, uploads=3)
+    assert stats['parts'] == 7
+    assert s3.uploads == {} and s3.cancelled == []
+    data = s3.objects[('backups', 'dump.sql.gz')]
+    assert len(data) == stats['bytes']
+    assert len(zlib.decompress(data, 16 + zlib.MAX_WBITS)) == 300000
+    # one connection to initiate the upload, then at most one per uploading thread
+    assert 2 <= len(s3.connections) <= 4
+    assert all(len(x.threads) <= 1 for x in s3.connections)
+
+
+def test_stream_to_s3_failure():
+    s3 = FakeS3(fail_part=3)
+    target = S3Target(s3.connect, 'backups', 'dump.sql.gz')
+    with pytest.raises(IOError):
+        stream([sys.executable, '-c', 'import os, sys; sys.stdout.write(os.urandom(300000))'],
+            target, part_size=50000, uploads=3)
+    assert s3.cancelled == ['upload-1']
+    assert s3.uploads == {} and s3.objects == {}
+
+
+def test_filter_toc():
+    toc = [
+        ';',
+        '; Selected TOC Entries:',
+        '2011; 1259 16386 TABLE public slots prkng',
+        '2012; 1259 16390 TABLE public analytics_pos_201501 prkng',
+        '3301; 0 16386 TABLE DATA public slots prkng',
+        '3302; 0 16390 TABLE DATA public analytics_pos_201501 prkng',
+        '3303; 0 16394 TABLE DATA public analytics_event_201501 prkng',
+        '3400; 1259 16400 INDEX public analytics_pos_201501_created_idx prkng'
+    ]
+    assert filter_toc(toc, exclude=['analytics_*']) == toc[:5] + toc[7:]
+    assert filter_toc(toc, include=['analytics_pos_*']) == toc[:4] + toc[5:6] + toc[7:]
+
+
+def test_verbose_table_lines():
+    lines = [
+        'pg_dump: dumping contents of table public.slots',
+        'pg_dump: dumping contents of table "public.slots"',
+        'pg_restore: processing data for table "slots"',
+        'pg_restore: finished item 3301 TABLE DATA slots'
+    ]
+    assert [TABLE_DATA.search(x).group(1).split('.')[-1] for x in lines] == ['slots'] * 4
+    assert TABLE_DATA.search('pg_dump: reading indexes for table "public.slots"') is None
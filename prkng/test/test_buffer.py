@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from ..buffer import WriteBehindBuffer
+
+
+def test_buffer_drops_oldest():
+    written = []
+    buf = WriteBehindBuffer(written.extend, maxlen=3, batch_size=10, interval=60)
+    for x in range(5):
+        buf.add(x)
+    buf.drain()
+    assert written == [2, 3, 4]
+    assert buf.stats()['dropped'] == 2
+    assert buf.stats()['flushed'] == 3
+
+
+def test_buffer_counts_failures():
+    def flush(records):
+        raise ValueError()
+    buf = WriteBehindBuffer(flush, maxlen=10, batch_size=10, interval=60)
+    buf.add(1)
+    buf.drain()
+    assert buf.stats()['failed'] == 1
+    assert buf.stats()['pending'] == 0
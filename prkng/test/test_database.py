@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from ..database import copy_line, mercator_distance, nearest
+
+
+def test_copy_line():
+    assert copy_line([1, None, 0, u'Café', 45.48420949674474]) == \
+        '1\t\\N\t0\tCaf\xc3\xa9\t45.48420949674474\n'
+
+
+def test_copy_line_escapes():
+    assert copy_line(['a\tb', 'c\nd', 'e\\f']) == 'a\\tb\tc\\nd\te\\\\f\n'
+
+
+def test_nearest():
+    qry = nearest("carshares c", ["c.id", "1 AS quantity"], -73.5, 45.5, 3,
+        where="c.parked = true", max_distance=500, geom="c.geom", key="c.id")
+    assert "SELECT id, quantity FROM" in qry
+    assert "ORDER BY c.geom <-> ST_Transform('SRID=4326;POINT(-73.5 45.5)'::geometry, 3857)" in qry
+    assert "(c.parked = true) AND ST_DWithin(c.geom" in qry
+    assert ", {})".format(mercator_distance(500, 45.5)) in qry
+    assert "ORDER BY knn_distance, knn_key" in qry
+    assert "LIMIT 13" in qry and "LIMIT 3" in qry
+
+
+def test_mercator_distance():
+    assert mercator_distance(1000, 0) == 1000
+    assert round(mercator_distance(1000, 45.5), 1) == 1426.7
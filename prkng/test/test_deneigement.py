@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+from cStringIO import StringIO
+import json
+
+from ..stubs import InfoNeigeStub
+from ..tasks.deneigement import get_client, parse_planifications, planification_row
+
+
+PLANIFICATIONS = [
+    {'munid': 1, 'coteRueId': 10, 'etatDeneig': 2,
+        'dateDebutPlanif': '2015-12-09T07:00:00', 'dateFinPlanif': '2015-12-09T19:00:00'},
+    {'munid': 1, 'coteRueId': 11, 'etatDeneig': 3,
+        'dateDebutPlanif': '2015-12-09T07:00:00', 'dateFinPlanif': '2015-12-09T19:00:00',
+        'dateDebutReplanif': '2015-12-10T22:00:00', 'dateFinReplanif': '2015-12-11T06:30:00'},
+    {'munid': 1, 'coteRueId': 12, 'etatDeneig': 0},
+    {'munid': 1, 'coteRueId': 13, 'etatDeneig': 5}
+]
+
+
+def test_parse_planifications():
+    status = {}
+    res = list(parse_planifications(StringIO(InfoNeigeStub(PLANIFICATIONS).response()), status))
+    assert status == {'responseStatus': '0', 'responseDesc': 'OK'}
+    assert [x['coteRueId'] for x in res] == ['10', '11', '12', '13']
+    assert res[2].get('dateDebutPlanif') is None
+
+
+def test_planification_row():
+    x = {k: str(v) for k, v in PLANIFICATIONS[1].items()}
+    geobase_id, start, finish, active, rule, state = planification_row(x, '2015-12-09 12:00:00')
+    assert (geobase_id, start, finish, active, state) == \
+        (11, '2015-12-10 22:00:00', '2015-12-11 06:30:00', True, 3)
+    agenda = json.loads(rule)['agenda']
+    assert agenda['4'] == [[22.0, 24.0]] and agenda['5'] == [[0.0, 6.5]]
+
+    x = {'coteRueId': '12', 'etatDeneig': '0'}
+    assert planification_row(x, '2015-12-09 12:00:00') == \
+        (12, '2015-12-09 12:00:00', '2015-12-09 12:00:00', False, '{}', 0)
+    assert planification_row({'coteRueId': '13', 'etatDeneig': '5'}, '2015-12-09 12:00:00') is None
+
+
+def test_client_with_stub():
+    stub = InfoNeigeStub(PLANIFICATIONS).start()
+    try:
+        client = get_client({'PLANIFNEIGE_WSDL': stub.url + '?WSDL', 'PLANIFNEIGE_CACHE_DAYS': 1})
+        req = client.factory.create('getPlanificationsForDate')
+        req.fromDate, req.tokenString = '2015-12-09T00:00:00', 'test-token'
+        status = {}
+        res = list(parse_planifications(StringIO(client.service.GetPlanificationsForDate(req)), status))
+    finally:
+        stub.stop()
+    assert 'test-token' in stub.requests[0]
+    assert status['responseStatus'] == '0'
+    assert len(res) == 4
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+import time
+
+from ..models.free_spaces import FreeSpaces, LIVE_KEY, LIVE_UPDATED_KEY
+
+
+def test_mirror(fake_redis):
+    r = fake_redis()
+    assert FreeSpaces.get_live(r, 5) is None
+
+    now = time.time()
+    FreeSpaces.mirror(r, [1, 2], 300, now=now - 400)
+    FreeSpaces.mirror(r, [3], 300, now=now - 100)
+    FreeSpaces.mirror(r, [], 300, now=now)
+    assert sorted(r.data[LIVE_KEY]) == ['3']
+    assert r.data[LIVE_UPDATED_KEY] == str(int(now))
+    assert list(FreeSpaces.get_live(r, 5)) == [3]
+    assert FreeSpaces.get_live(r, 1) == {}
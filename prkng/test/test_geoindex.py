@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from .. import geoindex
+
+
+def test_store_and_search(fake_redis):
+    r = fake_redis()
+    geoindex.store(r, 'carshares', 'montreal', [
+        ('c:1', -73.5700, 45.5000, [1, None, 'vin1', 'car2go', 'A', 80, False, None, None, 1]),
+        ('c:2', -73.5601, 45.5000, [2, None, 'vin2', 'car2go', 'B', 20, False, None, None, 1]),
+        ('c:3', -73.6000, 45.5000, [3, None, 'vin3', 'car2go', 'C', 50, False, None, None, 1])], 600)
+    assert 'prkng:geo:carshares:montreal:new' not in r.data
+
+    res = geoindex.search(r, 'carshares', 'montreal', -73.5600, 45.5000, 1000)
+    assert [m for m, x in res] == ['c:2', 'c:1']
+    assert res[0][1][2] == 'vin2'
+
+
+def test_search_without_index(fake_redis):
+    r = fake_redis()
+    assert geoindex.search(r, 'carshares', 'montreal', -73.56, 45.5, 1000) is None
+    geoindex.store(r, 'carshares', 'montreal', [], 600)
+    assert geoindex.search(r, 'carshares', 'montreal', -73.56, 45.5, 1000) is None
+    assert geoindex.search(fake_redis(geo=False), 'carshares', 'montreal', -73.56, 45.5, 1000) is None
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+from ..ingest import Fingerprints, Ingestion, point
+
+
+def test_point():
+    assert point(-73.5, 45.25) == 'SRID=4326;POINT(-73.5 45.25)'
+
+
+def test_ingestion_commits(fake_db):
+    db = fake_db()
+    db.db.cursor_.rowcount = 2
+    with Ingestion(db, 'test') as run:
+        assert run.load('staged', [('pid', 'varchar'), ('name', 'varchar')], [(1, u'Café'), (2, None)]) == 2
+        assert run.apply('update', 'UPDATE t SET x = 1') == 2
+    assert db.db.commits == 1 and not db.db.rollbacks
+    assert db.db.cursor_.copied['staged'] == ('1\tCaf\xc3\xa9\n2\t\\N\n', ['pid', 'name'])
+    assert [x[0] for x in run.stages] == ['load staged', 'update', 'commit']
+
+
+def test_ingestion_rollbacks(fake_db):
+    db = fake_db()
+    try:
+        with Ingestion(db, 'test') as run:
+            run.apply('update', 'UPDATE t SET x = 1')
+            raise KeyError('name')
+    except KeyError:
+        pass
+    assert db.db.rollbacks == 1 and not db.db.commits
+
+
+def test_fingerprints(fake_redis):
+    r = fake_redis()
+    records = [{'id': 1, 'fuel': 50}, {'id': 2, 'fuel': 20}]
+    fp = Fingerprints(r, 'test', 60)
+    assert fp.diff(records, key=lambda x: x['id']) == {u'1', u'2'}
+    fp.save()
+
+    fp = Fingerprints(r, 'test', 60)
+    assert fp.unchanged(records, key=lambda x: x['id'])
+    records[1]['fuel'] = 19
+    assert fp.diff(records, key=lambda x: x['id']) == {u'2'}
+    assert not fp.removed
+    assert fp.diff(records[:1], key=lambda x: x['id']) == set()
+    assert fp.removed
+
+
+def test_fingerprints_non_ascii(fake_redis):
+    r = fake_redis()
+    records = [{'name': u'Gare Lucien-L\'All\xe9\u200bier'}, {'name': u'Mont-Royal'}]
+    fp = Fingerprints(r, 'test', 60)
+    assert fp.diff(records, key=lambda x: u'lot:' + x['name']) == {u'lot:' + x['name'] for x in records}
+    fp.save()
+
+    fp = Fingerprints(r, 'test', 60)
+    assert fp.unchanged(records, key=lambda x: u'lot:' + x['name'])
+    assert not fp.removed
+
+
+def test_fingerprints_rewrite(fake_redis):
+    r = fake_redis()
+    records = [{'id': 1, 'fuel': 50}]
+    fp = Fingerprints(r, 'test', 60)
+    fp.diff(records, key=lambda x: x['id'])
+    fp.save()
+    records[0]['fuel'] = 40
+    fp.diff(records, key=lambda x: x['id'])
+    fp.save()
+    assert r.data['prkng:fingerprints:test:rewrite'] == '1'
+
+    # once the rewrite is due, everything is written again even if unchanged
+    del r.data['prkng:fingerprints:test:rewrite']
+    fp = Fingerprints(r, 'test', 60)
+    assert fp.diff(records, key=lambda x: x['id']) == {u'1'}
+    assert fp.removed and not fp.unchanged(records, key=lambda x: x['id'])
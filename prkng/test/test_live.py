@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+import json
+
+from ..live import channel, publish, stream
+
+
+def test_publish_by_city(fake_redis):
+    r = fake_redis()
+    publish(r, [{'city': 'montreal', 'id': 1}, {'city': 'quebec', 'id': 2}, {'city': 'montreal', 'id': 3}])
+    assert sorted((name, json.loads(x)) for name, x in r.published) == [
+        ('prkng:live:montreal', [{'city': 'montreal', 'id': 1}, {'city': 'montreal', 'id': 3}]),
+        ('prkng:live:quebec', [{'city': 'quebec', 'id': 2}])
+    ]
+
+
+def test_stream_filters_bbox(fake_redis):
+    events = [{'id': 1, 'long': -73.56, 'lat': 45.50}, {'id': 2, 'long': -73.70, 'lat': 45.50},
+        {'id': 3, 'long': None, 'lat': None}]
+    r = fake_redis(messages=[{'type': 'message', 'data': json.dumps(events)}])
+    gen = stream(r, 'montreal', 45.51, -73.55, 45.49, -73.57, duration=60, heartbeat=0)
+    assert next(gen) == 'retry: 5000\n\n'
+    assert json.loads(next(gen)[len('data: '):]) == [events[0]]
+    assert next(gen) == ': keep-alive\n\n'
+    gen.close()
+    assert r.pubsub_.channels == [channel('montreal')]
+    assert r.pubsub_.closed
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+import json
+
+from .. import notifications
+from ..notifications import SNSPublisher
+from ..stubs import FakeSNSConnection
+
+
+def test_publisher():
+    FakeSNSConnection.reset()
+    targets = ['arn:aws:sns:us-west-2:1:endpoint/APNS/prkng/{}'.format(x) for x in range(25)]
+    FakeSNSConnection.errors.update({
+        targets[0]: [(400, 'Throttling'), (503, 'ServiceUnavailable')],
+        targets[1]: [(400, 'EndpointDisabled')],
+        targets[2]: [(400, 'InvalidParameter')],
+        targets[3]: [(503, 'ServiceUnavailable')] * 3
+    })
+    publisher = SNSPublisher(FakeSNSConnection, workers=4, retries=2, backoff=0, chunk_size=10)
+    try:
+        stats = publisher.publish(targets, 'hello')
+    finally:
+        publisher.close()
+    assert stats['targets'] == 25
+    assert (stats['sent'], stats['failed'], stats['disabled'], stats['retries']) == (22, 2, 1, 4)
+    assert sorted(x[0] for x in FakeSNSConnection.published) == sorted(targets[:1] + targets[4:])
+
+
+# the Lua scripts of the push queue, played in Python
+
+def claim_chunk(r, keys, argv):
+    queue, processing, claims = [r.data.setdefault(k, v) for k, v in zip(keys, ([], [], {}))]
+    if not queue:
+        return None
+    item = queue.pop()
+    processing.insert(0, item)
+    claims[item] = argv[0]
+    return item
+
+
+def ack_chunk(r, keys, argv):
+    processing, claims, refs, messages = [r.data.setdefault(k, v) for k, v in zip(keys, ([], {}, {}, {}))]
+    if argv[0] not in processing:
+        return -1
+    processing.remove(argv[0])
+    claims.pop(argv[0], None)
+    left = int(refs.get(argv[1], 0)) - 1
+    refs[argv[1]] = str(left)
+    if left <= 0:
+        refs.pop(argv[1])
+        messages.pop(argv[1], None)
+    return left
+
+
+def requeue_chunks(r, keys, argv):
+    claims, processing, queue = [r.data.setdefault(k, v) for k, v in zip(keys, ({}, [], []))]
+    items = [k for k, v in claims.items() if v <= argv[0]]
+    for item in items:
+        if item in processing:
+            processing.remove(item)
+            queue.append(item)
+        claims.pop(item)
+    return len(items)
+
+
+def test_push_queue(fake_redis, monkeypatch):
+    r = fake_redis()
+    r.scripts.update({notifications.CLAIM_CHUNK: claim_chunk, notifications.ACK_CHUNK: ack_chunk,
+        notifications.REQUEUE_CHUNKS: requeue_chunks})
+    monkeypatch.setattr(notifications.db, 'redis', r)
+    notifications.schedule_notifications(['arn:{}'.format(x) for x in range(2500)], 'hello')
+    assert len(r.data[notifications.QUEUE]) == 3
+
+    # a consumer dies with the first chunk, its devices are queued again after the timeout
+    item, pid, message, devices = notifications.claim(r)
+    assert (message, len(devices), devices[0]) == ('hello', 1000, 'arn:0')
+    assert notifications.requeue(r, 60) == 0
+    r.data[notifications.CLAIMS][item] -= 120
+    assert notifications.requeue(r, 60) == 1
+
+    sent = []
+    claimed = notifications.claim(r)
+    while claimed:
+        item, pid, message, devices = claimed
+        sent += devices
+        notifications.ack(r, item, pid, {"sent": len(devices), "failed": 0})
+        claimed = notifications.claim(r)
+    assert sorted(sent) == sorted('arn:{}'.format(x) for x in range(2500))
+    assert not r.data[notifications.PROCESSING] and not r.data[notifications.MESSAGES]
+
+    # stats are recorded once, when the last chunk is sent
+    stats = [json.loads(x) for x in r.data['prkng:push:stats']]
+    assert [(x['pid'], x['sent']) for x in stats] == [(pid, 2500)]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+import gzip
+import os
+import shutil
+import tempfile
+
+from ..tasks.general import archive_partition, persistent_directory
+
+
+class FakeCopy(object):
+    def copy_to(self, table, fileobj):
+        fileobj.write("1\t{}\n".format(table))
+
+
+def test_persistent_directory():
+    assert not persistent_directory(None)
+    assert not persistent_directory('/does/not/exist')
+    assert not persistent_directory(tempfile.gettempdir())
+    assert not persistent_directory(tempfile.mkdtemp())
+    assert persistent_directory(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_archive_partition():
+    directory = tempfile.mkdtemp()
+    try:
+        path = archive_partition(FakeCopy(), 'analytics_pos_y2015m01', directory)
+        assert os.listdir(directory) == ['analytics_pos_y2015m01.copy.gz']
+        with gzip.open(path, 'rb') as f:
+            assert f.read() == "1\tanalytics_pos_y2015m01\n"
+    finally:
+        shutil.rmtree(directory)
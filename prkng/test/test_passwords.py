@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+import pytest
+
+from ..passwords import PasswordPoolBusy, _Pool, _encrypt, _verify, rounds_of, stats
+
+
+def test_rounds_of():
+    assert rounds_of('$pbkdf2-sha256$200$c2FsdA$Y2hlY2tzdW0') == 200
+    assert rounds_of('not a hash') == None
+    assert rounds_of(None) == None
+
+
+def test_verify():
+    hashed = _encrypt('incrediblepass', 200)
+    assert rounds_of(hashed) == 200
+    assert _verify('incrediblepass', hashed, 200) == (True, None)
+    assert _verify('incrediblep', hashed, 200) == (False, None)
+
+
+def test_verify_upgrades_cost():
+    hashed = _encrypt('incrediblepass', 200)
+    valid, new_hash = _verify('incrediblepass', hashed, 400)
+    assert valid == True
+    assert rounds_of(new_hash) == 400
+    assert _verify('incrediblepass', new_hash, 400) == (True, None)
+
+
+def test_pool_runs_jobs():
+    pool = _Pool(1, 2)
+    try:
+        hashed = pool.run(_encrypt, ('incrediblepass', 200), 5)
+        assert pool.run(_verify, ('incrediblepass', hashed, 200), 5) == (True, None)
+        # errors raised in the pool are raised to the caller, and free their slot
+        with pytest.raises(ValueError):
+            pool.run(_verify, ('incrediblepass', 'not a hash', 200), 5)
+        assert pool.tokens.qsize() == 2
+    finally:
+        pool.close()
+
+
+def test_pool_saturated():
+    pool = _Pool(1, 1)
+    try:
+        slow = threading.Thread(target=pool.run, args=(time.sleep, (0.5,), 5))
+        slow.start()
+        time.sleep(0.1)
+        rejected = stats()['rejected']
+        with pytest.raises(PasswordPoolBusy):
+            pool.run(time.sleep, (0,), 0.1)
+        assert stats()['rejected'] == rejected + 1
+        slow.join()
+        assert pool.run(time.sleep, (0,), 1) is None
+    finally:
+        pool.close()
+
+
+def test_pool_timeout_keeps_slot():
+    pool = _Pool(1, 1)
+    try:
+        with pytest.raises(PasswordPoolBusy):
+            pool.run(time.sleep, (0.5,), 0.1)
+        # the job is still running in the pool, so it still holds the only slot
+        assert pool.tokens.qsize() == 0
+        with pytest.raises(PasswordPoolBusy):
+            pool.run(time.sleep, (0,), 0.1)
+        time.sleep(0.6)
+        assert pool.tokens.qsize() == 1
+        assert pool.run(time.sleep, (0,), 1) is None
+    finally:
+        pool.close()
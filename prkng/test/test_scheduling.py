@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from ..tasks import scheduling
+
+
+def release_lock(r, keys, argv):
+    if r.data.get(keys[0]) == argv[0]:
+        del r.data[keys[0]]
+        return 1
+    return 0
+
+
+@pytest.fixture
+def r(fake_redis):
+    r = fake_redis()
+    r.scripts[scheduling.RELEASE_LOCK] = release_lock
+    return r
+
+
+def task(calls):
+    calls.append(1)
+    return 'done'
+
+
+def test_run_records_outcome(r):
+    calls = []
+    assert scheduling.run(r, task, 120, 60, 0, (calls,), {}) == 'done'
+    tasks = scheduling.status(r)
+    assert tasks[0]['name'] == 'task' and tasks[0]['last_outcome'] == 'ok'
+    assert not tasks[0]['running'] and tasks[0]['next_run'] is None
+    assert [x['outcome'] for x in tasks[0]['history']] == ['ok']
+
+
+def test_run_skips_when_locked(r):
+    calls = []
+    r.set(scheduling.key('task', 'lock'), 'other')
+    assert scheduling.run(r, task, 120, 60, 0, (calls,), {}) is None
+    assert not calls
+    assert r.data[scheduling.key('task', 'lock')] == 'other'
+    assert scheduling.status(r)[0]['history'][0]['outcome'] == 'skipped'
+
+
+def test_run_releases_lock_on_failure(r):
+    try:
+        scheduling.run(r, task, 120, 60, 0, (None,), {})
+    except AttributeError:
+        pass
+    else:
+        assert False
+    assert scheduling.key('task', 'lock') not in r.data
+    run = scheduling.status(r)[0]['history'][0]
+    assert run['outcome'] == 'failed' and run['error'].startswith('AttributeError')
+
+
+def test_run_defers_slow_tasks(r):
+    calls = []
+    # previous runs took 10s on average, too long for an interval of 5s
+    r.hmset(scheduling.key('task'), {'runtime': 10})
+    scheduling.run(r, task, 5, 60, 0, (calls,), {})
+    assert scheduling.status(r)[0]['next_run'] is not None
+    scheduling.run(r, task, 5, 60, 0, (calls,), {})
+    assert len(calls) == 1
+
+
+def test_run_concurrent_slots(r):
+    calls = []
+    r.set(scheduling.lock_key('task'), 'other')
+    assert scheduling.run(r, task, 120, 60, 0, (calls,), {}, 2) == 'done'
+    assert scheduling.lock_key('task', 1) not in r.data
+    r.set(scheduling.lock_key('task', 1), 'another')
+    assert scheduling.run(r, task, 120, 60, 0, (calls,), {}, 2) is None
+    assert len(calls) == 1
+    assert [x['outcome'] for x in scheduling.status(r)[0]['history']] == ['skipped', 'ok']
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from psycopg2.extensions import TRANSACTION_STATUS_INTRANS
+
+from ..tasks import worker
+
+
+def test_get_db(fake_redis, fake_db, monkeypatch):
+    r = fake_redis()
+    monkeypatch.setattr(worker, 'PostgresWrapper', fake_db)
+    monkeypatch.setattr(worker, 'get_redis', lambda: r)
+    monkeypatch.setattr(worker, '_local', worker.threading.local())
+    CONFIG = {"PG_HOST": "localhost", "PG_PORT": 5432, "PG_DATABASE": "prkng",
+        "PG_USERNAME": "prkng", "PG_PASSWORD": "prkng"}
+
+    db = worker.get_db(CONFIG)
+    assert worker.get_db(CONFIG) is db
+
+    # a transaction left open by a failed task is rolled back
+    db.db.status = TRANSACTION_STATUS_INTRANS
+    assert worker.get_db(CONFIG) is db
+    assert db.db.rollbacks == 1
+
+    # a broken connection is replaced
+    db.db.status, db.db.broken = TRANSACTION_STATUS_INTRANS, True
+    other = worker.get_db(CONFIG)
+    assert other is not db and db.db.closed
+
+    stats = worker.stats(r)
+    assert len(stats) == 1
+    assert (stats[0]["connected"], stats[0]["reused"], stats[0]["reconnected"]) == (1, 2, 1)
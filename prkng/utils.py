@@ -9,6 +9,7 @@ from __future__ import print_function
 
 import aniso8601
 import hashlib
+import pytz
 import random
 
 
@@ -21,6 +22,19 @@ def timestamp(x):
     """
     return aniso8601.parse_datetime(x).isoformat(str('T'))
 
+def utc_timestamp(x):
+    """
+    Convert an ISO-8601 timestamp to a UTC timestamp without timezone, as stored in the database.
+    Comparing a column to such a constant lets PostgreSQL skip the monthly partitions out of range.
+
+    :param x: ISO-8601 timestamp (str)
+    :returns: timestamp (str)
+    """
+    dt = aniso8601.parse_datetime(x)
+    if dt.tzinfo:
+        dt = dt.astimezone(pytz.utc)
+    return dt.strftime("%Y-%m-%d %H:%M:%S")
+
 def can_be_int(data):
     """
     Simply tells you if an item (string, etc) could potentially be an integer.